@@ -0,0 +1,97 @@
+import threading
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from accounts.models import LedgerLock, ShopFinancialTransaction
+from stock.models import Shop
+
+
+class Command(BaseCommand):
+    help = (
+        "Concurrency harness for ledger appends. Starts several threads (each with its "
+        "own database connection) that post receipts to one scratch shop and one scratch "
+        "manual customer at the same time, then checks that every running balance and "
+        "the stored shop balance add up. The scratch rows are removed afterwards. "
+        "Run it against the production database engine to exercise real row locks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help="Concurrent writer threads.")
+        parser.add_argument('--entries', type=int, default=25, help="Ledger entries posted by each worker per ledger.")
+        parser.add_argument('--user', help="Username to record the entries under. Defaults to the first superuser.")
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['user']).first() if options['user'] else User.objects.filter(is_superuser=True).first()
+        if user is None:
+            raise CommandError("No user to post the entries with; pass --user.")
+
+        tag = f"ledger-check-{uuid.uuid4().hex[:8]}"
+        shop = Shop.objects.create(user=user, name=tag, notes="Scratch shop of ledger_concurrency_check.")
+        customer_name = tag
+        errors = []
+        start = threading.Barrier(options['workers'])
+
+        def worker(index):
+            try:
+                start.wait()
+                for entry in range(options['entries']):
+                    # Alternate debits and credits so a lost update shows up in the balances.
+                    amount = Decimal(index + 1) + Decimal(entry) / 100
+                    debit, credit = (amount, Decimal('0.00')) if entry % 2 == 0 else (Decimal('0.00'), amount)
+                    ShopFinancialTransaction(
+                        shop=shop, user=user, transaction_type='CASH_RECEIPT',
+                        debit_amount=debit, credit_amount=credit, notes=tag,
+                    ).save()
+                    ShopFinancialTransaction(
+                        customer_name_snapshot=customer_name, user=user, transaction_type='CASH_RECEIPT',
+                        debit_amount=debit, credit_amount=credit, notes=tag,
+                    ).save()
+            except Exception as e:
+                errors.append(f"worker {index}: {e}")
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(options['workers'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        try:
+            problems = list(errors)
+            expected_rows = options['workers'] * options['entries']
+            for label, ledger, owner in [
+                (f"shop {shop.name}", ShopFinancialTransaction.objects.filter(shop=shop), shop),
+                (f"manual customer {customer_name}", ShopFinancialTransaction.objects.filter(shop__isnull=True, customer_name_snapshot=customer_name), None),
+            ]:
+                running = Decimal('0.00')
+                rows = 0
+                for debit, credit, balance in ledger.order_by('transaction_date', 'pk').values_list('debit_amount', 'credit_amount', 'balance'):
+                    running += debit - credit
+                    rows += 1
+                    if balance != running:
+                        problems.append(f"{label}: row {rows} has balance Rs {balance}, expected Rs {running}")
+                        break
+                if rows != expected_rows:
+                    problems.append(f"{label}: {rows} rows written, expected {expected_rows}")
+                self.stdout.write(f"{label}: {rows} rows, closing balance Rs {running}")
+                if owner is not None:
+                    owner.refresh_from_db()
+                    if owner.balance != running:
+                        problems.append(f"{label}: stored balance Rs {owner.balance}, ledger Rs {running}")
+        finally:
+            ShopFinancialTransaction.objects.filter(notes=tag).delete()
+            LedgerLock.objects.filter(key__contains=tag).delete()
+            shop.delete()
+
+        if problems:
+            for problem in problems:
+                self.stderr.write(problem)
+            raise CommandError(f"{len(problems)} problem(s) found under concurrent appends.")
+        self.stdout.write(self.style.SUCCESS(
+            f"{options['workers']} workers x {options['entries']} entries per ledger: all balances consistent."
+        ))
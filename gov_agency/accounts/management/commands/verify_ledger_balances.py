@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from accounts.models import CustomAccount, CustomAccountTransaction, ShopFinancialTransaction
+from accounts.utils import ledger_total, recalc_custom_account_balances, recalc_shop_balances
+from stock.models import Shop
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the stored Shop.balance and CustomAccount.balance with the sum of "
+        "their ledgers and reports every mismatch. Use --fix to rebuild the running "
+        "balances and stored totals of the mismatched ledgers."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help="Rebuild the ledgers that do not match.")
+
+    def handle(self, *args, **options):
+        checks = [
+            ('Shop', Shop.objects.annotate(ledger_balance=ledger_total(ShopFinancialTransaction, 'shop')), recalc_shop_balances),
+            ('Custom account', CustomAccount.objects.annotate(ledger_balance=ledger_total(CustomAccountTransaction, 'account')), recalc_custom_account_balances),
+        ]
+        mismatches = 0
+        for label, owners, recalc in checks:
+            for owner in owners.only('pk', 'name', 'balance').iterator():
+                if owner.balance == owner.ledger_balance:
+                    continue
+                mismatches += 1
+                self.stdout.write(
+                    f"{label} #{owner.pk} {owner.name}: stored Rs {owner.balance}, ledger Rs {owner.ledger_balance}"
+                )
+                if options['fix']:
+                    with transaction.atomic():
+                        recalc(owner.pk)
+
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS("All stored balances match their ledgers."))
+        elif options['fix']:
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt {mismatches} ledger(s)."))
+        else:
+            self.stdout.write(self.style.WARNING(f"{mismatches} mismatch(es). Run again with --fix to repair them."))
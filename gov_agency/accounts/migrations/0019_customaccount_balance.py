@@ -0,0 +1,42 @@
+# Generated by Django 4.2.21 on 2026-10-18 14:40
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def backfill_balances(apps, schema_editor):
+    # balance = SUM(debit - credit) over the existing ledger, one UPDATE for all rows.
+    CustomAccount = apps.get_model('accounts', 'CustomAccount')
+    Ledger = apps.get_model('accounts', 'CustomAccountTransaction')
+    totals = (
+        Ledger.objects.filter(account=models.OuterRef('pk'))
+        .order_by()
+        .values('account')
+        .annotate(total=models.Sum(models.F('debit_amount') - models.F('credit_amount')))
+        .values('total')
+    )
+    CustomAccount.objects.update(balance=Coalesce(
+        models.Subquery(totals, output_field=models.DecimalField(max_digits=14, decimal_places=2)),
+        models.Value(Decimal('0.00')),
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0018_customaccounttransaction_balance'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='customaccounttransaction',
+            options={'ordering': ['transaction_date', 'pk'], 'verbose_name': 'Custom Account Transaction', 'verbose_name_plural': 'Custom Account Transactions'},
+        ),
+        migrations.AddField(
+            model_name='customaccount',
+            name='balance',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=Decimal('0.00'), max_digits=14),
+        ),
+        migrations.RunPython(backfill_balances, migrations.RunPython.noop),
+    ]
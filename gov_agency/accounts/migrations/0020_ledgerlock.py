@@ -0,0 +1,20 @@
+# Generated by Django 4.2.21 on 2026-10-18 14:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0019_customaccount_balance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.21 on 2026-10-18 14:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0020_ledgerlock'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customaccounttransaction',
+            index=models.Index(fields=['account', 'transaction_date', 'id'], name='customledger_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shopfinancialtransaction',
+            index=models.Index(fields=['shop', 'transaction_date', 'id'], name='shopledger_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shopfinancialtransaction',
+            index=models.Index(fields=['customer_name_snapshot', 'transaction_date', 'id'], name='manualledger_keyset_idx'),
+        ),
+    ]
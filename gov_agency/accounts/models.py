@@ -3,12 +3,123 @@ from django.contrib.auth.models import User
 from django.utils import timezone
 from decimal import Decimal
 from django.core.validators import MinValueValidator
-from django.db.models import Sum  # <-- ADD THIS LINE
+from django.db.models import Sum, Q, F  # <-- ADD THIS LINE
+from gov_agency.decorators import retry_on_conflict
 
 # Create your models here.
 
 
-class ShopFinancialTransaction(models.Model):
+class LedgerLock(models.Model):
+    """
+    A row to lock for ledgers that have no owner row of their own (manual customers),
+    so their appends are serialized the same way a Shop or CustomAccount row does.
+    """
+    key = models.CharField(max_length=255, unique=True)
+
+    def __str__(self):
+        return self.key
+
+
+class LedgerBalanceMixin:
+    """
+    Keeps `balance` a running SUM(debit - credit) in (transaction_date, pk) order.
+    An entry written at the end of its ledger takes its balance from the row before it.
+    A backdated insert, an edit or a delete also rebalances the later rows of that
+    ledger (and of the ledger it moved out of), in the same transaction. The owner's
+    stored `balance` (Shop, CustomAccount) moves by the entry's net change.
+    Writes to one ledger are serialized by lock_ledger(). A save or delete outside any
+    transaction is retried on lock conflicts; inside one, the retry belongs to the
+    outermost boundary (retry_on_conflict on the service call or job task).
+    """
+
+    def ledger_filter(self):
+        """Filter kwargs selecting the ledger this entry belongs to."""
+        raise NotImplementedError
+
+    def ledger_owner(self):
+        """The queryset of the row (Shop, CustomAccount) holding this ledger's stored balance, or None."""
+        return None
+
+    @property
+    def net_amount(self):
+        return (self.debit_amount or Decimal("0.00")) - (self.credit_amount or Decimal("0.00"))
+
+    @staticmethod
+    def _shift_owner_balance(owner, delta):
+        if owner is not None and delta:
+            owner.update(balance=F("balance") + delta)
+
+    def ledger_lock_key(self):
+        """Names this entry's ledger; used for the lock row and for lock ordering."""
+        return ":".join(f"{key}={value}" for key, value in sorted(self.ledger_filter().items()))
+
+    def lock_ledger(self, *others):
+        """
+        Takes SELECT ... FOR UPDATE on the row guarding this entry's ledger (and those of
+        `others`, in key order): the owner row when there is one, otherwise a LedgerLock
+        row. Writers to the same ledger queue up here until the holder commits.
+        """
+        entries = sorted({entry.ledger_lock_key(): entry for entry in (self, *others)}.items())
+        for key, entry in entries:
+            guard = entry.ledger_owner()
+            if guard is None:
+                LedgerLock.objects.get_or_create(key=key)
+                guard = LedgerLock.objects.filter(key=key)
+            list(guard.select_for_update().values_list("pk", flat=True))
+
+    def save(self, *args, **kwargs):
+        retry_on_conflict(self._save_balanced)(*args, **kwargs)
+
+    def _save_balanced(self, *args, **kwargs):
+        from .utils import recompute_running_balances
+        model = type(self)
+        filters = self.ledger_filter()
+        stored = model.objects.filter(pk=self.pk).first() if self.pk else None
+        self.lock_ledger(*([stored] if stored is not None else []))
+        ledger = model.objects.filter(**filters)
+
+        when = self.transaction_date
+        before = Q(transaction_date__lt=when) | Q(transaction_date=when, pk__lt=self.pk) if self.pk else Q(transaction_date__lte=when)
+        previous_balance = (
+            ledger.exclude(pk=self.pk).filter(before)
+            .order_by("-transaction_date", "-pk")
+            .values_list("balance", flat=True)
+            .first()
+        ) or Decimal("0.00")
+        self.balance = previous_balance + self.debit_amount - self.credit_amount
+        super().save(*args, **kwargs)
+
+        since = when
+        if stored is None:
+            self._shift_owner_balance(self.ledger_owner(), self.net_amount)
+        else:
+            stored_filters = stored.ledger_filter()
+            if stored_filters != filters:
+                recompute_running_balances(model.objects.filter(**stored_filters), since=stored.transaction_date)
+                self._shift_owner_balance(stored.ledger_owner(), -stored.net_amount)
+                self._shift_owner_balance(self.ledger_owner(), self.net_amount)
+            else:
+                since = min(since, stored.transaction_date)
+                self._shift_owner_balance(self.ledger_owner(), self.net_amount - stored.net_amount)
+        # Only rows from `since` on can be affected; appending to the end touches none.
+        if ledger.exclude(pk=self.pk).filter(transaction_date__gte=since).exists():
+            recompute_running_balances(ledger, since=since)
+            self.balance = ledger.filter(pk=self.pk).values_list("balance", flat=True).get()
+
+    def delete(self, *args, **kwargs):
+        return retry_on_conflict(self._delete_balanced)(*args, **kwargs)
+
+    def _delete_balanced(self, *args, **kwargs):
+        from .utils import recompute_running_balances
+        self.lock_ledger()
+        ledger = type(self).objects.filter(**self.ledger_filter())
+        result = super().delete(*args, **kwargs)
+        recompute_running_balances(ledger, since=self.transaction_date)
+        self._shift_owner_balance(self.ledger_owner(), -self.net_amount)
+        return result
+
+
+class ShopFinancialTransaction(LedgerBalanceMixin, models.Model):
     """
     Represents a single ledger entry (debit or credit) for a specific shop.
     """
@@ -79,27 +190,25 @@ class ShopFinancialTransaction(models.Model):
     def __str__(self):
         return f"{self.get_transaction_type_display()} for {self.get_customer_display_name()} on {self.transaction_date.strftime('%Y-%m-%d')} customer name is {self.customer_name_snapshot}"
     
-    def save(self, *args, **kwargs):
-        # Get the latest previous balance for this shop or manual customer
-        if self.shop:
-            last_transaction = ShopFinancialTransaction.objects.filter(
-                shop=self.shop
-            ).exclude(pk=self.pk).order_by("-transaction_date", "-pk").first()
-        else:
-            last_transaction = ShopFinancialTransaction.objects.filter(
-                shop__isnull=True,
-                customer_name_snapshot=self.customer_name_snapshot
-            ).exclude(pk=self.pk).order_by("-transaction_date", "-pk").first()
-
-        previous_balance = last_transaction.balance if last_transaction else Decimal("0.00")
-
-        # Calculate new balance
-        self.balance = previous_balance + self.debit_amount - self.credit_amount
-
-        super().save(*args, **kwargs)
+    def ledger_filter(self):
+        # A registered shop's ledger, or a manual customer's by name.
+        if self.shop_id:
+            return {'shop_id': self.shop_id}
+        return {'shop_id': None, 'customer_name_snapshot': self.customer_name_snapshot}
+
+    def ledger_owner(self):
+        # Manual customers have no row to keep a balance on.
+        if self.shop_id:
+            return self._meta.get_field('shop').related_model.objects.filter(pk=self.shop_id)
+        return None
 
     class Meta:
         ordering = ['-transaction_date', '-pk'] # Order by most recent first
+        indexes = [
+            # Keyset pages and running-balance recomputes walk one ledger in (transaction_date, id) order.
+            models.Index(fields=['shop', 'transaction_date', 'id'], name='shopledger_keyset_idx'),
+            models.Index(fields=['customer_name_snapshot', 'transaction_date', 'id'], name='manualledger_keyset_idx'),
+        ]
         verbose_name = "Shop Financial Transaction"
         verbose_name_plural = "Shop Financial Transactions"
 
@@ -121,20 +230,16 @@ class CustomAccount(models.Model):
     phone_number = models.CharField(max_length=20, blank=True, null=True)
     notes = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Total debits - total credits of the account's ledger, maintained by its transactions.
+    balance = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'), db_index=True)
 
     def __str__(self):
         return self.name
 
     @property
     def current_balance(self):
-        """Calculates the current balance from its related transactions."""
-        totals = self.transactions.aggregate(
-            total_debit=Sum('debit_amount'),
-            total_credit=Sum('credit_amount')
-        )
-        total_debit = totals.get('total_debit') or Decimal('0.00')
-        total_credit = totals.get('total_credit') or Decimal('0.00')
-        return total_debit - total_credit
+        """The account's balance: Total Debits - Total Credits."""
+        return self.balance
 
     class Meta:
         ordering = ['name']
@@ -144,7 +249,7 @@ class CustomAccount(models.Model):
         verbose_name_plural = "Custom Accounts"
 
 
-class CustomAccountTransaction(models.Model):
+class CustomAccountTransaction(LedgerBalanceMixin, models.Model):
     """Represents a single debit or credit ledger entry for a CustomAccount."""
     account = models.ForeignKey(
         CustomAccount,
@@ -172,23 +277,16 @@ class CustomAccountTransaction(models.Model):
     def __str__(self):
         return f"Transaction for {self.account.name} on {self.transaction_date.strftime('%Y-%m-%d')}"
 
-    def save(self, *args, **kwargs):
-        # Get the latest previous balance for this account (excluding current if updating)
-        last_transaction = (
-            CustomAccountTransaction.objects
-            .filter(account=self.account)
-            .exclude(pk=self.pk)
-            .order_by("-transaction_date", "-pk")
-            .first()
-        )
-        previous_balance = last_transaction.balance if last_transaction else Decimal("0.00")
-        # Calculate new balance
-        self.balance = previous_balance + self.debit_amount - self.credit_amount
-        super().save(*args, **kwargs)
+    def ledger_filter(self):
+        return {'account_id': self.account_id}
+
+    def ledger_owner(self):
+        return CustomAccount.objects.filter(pk=self.account_id)
 
 
     class Meta:
         ordering = ['transaction_date', 'pk']
+        indexes = [models.Index(fields=['account', 'transaction_date', 'id'], name='customledger_keyset_idx')]
         verbose_name = "Custom Account Transaction"
         verbose_name_plural = "Custom Account Transactions"
 
@@ -1,3 +1,222 @@
-from django.test import TestCase
+import threading
+from datetime import timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from gov_agency.decorators import retry_on_conflict
+from stock.models import Shop
+from .models import ShopFinancialTransaction, CustomAccount, CustomAccountTransaction
+from .views import LEDGER_PAGE_SIZE
+
+
+def assert_running_balances(test, ledger):
+    """Every stored balance equals the running SUM(debit - credit) up to that row."""
+    running = Decimal('0.00')
+    for debit, credit, balance in ledger.order_by('transaction_date', 'pk').values_list('debit_amount', 'credit_amount', 'balance'):
+        running += debit - credit
+        test.assertEqual(balance, running)
+    return running
+
+
+class LedgerRebalanceTests(TestCase):
+    """Backdated inserts, edits, moves and deletes rebalance the later rows."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('clerk', password='x')
+        self.shop = Shop.objects.create(user=self.user, name='Corner Store')
+        self.start = timezone.now() - timedelta(days=30)
+        for day in range(10):
+            ShopFinancialTransaction.objects.create(
+                shop=self.shop, user=self.user, transaction_type='CREDIT_SALE',
+                debit_amount=Decimal('10.00'), transaction_date=self.start + timedelta(days=day),
+            )
+
+    def shop_ledger(self):
+        return ShopFinancialTransaction.objects.filter(shop=self.shop)
+
+    def assert_shop_balanced(self):
+        closing = assert_running_balances(self, self.shop_ledger())
+        self.shop.refresh_from_db()
+        self.assertEqual(self.shop.balance, closing)
+        return closing
+
+    def test_backdated_insert_rebalances_later_rows(self):
+        receipt = ShopFinancialTransaction.objects.create(
+            shop=self.shop, user=self.user, transaction_type='CASH_RECEIPT',
+            credit_amount=Decimal('7.00'), transaction_date=self.start + timedelta(days=2, hours=1),
+        )
+        self.assertEqual(receipt.balance, Decimal('23.00'))
+        self.assertEqual(self.assert_shop_balanced(), Decimal('93.00'))
+
+    def test_edit_moving_an_entry_rebalances_both_positions(self):
+        entry = self.shop_ledger().order_by('transaction_date', 'pk')[7]
+        entry.transaction_date = self.start - timedelta(days=1)
+        entry.debit_amount = Decimal('25.00')
+        entry.save()
+        self.assertEqual(self.assert_shop_balanced(), Decimal('115.00'))
+
+    def test_delete_rebalances_later_rows(self):
+        self.shop_ledger().order_by('transaction_date', 'pk')[3].delete()
+        self.assertEqual(self.assert_shop_balanced(), Decimal('90.00'))
+
+    def test_moving_an_entry_to_another_ledger_rebalances_both(self):
+        ShopFinancialTransaction.objects.create(
+            customer_name_snapshot='Walk-in Ali', user=self.user, transaction_type='CREDIT_SALE',
+            debit_amount=Decimal('4.00'), transaction_date=self.start + timedelta(days=5),
+        )
+        entry = self.shop_ledger().order_by('transaction_date', 'pk')[2]
+        entry.shop = None
+        entry.customer_name_snapshot = 'Walk-in Ali'
+        entry.save()
+        self.assertEqual(self.assert_shop_balanced(), Decimal('90.00'))
+        manual = ShopFinancialTransaction.objects.filter(shop__isnull=True, customer_name_snapshot='Walk-in Ali')
+        self.assertEqual(assert_running_balances(self, manual), Decimal('14.00'))
+
+    def test_custom_account_edit_and_delete_rebalance(self):
+        account = CustomAccount.objects.create(user=self.user, name='Supplier')
+        entries = [
+            CustomAccountTransaction.objects.create(
+                account=account, user=self.user, debit_amount=Decimal('5.00'),
+                transaction_date=self.start + timedelta(days=day),
+            )
+            for day in range(4)
+        ]
+        entries[3].transaction_date = self.start - timedelta(days=1)
+        entries[3].save()
+        entries[0].delete()
+        closing = assert_running_balances(self, account.transactions.all())
+        account.refresh_from_db()
+        self.assertEqual(closing, Decimal('15.00'))
+        self.assertEqual(account.balance, closing)
+
+
+class LedgerPageTests(TestCase):
+    """Ledger pages are keyset pages with an opening/closing balance band."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('clerk', password='x')
+        self.shop = Shop.objects.create(user=self.user, name='Corner Store')
+        start = timezone.now() - timedelta(days=200)
+        for day in range(LEDGER_PAGE_SIZE + 20):
+            ShopFinancialTransaction.objects.create(
+                shop=self.shop, user=self.user, transaction_type='CREDIT_SALE',
+                debit_amount=Decimal(day + 1), transaction_date=start + timedelta(days=day),
+            )
+        self.client.force_login(self.user)
+        self.url = reverse('accounts:shop_ledger', args=[self.shop.pk])
+
+    def test_pages_chain_their_balance_bands(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        page = first.context['ledger_entries']
+        self.assertEqual(len(page), LEDGER_PAGE_SIZE)
+        self.shop.refresh_from_db()
+        self.assertEqual(first.context['page_closing_balance'], self.shop.balance)
+        self.assertEqual(first.context['current_balance'], self.shop.balance)
+
+        second = self.client.get(self.url, {'after': page.next_cursor, 'partial': 1})
+        self.assertTemplateUsed(second, 'accounts/partials/shop_ledger_page.html')
+        self.assertEqual(len(second.context['ledger_entries']), 20)
+        self.assertFalse(second.context['ledger_entries'].has_next)
+        self.assertEqual(second.context['page_closing_balance'], first.context['page_opening_balance'])
+        self.assertEqual(second.context['page_opening_balance'], Decimal('0.00'))
+
+        back = self.client.get(self.url, {'before': second.context['ledger_entries'].previous_cursor, 'partial': 1})
+        self.assertEqual([entry.pk for entry in back.context['ledger_entries']], [entry.pk for entry in page])
+
+    def test_current_balance_is_read_not_summed(self):
+        # The stored balance is what the page shows, even when it has drifted from the rows.
+        Shop.objects.filter(pk=self.shop.pk).update(balance=Decimal('1.00'))
+        response = self.client.get(self.url, {'after': self.client.get(self.url).context['ledger_entries'].next_cursor})
+        self.assertEqual(response.context['current_balance'], Decimal('1.00'))
+        self.assertNotIn('total_debit', response.context)
+
+    def test_manual_customer_balance_comes_from_the_newest_entry(self):
+        for amount in ('5.00', '7.00'):
+            ShopFinancialTransaction.objects.create(
+                customer_name_snapshot='Walk-in Ali', user=self.user, transaction_type='CREDIT_SALE', debit_amount=Decimal(amount),
+            )
+        response = self.client.get(reverse('accounts:manual_customer_ledger', args=['Walk-in Ali']))
+        self.assertEqual(response.context['current_balance'], Decimal('12.00'))
+
+    def test_malformed_cursor_falls_back_to_the_first_page(self):
+        response = self.client.get(self.url, {'after': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['ledger_entries']), LEDGER_PAGE_SIZE)
+
+
+class ConcurrentLedgerWriteTests(TransactionTestCase):
+    """
+    Several threads append to the same ledgers at once, each write in its own
+    retry_on_conflict transaction, and no append may be lost or misbalanced.
+    """
+    WRITERS = 4
+    WRITES_PER_WRITER = 10
+
+    def setUp(self):
+        self.user = User.objects.create_user('clerk', password='x')
+        self.shop = Shop.objects.create(user=self.user, name='Corner Store')
+        self.account = CustomAccount.objects.create(user=self.user, name='Supplier')
+
+    def run_writers(self, write):
+        errors = []
+
+        def writer(index):
+            try:
+                for step in range(self.WRITES_PER_WRITER):
+                    retry_on_conflict(write)(index, step)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=writer, args=(index,)) for index in range(self.WRITERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_concurrent_shop_and_manual_ledger_appends(self):
+        def write(index, step):
+            # Even writers sell on credit to the shop, odd ones take cash from a walk-in.
+            if index % 2 == 0:
+                ShopFinancialTransaction.objects.create(
+                    shop=self.shop, user=self.user, transaction_type='CREDIT_SALE', debit_amount=Decimal('3.00'),
+                )
+            else:
+                ShopFinancialTransaction.objects.create(
+                    customer_name_snapshot='Walk-in Ali', user=self.user, transaction_type='CASH_RECEIPT',
+                    credit_amount=Decimal('2.00'),
+                )
+
+        self.run_writers(write)
+        writes = self.WRITERS // 2 * self.WRITES_PER_WRITER
+        shop_ledger = ShopFinancialTransaction.objects.filter(shop=self.shop)
+        manual_ledger = ShopFinancialTransaction.objects.filter(shop__isnull=True, customer_name_snapshot='Walk-in Ali')
+        self.assertEqual(shop_ledger.count(), writes)
+        self.assertEqual(assert_running_balances(self, shop_ledger), Decimal('3.00') * writes)
+        self.assertEqual(assert_running_balances(self, manual_ledger), Decimal('-2.00') * writes)
+        self.shop.refresh_from_db()
+        self.assertEqual(self.shop.balance, Decimal('3.00') * writes)
+
+    def test_concurrent_backdated_custom_account_writes(self):
+        start = timezone.now() - timedelta(days=1)
+
+        def write(index, step):
+            # Interleaved dates, so most writes land before rows other writers already added.
+            CustomAccountTransaction.objects.create(
+                account=self.account, user=self.user, debit_amount=Decimal(index + 1),
+                transaction_date=start + timedelta(minutes=step * self.WRITERS + (self.WRITERS - index)),
+            )
+
+        self.run_writers(write)
+        expected = sum(Decimal(index + 1) for index in range(self.WRITERS)) * self.WRITES_PER_WRITER
+        self.assertEqual(assert_running_balances(self, self.account.transactions.all()), expected)
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, expected)
@@ -1,38 +1,176 @@
 # utils.py (in your app)
 from decimal import Decimal
 from .models import ShopFinancialTransaction
-from .models import CustomAccountTransaction
+from .models import CustomAccount, CustomAccountTransaction, DailySummary
+from django.db.models import Sum, Q, F, Value, DecimalField, Window, RowRange, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from stock.models import SalesTransaction, SalesDailyRollup, Shop
+from stock.utils import sales_rollup_contributions
+from expense.models import Expense
 
-def recalc_shop_balances(shop_id):
-    qs = (
-        ShopFinancialTransaction.objects
-        .filter(shop_id=shop_id)
-        .order_by("transaction_date", "pk")  # ascending oldest first
+# --- Running balances ----------------------------------------------------------------
+# Ledger balances are a running SUM(debit - credit) in (transaction_date, id) order.
+# The database computes it with a window function; only rows whose stored balance is
+# wrong are written back, in chunked bulk_updates. Pass `since` to start from a date
+# (e.g. a backdated entry): rows before it are left alone and seed the opening balance.
+
+BALANCE_WRITE_CHUNK = 1000
+
+
+def recompute_running_balances(ledger, since=None):
+    """
+    Rewrites `balance` on every row of `ledger` (one shop's or one account's entries)
+    from `since` onwards and returns the closing balance.
+    """
+    opening = Decimal("0.00")
+    if since is not None:
+        previous = (
+            ledger.filter(transaction_date__lt=since)
+            .order_by("-transaction_date", "-pk")
+            .values_list("balance", flat=True)
+            .first()
+        )
+        opening = previous or Decimal("0.00")
+        ledger = ledger.filter(transaction_date__gte=since)
+
+    movement = Coalesce(F("debit_amount"), Value(Decimal("0.00"))) - Coalesce(F("credit_amount"), Value(Decimal("0.00")))
+    rows = (
+        ledger.annotate(running=Window(
+            expression=Sum(movement, output_field=DecimalField(max_digits=16, decimal_places=2)),
+            order_by=[F("transaction_date").asc(), F("pk").asc()],
+            frame=RowRange(start=None, end=0),
+        ))
+        .order_by("transaction_date", "pk")
+        .values_list("pk", "balance", "running")
+    )
+
+    model = ledger.model
+    closing = opening
+    stale = []
+    for pk, stored, running in rows.iterator(chunk_size=BALANCE_WRITE_CHUNK):
+        closing = (opening + Decimal(str(running))).quantize(Decimal("0.01"))
+        if stored != closing:
+            stale.append(model(pk=pk, balance=closing))
+        if len(stale) >= BALANCE_WRITE_CHUNK:
+            model.objects.bulk_update(stale, ["balance"])
+            stale = []
+    if stale:
+        model.objects.bulk_update(stale, ["balance"])
+    return closing
+
+
+def recalc_shop_balances(shop_id, since=None):
+    closing = recompute_running_balances(ShopFinancialTransaction.objects.filter(shop_id=shop_id), since=since)
+    sync_shop_balances([shop_id])
+    return closing
+
+
+def recalc_custom_account_balances(account_id, since=None):
+    closing = recompute_running_balances(CustomAccountTransaction.objects.filter(account_id=account_id), since=since)
+    sync_custom_account_balances([account_id])
+    return closing
+
+
+# --- Stored owner balances -----------------------------------------------------------
+# Shop.balance and CustomAccount.balance hold SUM(debit - credit) of their ledger.
+# Single entry writes move them by the entry's net change (LedgerBalanceMixin); bulk
+# ledger writes call these to reset them from the ledger in one UPDATE.
+
+
+def ledger_total(ledger_model, owner_field):
+    """Subquery: SUM(debit - credit) of the `ledger_model` rows whose `owner_field` is the outer row."""
+    return Coalesce(
+        Subquery(
+            ledger_model.objects.filter(**{owner_field: OuterRef("pk")})
+            .order_by()
+            .values(owner_field)
+            .annotate(total=Sum(F("debit_amount") - F("credit_amount")))
+            .values("total"),
+            output_field=DecimalField(max_digits=14, decimal_places=2),
+        ),
+        Value(Decimal("0.00")),
     )
 
-    balance = Decimal("0.00")
-    for tx in qs:
-        debit = tx.debit_amount or Decimal("0.00")
-        credit = tx.credit_amount or Decimal("0.00")
-        balance = balance + debit - credit
-        tx.balance = balance
-        ShopFinancialTransaction.objects.filter(pk=tx.pk).update(balance=balance)
-        # print(f'[{tx.id}] debit={debit} credit={credit} new_balance={balance}')
-    return balance
-
-
-def recalc_custom_account_balances(account_id):
-    qs = (
-        CustomAccountTransaction.objects
-        .filter(account_id=account_id)
-        .order_by("transaction_date", "pk")  # ascending order
+
+def lock_shop_ledgers(shop_ids):
+    """
+    Row-locks the shops in pk order before a bulk ledger change, so single-entry writes
+    (which lock the same Shop row) wait for it instead of interleaving.
+    """
+    return list(Shop.objects.select_for_update().filter(pk__in=shop_ids).order_by("pk").values_list("pk", flat=True))
+
+
+def sync_shop_balances(shop_ids):
+    return Shop.objects.filter(pk__in=shop_ids).update(balance=ledger_total(ShopFinancialTransaction, "shop"))
+
+
+def sync_custom_account_balances(account_ids):
+    return CustomAccount.objects.filter(pk__in=account_ids).update(balance=ledger_total(CustomAccountTransaction, "account"))
+
+
+def build_daily_summary(user, target_date):
+    """
+    Generates or updates the user's DailySummary for `target_date` from that day's
+    sales, expenses and ledger entries. Returns (summary, created).
+    Revenue and profit come from the day's SalesDailyRollup rows; the rollup counts a
+    sale from dispatch, so the day's deliveries still pending are taken back out.
+    """
+    # --- GATHER DATA ---
+    sales_for_day = SalesTransaction.objects.filter(user=user, transaction_time__date=target_date).filter(~Q(status='PENDING_DELIVERY'))
+    expenses_for_day = Expense.objects.filter(user=user, expense_date__date=target_date)
+    shop_financial_entries_for_day = ShopFinancialTransaction.objects.filter(user=user, transaction_date__date=target_date)
+    custom_account_entries_for_day = CustomAccountTransaction.objects.filter(user=user, transaction_date__date=target_date, store_in_daily_summery=True)
+
+    # --- CALCULATE REPORTING & CASH FLOW COMPONENTS ---
+    rollup = SalesDailyRollup.objects.filter(user=user, business_date=target_date).aggregate(
+        revenue=Sum('revenue'), cost=Sum('cost'), discount=Sum('discount'),
     )
+    sales_totals = {measure: rollup[measure] or Decimal('0.00') for measure in rollup}
+    pending_for_day = SalesTransaction.objects.filter(user=user, transaction_time__date=target_date, status='PENDING_DELIVERY').only('pk')
+    for values in sales_rollup_contributions(pending_for_day).values():
+        contribution = dict(zip(SalesDailyRollup.MEASURE_FIELDS, values))
+        for measure in sales_totals:
+            sales_totals[measure] -= contribution[measure]
+    total_revenue = sales_totals['revenue'] - sales_totals['discount']
+    total_profit = total_revenue - sales_totals['cost']
+    total_expense = expenses_for_day.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
+
+    # --- PAYMENT CALCULATIONS (handles the 'SPLIT' type) ---
+    # Cash, online and credit parts of the day's sales.
+    cash_from_sales = sales_for_day.aggregate(total=Sum('amount_paid_cash'))['total'] or Decimal('0.00')
+    online_sales_today = sales_for_day.aggregate(total=Sum('amount_paid_online'))['total'] or Decimal('0.00')
+    # This is the amount that was added to various customer ledgers from the day's sales.
+    credit_given_from_sales = sales_for_day.aggregate(total=Sum('amount_on_credit'))['total'] or Decimal('0.00')
 
-    balance = Decimal("0.00")
-    for tx in qs:
-        debit = tx.debit_amount or Decimal("0.00")
-        credit = tx.credit_amount or Decimal("0.00")
-        balance = balance + debit - credit
-        CustomAccountTransaction.objects.filter(pk=tx.pk).update(balance=balance)
-        # print(f"[{tx.pk}] debit={debit} credit={credit} balance={balance}")
-    return balance
\ No newline at end of file
+    # --- DEBIT/CREDIT AND CASH RECEIVED CALCULATIONS ---
+    # Cash Received from PAST Credit Sales (from shop/custom ledgers)
+    cash_received_from_shops_ledger = shop_financial_entries_for_day.filter(transaction_type='CASH_RECEIPT').aggregate(total=Sum('credit_amount'))['total'] or Decimal('0.00')
+    cash_received_from_custom_ledger = custom_account_entries_for_day.filter(credit_amount__gt=0).aggregate(total=Sum('credit_amount'))['total'] or Decimal('0.00')
+    total_cash_received_on_account = cash_received_from_shops_ledger + cash_received_from_custom_ledger
+    online_cash_received = shop_financial_entries_for_day.filter(transaction_type='ONLINE').aggregate(total=Sum('credit_amount'))['total'] or Decimal('0.00')
+    # Total debit is the new credit given out plus any manual debits.
+    debit_from_custom_manual = custom_account_entries_for_day.filter(debit_amount__gt=0).aggregate(total=Sum('debit_amount'))['total'] or Decimal('0.00')
+    total_debit_today = credit_given_from_sales + debit_from_custom_manual
+
+    # --- FINAL NET CALCULATIONS ---
+    # Net Physical Cash = (Cash from the day's sales) + (Cash received for old debts) - (The day's expenses)
+    net_physical_cash = ((cash_from_sales + total_cash_received_on_account) - total_expense) - debit_from_custom_manual
+    # Net Total Settlement = (All cash-like payments from the day's sales) + (Cash received for old debts) - (The day's expenses)
+    net_total_settlement = ((cash_from_sales + online_sales_today + total_cash_received_on_account + online_cash_received) - total_expense) - debit_from_custom_manual
+
+    # --- SAVE THE SUMMARY ---
+    return DailySummary.objects.update_or_create(
+        user=user,
+        summary_date=target_date,
+        defaults={
+            'total_revenue': total_revenue,
+            'total_profit': total_profit,
+            'total_debit_today': total_debit_today,
+            'online_sales_today': online_sales_today,
+            'online_received_cash': online_cash_received,
+            'total_expense': total_expense,
+            'total_cash_received': total_cash_received_on_account,
+            'net_physical_cash': net_physical_cash,
+            'net_total_settlement': net_total_settlement,
+        }
+    )
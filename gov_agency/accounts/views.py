@@ -20,6 +20,39 @@ from stock.models import Vehicle, Shop, SalesTransaction
 from .models import ShopFinancialTransaction
 from .forms import ReceiveCashForm, EditFinancialTransactionForm # Import the new forms
 from .utils import recalc_shop_balances,recalc_custom_account_balances
+from jobs.models import Job
+from gov_agency.pagination import keyset_paginate
+
+LEDGER_PAGE_SIZE = 50
+
+
+def ledger_page_context(request, ledger_entries, current_balance=None):
+    """
+    One keyset page of a ledger (newest first) plus its balance band. The stored
+    running balances give the closing balance (newest row on the page) and the
+    opening balance (oldest row minus its own amount), so no earlier rows are loaded.
+    `current_balance` is the owner's stored balance (Shop, CustomAccount); a ledger
+    without an owner row takes it from its newest entry.
+    """
+    page = keyset_paginate(
+        ledger_entries,
+        keys=('transaction_date', 'id'),
+        after=request.GET.get('after'),
+        before=request.GET.get('before'),
+        per_page=LEDGER_PAGE_SIZE,
+    )
+    entries = page.object_list
+    if current_balance is None:
+        current_balance = (
+            ledger_entries.order_by('-transaction_date', '-id').values_list('balance', flat=True).first()
+        ) or Decimal('0.00')
+    return {
+        'ledger_entries': page,
+        'page_opening_balance': entries[-1].balance - entries[-1].net_amount if entries else None,
+        'page_closing_balance': entries[0].balance if entries else None,
+        'current_balance': current_balance,
+        'is_partial': bool(request.GET.get('partial')),
+    }
 
 
 @login_required
@@ -41,10 +74,8 @@ def vehicle_ledger_summary_view(request, vehicle_pk):
     associated_shops_query  = Shop.objects.filter(user=request.user,
         shop_sales_transactions__assigned_vehicle=vehicle
     ).distinct().order_by('name')
+    # Shop.balance is the stored ledger total, so no per-shop aggregate is needed.
     associated_shops = associated_shops_query.annotate(
-        # Calculate the current balance for each shop
-    balance=Sum('financial_transactions__debit_amount') - Sum('financial_transactions__credit_amount')
-    ).annotate(
         # Create a temporary 'sort_priority' field
         sort_priority=Case(
             When(balance=Decimal('0.00'), then=Value(1)), # Zero balance gets priority 1
@@ -88,9 +119,6 @@ def store_ledger_summary_view(request):
     ).distinct().order_by('name')
 
     associated_shops = associated_shops_query.annotate(
-        # Use 'balance' here as well for consistency
-        balance=Sum('financial_transactions__debit_amount') - Sum('financial_transactions__credit_amount')
-    ).annotate(
         sort_priority=Case(
             When(balance=Decimal('0.00'), then=Value(1)),
             default=Value(0),
@@ -155,23 +183,26 @@ def shop_ledger_view(request, shop_pk):
             receive_cash_form = form_to_process # Pass back form with errors
 
 
-    # Fetch all financial transactions for this shop to display in the ledger table
-    ledger_entries = ShopFinancialTransaction.objects.filter(shop=shop).order_by('-transaction_date', '-pk')
+    # Only one page of the ledger is loaded; the balance is the one stored on the shop.
+    ledger_entries = ShopFinancialTransaction.objects.filter(shop=shop)
+    context = ledger_page_context(request, ledger_entries, current_balance=shop.balance)
+    context['shop'] = shop
+    if context['is_partial']:
+        return render(request, 'accounts/partials/shop_ledger_page.html', context)
 
-    context = {
-        'shop': shop,
-        'ledger_entries': ledger_entries,
+    context.update({
         'receive_cash_form': receive_cash_form,
         'form_had_errors_for_modal': form_had_errors,
         # For the Edit modal, we'll pass an empty instance of the Edit form
         'edit_transaction_form': EditFinancialTransactionForm(),
-    }
+    })
     return render(request, 'accounts/shop_ledger.html', context)
 
+@login_required
 def calc_balance_view(request, shop_id):
     shop = get_object_or_404(Shop, pk=shop_id)
-    final_balance = recalc_shop_balances(shop_id)
-    messages.success(request, f"Balances recalculated for {shop.name}. Final balance = {final_balance}")
+    job = Job.enqueue(request.user, 'recalc_shop_balances', {'shop_id': shop.pk})
+    messages.info(request, f"Balance recalculation for {shop.name} queued (job #{job.pk}). Refresh in a moment to see the new balances.")
     return redirect("accounts:shop_ledger", shop_pk=shop_id)
 
 
@@ -203,32 +234,22 @@ def manual_customer_ledger_view(request, customer_name):
     # Create an empty form instance for the "Receive Cash" modal for GET requests
     receive_cash_form = ReceiveCashForm()
 
-    # Fetch all financial transactions for this specific manual customer name
+    # Fetch one page of financial transactions for this specific manual customer name
     ledger_entries = ShopFinancialTransaction.objects.filter(
         customer_name_snapshot=customer_name,
         shop__isnull=True, # Ensure we only get manual entries
         user=request.user # Scope to the logged-in user's transactions
-    ).order_by('-transaction_date', '-pk')
-
-    # Calculate summary stats for this manual customer
-    totals = ledger_entries.aggregate(
-        total_debit=Sum('debit_amount'),
-        total_credit=Sum('credit_amount')
     )
-    total_debit = totals.get('total_debit') or Decimal('0.00')
-    total_credit = totals.get('total_credit') or Decimal('0.00')
-    current_balance = total_debit - total_credit
+    context = ledger_page_context(request, ledger_entries)
+    context['customer_name'] = customer_name
+    if context['is_partial']:
+        return render(request, 'accounts/partials/manual_customer_ledger_page.html', context)
 
-    context = {
-        'customer_name': customer_name,
-        'ledger_entries': ledger_entries,
+    context.update({
         'receive_cash_form': receive_cash_form,
         'edit_transaction_form': EditFinancialTransactionForm(), # For the edit modal
         'form_had_errors_for_modal': request.method == 'POST', # A simple way to signal error state
-        'total_debit': total_debit,
-        'total_credit': total_credit,
-        'current_balance': current_balance,
-    }
+    })
     return render(request, 'accounts/manual_customer_ledger.html', context)
 
 
@@ -249,7 +270,7 @@ def edit_financial_transaction_view(request, transaction_pk):
         form = EditFinancialTransactionForm(request.POST, instance=transaction_instance)
         if form.is_valid():
             form.save()
-            messages.success(request, "Financial transaction updated successfully.")
+            messages.success(request, "Financial transaction updated successfully. Later balances in this ledger were updated.")
         else:
             # Create a detailed error message to show the user
             error_string = ". ".join([f"{field}: {', '.join(errors)}" for field, errors in form.errors.items()])
@@ -274,7 +295,7 @@ def delete_financial_transaction_view(request, transaction_pk):
             return redirect(next_url)
         
         transaction_instance.delete()
-        messages.success(request, "Financial transaction deleted successfully.")
+        messages.success(request, "Financial transaction deleted successfully. Later balances in this ledger were updated.")
     
     return redirect(next_url)
 
@@ -348,21 +369,24 @@ def custom_account_ledger_view(request, account_pk):
             messages.error(request, "Error adding entry. Please check the form.")
     
     add_entry_form = CustomTransactionEntryForm()
-    ledger_entries = account.transactions.all().order_by('-transaction_date', '-pk')
-    
-    context = {
-        'account': account,
-        'ledger_entries': ledger_entries,
+    ledger_entries = account.transactions.all()
+    context = ledger_page_context(request, ledger_entries, current_balance=account.balance)
+    context['account'] = account
+    if context['is_partial']:
+        return render(request, 'accounts/partials/custom_account_ledger_page.html', context)
+
+    context.update({
         'add_form': add_entry_form,
         'form_had_errors': 'form' in locals() and form.errors,
         'edit_form': CustomTransactionEntryForm(), # For the edit modal structure
-    }
+    })
     return render(request, 'accounts/custom_account_ledger.html', context)
 
+@login_required
 def calc_account_balance_view(request, account_id):
-    account = get_object_or_404(CustomAccount, pk=account_id)
-    final_balance = recalc_custom_account_balances(account_id)
-    messages.success(request, f"Balances recalculated for {account.name}. Final balance = {final_balance}")
+    account = get_object_or_404(CustomAccount, pk=account_id, user=request.user)
+    job = Job.enqueue(request.user, 'recalc_custom_account_balances', {'account_id': account.pk})
+    messages.info(request, f"Balance recalculation for {account.name} queued (job #{job.pk}). Refresh in a moment to see the new balances.")
     return redirect("accounts:custom_account_ledger", account_pk=account_id)
 
 @login_required
@@ -380,7 +404,7 @@ def update_custom_transaction_view(request, pk):
         form = CustomTransactionEntryForm(request.POST, instance=transaction_instance)
         if form.is_valid():
             form.save() # This updates the transaction instance
-            messages.success(request, "Custom transaction updated successfully.")
+            messages.success(request, "Custom transaction updated successfully. Later balances in this ledger were updated.")
         else:
             # Create a detailed error message to show the user upon redirection
             error_string = ". ".join([f"{field}: {', '.join(errors)}" for field, errors in form.errors.items()])
@@ -405,7 +429,7 @@ def delete_custom_transaction_view(request, pk):
         entity_name = transaction_instance.account.name
         try:
             transaction_instance.delete()
-            messages.success(request, f"Transaction for '{entity_name}' deleted successfully.")
+            messages.success(request, f"Transaction for '{entity_name}' deleted successfully. Later balances in this ledger were updated.")
         except Exception as e:
             messages.error(request, f"An error occurred while deleting the transaction: {str(e)}")
         
@@ -504,74 +528,8 @@ def daily_summary_list_view(request):
 def generate_today_summary_view(request):
     if request.method == 'POST':
         today = timezone.localdate()
-        # --- GATHER DATA (This part is unchanged) ---
-        sales_today = SalesTransaction.objects.filter(user=request.user, transaction_time__date=today).filter(~Q(status='PENDING_DELIVERY'))
-        expenses_today = Expense.objects.filter(user=request.user, expense_date__date=today)
-        shop_financial_entries_today = ShopFinancialTransaction.objects.filter(user=request.user, transaction_date__date=today)
-        custom_account_entries_today = CustomAccountTransaction.objects.filter(user=request.user, transaction_date__date=today, store_in_daily_summery=True)
-
-        # --- CALCULATE REPORTING & CASH FLOW COMPONENTS ---
-        total_revenue = sales_today.aggregate(total=Sum('grand_total_revenue'))['total'] or Decimal('0.00')
-        total_profit = sum(sale.calculated_grand_profit for sale in sales_today) or Decimal('0.00')
-        total_expense = expenses_today.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-        
-        # --- REVISED PAYMENT CALCULATIONS TO HANDLE 'SPLIT' TYPE ---
-        # Total Cash from Sales:
-        # Sum the `amount_paid_cash` field across all of today's sales.
-        cash_from_sales = sales_today.aggregate(total=Sum('amount_paid_cash'))['total'] or Decimal('0.00')
-        
-        # Total Online Payments from Sales:
-        # Sum the `amount_paid_online` field across all of today's sales.
-        online_sales_today = sales_today.aggregate(total=Sum('amount_paid_online'))['total'] or Decimal('0.00')
-
-        # Total Credit Given in Sales:
-        # Sum the `amount_on_credit` field across all of today's sales.
-        # This is the amount that was added to various customer ledgers today from new sales.
-        credit_given_from_sales = sales_today.aggregate(total=Sum('amount_on_credit'))['total'] or Decimal('0.00')
-        
-        # --- REVISED DEBIT/CREDIT AND CASH RECEIVED CALCULATIONS ---
-        
-        # Cash Received from PAST Credit Sales (from shop/custom ledgers)
-        cash_received_from_shops_ledger = shop_financial_entries_today.filter(transaction_type='CASH_RECEIPT').aggregate(total=Sum('credit_amount'))['total'] or Decimal('0.00')
-        cash_received_from_custom_ledger = custom_account_entries_today.filter(credit_amount__gt=0).aggregate(total=Sum('credit_amount'))['total'] or Decimal('0.00')
-        total_cash_received_on_account = cash_received_from_shops_ledger + cash_received_from_custom_ledger
-        online_cash_received = shop_financial_entries_today.filter(transaction_type='ONLINE').aggregate(total=Sum('credit_amount'))['total'] or Decimal('0.00')
-        # Total Debit for Today (Credit given from new sales + Manual Debits)
-        # We already calculated the credit part from sales (`credit_given_from_sales`)
-        debit_from_custom_manual = custom_account_entries_today.filter(debit_amount__gt=0).aggregate(total=Sum('debit_amount'))['total'] or Decimal('0.00')
-        
-        # Total debit is the new credit given out today plus any manual debits.
-        total_debit_today = credit_given_from_sales + debit_from_custom_manual
-
-        # --- REVISED FINAL NET CALCULATIONS ---
-        
-        # Net Physical Cash = (Cash from today's sales) + (Cash received for old debts) - (Today's cash expenses)
-        net_physical_cash = ((cash_from_sales + total_cash_received_on_account) - total_expense) - debit_from_custom_manual
-
-        # Net Total Settlement = (All cash-like payments from today's sales) + (Cash received for old debts) - (Today's expenses)
-        net_total_settlement = ((cash_from_sales + online_sales_today + total_cash_received_on_account + online_cash_received) - total_expense) - debit_from_custom_manual
-        
-        # --- SAVE THE SUMMARY ---
-        summary, created = DailySummary.objects.update_or_create(
-            user=request.user,
-            summary_date=today,
-            defaults={
-                'total_revenue': total_revenue,
-                'total_profit': total_profit,
-                'total_debit_today': total_debit_today,
-                'online_sales_today': online_sales_today,
-                'online_received_cash': online_cash_received,
-                'total_expense': total_expense,
-                'total_cash_received': total_cash_received_on_account,
-                'net_physical_cash': net_physical_cash,
-                'net_total_settlement': net_total_settlement,
-            }
-        )
-        
-        if created:
-            messages.success(request, f"Successfully generated financial summary for {today.strftime('%B %d, %Y')}.")
-        else:
-            messages.info(request, f"Successfully updated financial summary for {today.strftime('%B %d, %Y')}.")
+        job = Job.enqueue(request.user, 'daily_summary', {'date': today.isoformat()})
+        messages.info(request, f"Financial summary for {today.strftime('%B %d, %Y')} is being generated (job #{job.pk}). Refresh in a moment.")
 
     return redirect('accounts:daily_summary_list')
 
@@ -608,54 +566,8 @@ def generate_specific_date_summary_view(request):
             messages.error(request, "No date was selected to generate the summary for.")
             return redirect('accounts:daily_summary_list')
             
-        # --- All the calculation logic is identical to generate_today_summary_view, ---
-        # --- but it uses 'target_date' instead of 'today'. ---
-        
-        sales_for_day = SalesTransaction.objects.filter(user=request.user, transaction_time__date=target_date).filter(~Q(status='PENDING_DELIVERY'))
-        # ... (and so on for expenses, shop_financial_entries, custom_account_entries) ...
-        expenses_for_day = Expense.objects.filter(user=request.user, expense_date__date=target_date)
-        shop_financial_entries_for_day = ShopFinancialTransaction.objects.filter(user=request.user, transaction_date__date=target_date)
-        custom_account_entries_for_day = CustomAccountTransaction.objects.filter(user=request.user, transaction_date__date=target_date, store_in_daily_summery=True)
-
-        total_revenue = sales_for_day.aggregate(total=Sum('grand_total_revenue'))['total'] or Decimal('0.00')
-        total_profit = sum(sale.calculated_grand_profit for sale in sales_for_day)
-        total_expense = expenses_for_day.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-        
-        cash_from_sales = sales_for_day.aggregate(total=Sum('amount_paid_cash'))['total'] or Decimal('0.00')
-        online_sales_today = sales_for_day.aggregate(total=Sum('amount_paid_online'))['total'] or Decimal('0.00')
-        credit_given_from_sales = sales_for_day.aggregate(total=Sum('amount_on_credit'))['total'] or Decimal('0.00')
-        
-        cash_received_from_shops_ledger = shop_financial_entries_for_day.filter(transaction_type='CASH_RECEIPT').aggregate(total=Sum('credit_amount'))['total'] or Decimal('0.00')
-        cash_received_from_custom_ledger = custom_account_entries_for_day.filter(credit_amount__gt=0).aggregate(total=Sum('credit_amount'))['total'] or Decimal('0.00')
-        total_cash_received_on_account = cash_received_from_shops_ledger + cash_received_from_custom_ledger
-        online_cash_received = shop_financial_entries_for_day.filter(transaction_type='ONLINE').aggregate(total=Sum('credit_amount'))['total'] or Decimal('0.00')
-        debit_from_custom_manual = custom_account_entries_for_day.filter(debit_amount__gt=0).aggregate(total=Sum('debit_amount'))['total'] or Decimal('0.00')
-        total_debit_today = credit_given_from_sales + debit_from_custom_manual
-
-        net_physical_cash = ((cash_from_sales + total_cash_received_on_account) - total_expense) - debit_from_custom_manual
-        net_total_settlement = ((cash_from_sales + online_sales_today + total_cash_received_on_account + online_cash_received) - total_expense) - debit_from_custom_manual
-        
-        # --- Save the summary for the TARGET_DATE ---
-        summary, created = DailySummary.objects.update_or_create(
-            user=request.user,
-            summary_date=target_date,
-            defaults={
-                'total_revenue': total_revenue,
-                'total_profit': total_profit,
-                'total_debit_today': total_debit_today,
-                'online_sales_today': online_sales_today,
-                'online_received_cash': online_cash_received,
-                'total_expense': total_expense,
-                'total_cash_received': total_cash_received_on_account,
-                'net_physical_cash': net_physical_cash,
-                'net_total_settlement': net_total_settlement,
-            }
-        )
-        
-        if created:
-            messages.success(request, f"Successfully generated financial summary for {target_date.strftime('%B %d, %Y')}.")
-        else:
-            messages.info(request, f"Successfully updated financial summary for {target_date.strftime('%B %d, %Y')}.")
+        job = Job.enqueue(request.user, 'daily_summary', {'date': target_date.isoformat()})
+        messages.info(request, f"Financial summary for {target_date.strftime('%B %d, %Y')} is being generated (job #{job.pk}). Refresh in a moment.")
     else:
         messages.error(request, "Invalid date provided.")
         
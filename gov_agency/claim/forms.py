@@ -16,6 +16,11 @@ class AddClaimItemForm(forms.Form):
         max_digits=10, decimal_places=2,
         widget=forms.NumberInput(attrs={'class': 'input input-bordered w-full', 'step': '0.01', 'placeholder': '0.00'})
     )
+    allocate_by_expiry = forms.BooleanField(
+        required=False, initial=True,
+        label="Give from earliest-expiring batches first (FEFO)",
+        widget=forms.CheckboxInput(attrs={'class': 'checkbox checkbox-primary'})
+    )
     def __init__(self, *args, **kwargs):
         user = kwargs.pop('user', None)
         # Add a flag for exchanged items to filter stock
@@ -24,10 +29,12 @@ class AddClaimItemForm(forms.Form):
         if user:
             queryset = ProductDetail.objects.filter(user=user).select_related('product_base')
             if for_exchange: # Only show items with stock if we are giving them away
-                queryset = queryset.filter(stock__gt=Decimal('0.00'))
+                queryset = queryset.filter(stock_items__gt=0)
             self.fields['product_detail'].queryset = queryset.order_by('product_base__name', 'expirey_date')
             self.fields['product_detail'].label_from_instance = lambda obj: f"{obj.product_base.name} {obj.quantity_in_packing} {obj.unit_of_measure} (Exp: {obj.expirey_date.strftime('%d-%b-%Y')})"
         self.fields['product_detail'].empty_label = "--- Select a Product ---"
+        if not for_exchange: # Claimed items go back into the exact batch they came from
+            del self.fields['allocate_by_expiry']
 
 class FinalizeClaimForm(forms.ModelForm):
     class Meta:
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.21 on 2026-10-18 14:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claim', '0002_alter_claim_options_remove_claim_product_detail_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='claimitem',
+            name='allocate_by_expiry',
+            field=models.BooleanField(default=False),
+        ),
+    ]
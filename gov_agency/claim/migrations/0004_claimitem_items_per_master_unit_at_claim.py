@@ -0,0 +1,35 @@
+# Generated by Django 4.2.21 on 2026-10-18 18:20
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def snapshot_packing(apps, schema_editor):
+    # Existing items take their batch's packing as it is now; later edits no longer reach them.
+    ClaimItem = apps.get_model('claim', 'ClaimItem')
+    ProductDetail = apps.get_model('stock', 'ProductDetail')
+    ClaimItem.objects.update(items_per_master_unit_at_claim=Subquery(
+        ProductDetail.objects.filter(pk=OuterRef('product_detail_id')).values('items_per_master_unit')[:1]
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claim', '0003_claimitem_allocate_by_expiry'),
+        ('stock', '0071_salesdailyrollup_incremental'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='claimitem',
+            name='items_per_master_unit_at_claim',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.RunPython(snapshot_packing, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='claimitem',
+            name='items_per_master_unit_at_claim',
+            field=models.PositiveIntegerField(),
+        ),
+    ]
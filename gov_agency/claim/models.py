@@ -50,12 +50,28 @@ class ClaimItem(models.Model):
     )
     # Snapshot the cost for financial tracking
     cost_price_at_claim = models.DecimalField(max_digits=10, decimal_places=2)
+    # FEFO lines keep the selected batch as a template until the claim is processed,
+    # then they are split across the earliest-expiring batches.
+    allocate_by_expiry = models.BooleanField(default=False)
+    # Snapshot the packing too, so the claim's value does not change if the batch is edited later
+    items_per_master_unit_at_claim = models.PositiveIntegerField()
+
+    def save(self, *args, **kwargs):
+        if self.items_per_master_unit_at_claim is None and self.product_detail_id:
+            self.items_per_master_unit_at_claim = self.product_detail.items_per_master_unit
+        super().save(*args, **kwargs)
+
+    @property
+    def individual_items(self):
+        """quantity_decimal ('MasterUnits.Items') as an item count, with the packing at claim time."""
+        full_units = int(self.quantity_decimal)
+        loose_items = int(round((self.quantity_decimal % 1) * 100))
+        return full_units * self.items_per_master_unit_at_claim + loose_items
 
     @property
     def total_cost(self):
         """Calculates the total cost of this line item."""
-        individual_items = self.product_detail._get_items_from_decimal(self.quantity_decimal)
-        return (Decimal(individual_items) * self.cost_price_at_claim).quantize(Decimal('0.01'))
+        return (Decimal(self.individual_items) * self.cost_price_at_claim).quantize(Decimal('0.01'))
 
     def __str__(self):
         return f"{self.get_item_type_display()}: {self.quantity_decimal} of {self.product_detail.product_base.name}"
\ No newline at end of file
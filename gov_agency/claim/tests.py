@@ -1,3 +1,86 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from stock.models import AddProduct, ProductDetail
+from stock.utils import claim_loss_expression
+from .models import Claim, ClaimItem
+
+
+class ProcessPendingClaimsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('clerk', password='x')
+        product = AddProduct.objects.create(user=self.user, name='Mango Juice')
+        self.early = self.make_batch(product, stock_items=6, expires_in=5)
+        self.late = self.make_batch(product, stock_items=10, expires_in=60)
+        self.client.force_login(self.user)
+
+    def make_batch(self, product, stock_items, expires_in):
+        return ProductDetail.objects.create(
+            product_base=product, user=self.user, packing_type='PET', quantity_in_packing=Decimal('1.00'),
+            unit_of_measure='L', items_per_master_unit=6, price_per_item=Decimal('2.00'),
+            stock_items=stock_items, expirey_date=timezone.localdate() + timedelta(days=expires_in),
+        )
+
+    def stock_of(self, batch):
+        return ProductDetail.objects.values_list('stock_items', flat=True).get(pk=batch.pk)
+
+    def test_expiry_lines_are_allocated_after_explicit_exchanges(self):
+        claim = Claim.objects.create(user=self.user, reason='Expired', status='AWAITING_PROCESSING')
+        ClaimItem.objects.create(
+            claim=claim, product_detail=self.early, item_type='EXCHANGED',
+            quantity_decimal=Decimal('0.04'), cost_price_at_claim=Decimal('2.00'),
+        )
+        ClaimItem.objects.create(
+            claim=claim, product_detail=self.early, item_type='EXCHANGED',
+            quantity_decimal=Decimal('0.04'), cost_price_at_claim=Decimal('2.00'), allocate_by_expiry=True,
+        )
+
+        self.client.post(reverse('claim:process_pending_claims'))
+
+        claim.refresh_from_db()
+        self.assertEqual(claim.status, 'COMPLETED')
+        # 4 explicit items leave 2 early ones for the FEFO line; the other 2 come from the later batch.
+        self.assertEqual((self.stock_of(self.early), self.stock_of(self.late)), (0, 8))
+        self.assertEqual(
+            sorted(claim.items.values_list('product_detail_id', 'quantity_decimal', 'allocate_by_expiry')),
+            sorted([(self.early.pk, Decimal('0.04'), False), (self.early.pk, Decimal('0.02'), False), (self.late.pk, Decimal('0.02'), False)]),
+        )
+
+    def test_short_claim_changes_nothing(self):
+        claim = Claim.objects.create(user=self.user, reason='Damaged', status='AWAITING_PROCESSING')
+        ClaimItem.objects.create(
+            claim=claim, product_detail=self.early, item_type='EXCHANGED',
+            quantity_decimal=Decimal('3.00'), cost_price_at_claim=Decimal('2.00'), allocate_by_expiry=True,
+        )
+
+        self.client.post(reverse('claim:process_pending_claims'))
+
+        claim.refresh_from_db()
+        self.assertEqual(claim.status, 'AWAITING_PROCESSING')
+        self.assertEqual((self.stock_of(self.early), self.stock_of(self.late)), (6, 10))
+
+
+class ClaimItemValueTests(TestCase):
+    def test_value_uses_the_packing_at_claim_time(self):
+        user = User.objects.create_user('clerk', password='x')
+        batch = ProductDetail.objects.create(
+            product_base=AddProduct.objects.create(user=user, name='Mango Juice'), user=user, packing_type='PET',
+            quantity_in_packing=Decimal('1.00'), unit_of_measure='L', items_per_master_unit=6,
+            price_per_item=Decimal('2.00'), stock_items=20, expirey_date=timezone.localdate() + timedelta(days=30),
+        )
+        claim = Claim.objects.create(user=user, reason='Damaged')
+        item = ClaimItem.objects.create(
+            claim=claim, product_detail=batch, item_type='EXCHANGED',
+            quantity_decimal=Decimal('1.02'), cost_price_at_claim=Decimal('2.00'),
+        )
+        ProductDetail.objects.filter(pk=batch.pk).update(items_per_master_unit=12)
 
-# Create your tests here.
+        item = ClaimItem.objects.annotate(loss=claim_loss_expression()).get(pk=item.pk)
+        self.assertEqual(item.items_per_master_unit_at_claim, 6)
+        self.assertEqual(item.total_cost, Decimal('16.00'))
+        self.assertEqual(item.loss, Decimal('16.00'))
@@ -4,11 +4,13 @@ from django.contrib import messages
 from django.db import transaction
 from django.http import JsonResponse
 from decimal import Decimal
+from collections import defaultdict
 from django.urls import reverse
 
 
 # Import models from other apps using their app name
-from stock.models import Vehicle, ProductDetail
+from stock.models import Vehicle, ProductDetail, StockMovement
+from stock.utils import allocate_fefo_many, fefo_available_items, InsufficientStock, batched_movements
 from .models import Claim,ClaimItem
 from .forms import FinalizeClaimForm,AddClaimItemForm
 from   gov_agency.decorators import admin_mode_required
@@ -111,12 +113,16 @@ def create_claim_view(request):
                 product_detail = form.cleaned_data['product_detail']
                 quantity = form.cleaned_data['quantity']
                 
+                allocate_by_expiry = form.cleaned_data.get('allocate_by_expiry', False)
+
                 current_items.append({
                     'product_detail_id': product_detail.id,
-                    'product_display': str(product_detail),
+                    'product_display': f"{product_detail} (Earliest expiry first)" if allocate_by_expiry else str(product_detail),
                     'quantity': str(quantity),
                     'cost_price': str(product_detail.price_per_item),
                     'item_type': 'CLAIMED' if action == 'add_claimed' else 'EXCHANGED',
+                    # FEFO exchange lines are split across batches when the claim is processed.
+                    'allocation': 'FEFO' if allocate_by_expiry else None,
                 })
                 request.session[session_key] = current_items
                 messages.success(request, "Item added to claim.")
@@ -139,24 +145,44 @@ def create_claim_view(request):
                 return redirect('claim:create_claim')
 
             if finalize_form.is_valid():
-                with transaction.atomic():
-                    claim_header = finalize_form.save(commit=False)
-                    claim_header.user = request.user
-                    claim_header.status = 'AWAITING_PROCESSING'
-                    claim_header.save()
-                    
-                    for item_data in current_items:
-                        ClaimItem.objects.create(
-                            claim=claim_header,
-                            product_detail_id=item_data['product_detail_id'],
-                            item_type=item_data['item_type'],
-                            quantity_decimal=Decimal(item_data['quantity']),
-                            cost_price_at_claim=Decimal(item_data['cost_price'])
-                        )
-                    
-                    del request.session[session_key]
-                    messages.success(request, f"Claim #{claim_header.pk} created and is awaiting stock processing.")
-                    return redirect('claim:claims_hub')
+                try:
+                    with transaction.atomic():
+                        claim_header = finalize_form.save(commit=False)
+                        claim_header.user = request.user
+                        claim_header.status = 'AWAITING_PROCESSING'
+                        claim_header.save()
+
+                        for item_data in current_items:
+                            if item_data.get('allocation') == 'FEFO':
+                                # Stock is only taken when the claim is processed, so the batches are
+                                # chosen then. Here we just check that enough is on hand right now.
+                                template_batch = ProductDetail.objects.select_related('product_base').get(pk=item_data['product_detail_id'])
+                                items_needed = template_batch._get_items_from_decimal(Decimal(item_data['quantity']))
+                                if fefo_available_items(template_batch) < items_needed:
+                                    raise InsufficientStock(f"Not enough stock across all batches of {template_batch}.")
+                                ClaimItem.objects.create(
+                                    claim=claim_header,
+                                    product_detail=template_batch,
+                                    item_type=item_data['item_type'],
+                                    quantity_decimal=Decimal(item_data['quantity']),
+                                    cost_price_at_claim=template_batch.price_per_item,
+                                    allocate_by_expiry=True,
+                                )
+                                continue
+                            ClaimItem.objects.create(
+                                claim=claim_header,
+                                product_detail_id=item_data['product_detail_id'],
+                                item_type=item_data['item_type'],
+                                quantity_decimal=Decimal(item_data['quantity']),
+                                cost_price_at_claim=Decimal(item_data['cost_price'])
+                            )
+
+                        del request.session[session_key]
+                        messages.success(request, f"Claim #{claim_header.pk} created and is awaiting stock processing.")
+                        return redirect('claim:claims_hub')
+                except (InsufficientStock, ProductDetail.DoesNotExist) as e:
+                    messages.error(request, f"Could not create claim: {e}")
+                    return redirect('claim:create_claim')
 
     context = {
         'claimed_form': claimed_form,
@@ -174,15 +200,45 @@ def process_pending_claims_view(request):
         claims_to_process = Claim.objects.filter(user=request.user, status='AWAITING_PROCESSING')
         processed_count = 0
         try:
-            with transaction.atomic():
+            with transaction.atomic(), batched_movements():
                 for claim in claims_to_process:
-                    for item in claim.items.all():
+                    items = list(claim.items.select_related('product_detail__product_base'))
+                    fefo_items = [item for item in items if item.allocate_by_expiry]
+                    if fefo_items:
+                        # Allocated now, against the stock left after the claims processed before this
+                        # one and after this claim's own explicit-batch exchanges, with the candidate
+                        # batches locked until the block commits.
+                        taken = defaultdict(int)
+                        for item in items:
+                            if item.item_type == 'EXCHANGED' and not item.allocate_by_expiry:
+                                taken[item.product_detail_id] += item.product_detail._get_items_from_decimal(item.quantity_decimal)
+                        allocations = allocate_fefo_many([
+                            (item.product_detail, item.product_detail._get_items_from_decimal(item.quantity_decimal))
+                            for item in fefo_items
+                        ], taken=taken, lock=True)
+                        for item, allocation in zip(fefo_items, allocations):
+                            items.remove(item)
+                            item.delete()
+                            items.extend(ClaimItem.objects.bulk_create([
+                                ClaimItem(
+                                    claim=claim,
+                                    product_detail=batch,
+                                    item_type=item.item_type,
+                                    quantity_decimal=batch._get_decimal_from_items(batch_items),
+                                    cost_price_at_claim=batch.price_per_item,
+                                    items_per_master_unit_at_claim=batch.items_per_master_unit,
+                                )
+                                for batch, batch_items in allocation
+                            ]))
+
+                    for item in items:
                         product_detail = item.product_detail
                         if item.item_type == 'CLAIMED':
-                            product_detail.increase_stock(item.quantity_decimal)
+                            product_detail.increase_stock(item.quantity_decimal, StockMovement.CLAIM_RECEIVED, claim=claim)
                         elif item.item_type == 'EXCHANGED':
-                            product_detail.decrease_stock(item.quantity_decimal)
-                    
+                            if not product_detail.decrease_stock(item.quantity_decimal, StockMovement.CLAIM_EXCHANGED, claim=claim):
+                                raise InsufficientStock(f"Not enough stock of '{product_detail}' for claim #{claim.pk}.")
+
                     claim.status = 'COMPLETED'
                     claim.save(update_fields=['status'])
                     processed_count += 1
@@ -246,18 +302,19 @@ def reverse_completed_claim_view(request, claim_pk):
     if request.method == 'POST':
         try:
             # --- Reverse Stock Movements ---
-            for item in claim_to_reverse.items.all():
-                product_detail = item.product_detail
-                
-                if item.item_type == 'CLAIMED':
-                    # This item was returned (stock IN), so now we must DECREASE stock to reverse it.
-                    if not product_detail.decrease_stock(item.quantity_decimal):
-                        # This should be rare, but is a critical safety check.
-                        raise Exception(f"Reversal failed: Not enough stock for '{product_detail}' to reverse the claim.")
-                
-                elif item.item_type == 'EXCHANGED':
-                    # This item was given out (stock OUT), so now we must INCREASE stock to reverse it.
-                    product_detail.increase_stock(item.quantity_decimal)
+            with batched_movements():
+                for item in claim_to_reverse.items.all():
+                    product_detail = item.product_detail
+
+                    if item.item_type == 'CLAIMED':
+                        # This item was returned (stock IN), so now we must DECREASE stock to reverse it.
+                        if not product_detail.decrease_stock(item.quantity_decimal, StockMovement.CLAIM_REVERSAL, claim=claim_to_reverse):
+                            # This should be rare, but is a critical safety check.
+                            raise Exception(f"Reversal failed: Not enough stock for '{product_detail}' to reverse the claim.")
+
+                    elif item.item_type == 'EXCHANGED':
+                        # This item was given out (stock OUT), so now we must INCREASE stock to reverse it.
+                        product_detail.increase_stock(item.quantity_decimal, StockMovement.CLAIM_REVERSAL, claim=claim_to_reverse)
 
             claim_pk_str = str(claim_to_reverse.pk)
             # After all stock is adjusted, delete the claim record and its items.
@@ -321,15 +378,16 @@ def edit_claim_view(request, claim_pk):
 
     # --- 2. Reverse the stock movements of the old claim ---
     try:
-        for item in claim_to_edit.items.all():
-            product_detail = item.product_detail
-            if item.item_type == 'CLAIMED':
-                # Reversal: DECREASE stock
-                if not product_detail.decrease_stock(item.quantity_decimal):
-                    raise Exception(f"Reversal failed: Not enough stock for '{product_detail}' to reverse the claim.")
-            elif item.item_type == 'EXCHANGED':
-                # Reversal: INCREASE stock
-                product_detail.increase_stock(item.quantity_decimal)
+        with batched_movements():
+            for item in claim_to_edit.items.all():
+                product_detail = item.product_detail
+                if item.item_type == 'CLAIMED':
+                    # Reversal: DECREASE stock
+                    if not product_detail.decrease_stock(item.quantity_decimal, StockMovement.CLAIM_REVERSAL, claim=claim_to_edit):
+                        raise Exception(f"Reversal failed: Not enough stock for '{product_detail}' to reverse the claim.")
+                elif item.item_type == 'EXCHANGED':
+                    # Reversal: INCREASE stock
+                    product_detail.increase_stock(item.quantity_decimal, StockMovement.CLAIM_REVERSAL, claim=claim_to_edit)
     except Exception as e:
         # If reversal fails, clear the session data and show an error
         if 'claim_to_restore_header' in request.session:
@@ -1,7 +1,8 @@
 
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
-from django.db.models import Sum
+from django.db.models import Sum, F, Value, FloatField, DecimalField
+from django.db.models.functions import Cast
 from decimal import Decimal
 import json 
 from django.views.decorators.http import require_POST
@@ -16,6 +17,7 @@ from datetime import date  # import date directly
 from .models import Note,MonthlySalesTarget
 from .forms import NoteForm,SalesTargetForm
 from stock.models import SalesTransaction,Shop,ProductDetail,SalesTransactionItem
+from stock.expressions import PackedToItems
 from accounts.models import CustomAccount
 from claim.models import Claim
 
@@ -45,8 +47,8 @@ def dashboard_view(request):
     incomplete_notes_count = Note.objects.filter(user=request.user, is_completed=False).count()
 
     stock_summary = ProductDetail.objects.filter(
-        user=user, stock__gt=Decimal('0.00')
-    ).values('quantity_in_packing', 'unit_of_measure').annotate(total_stock=Sum('stock')).order_by('unit_of_measure', '-total_stock')
+        user=user, stock_items__gt=0
+    ).values('quantity_in_packing', 'unit_of_measure').annotate(total_stock=Sum('stock_items')).order_by('unit_of_measure', '-total_stock')
 
     stock_chart_labels = []
     stock_chart_data = []
@@ -56,10 +58,9 @@ def dashboard_view(request):
         stock_chart_labels.append(label)
         stock_chart_data.append(float(item['total_stock']))
     
-    all_shops = Shop.objects.filter(user=user)
-    all_custom_accounts = CustomAccount.objects.filter(user=user)
-    total_shop_balance = sum(shop.current_balance for shop in all_shops if shop.current_balance > 0)
-    total_custom_balance = sum(account.current_balance for account in all_custom_accounts if account.current_balance > 0)
+    # Stored balances: one indexed SUM each instead of an aggregate per shop/account.
+    total_shop_balance = Shop.objects.filter(user=user, balance__gt=0).aggregate(total=Sum('balance'))['total'] or Decimal('0.00')
+    total_custom_balance = CustomAccount.objects.filter(user=user, balance__gt=0).aggregate(total=Sum('balance'))['total'] or Decimal('0.00')
     total_receivables = total_shop_balance + total_custom_balance
     
     pending_claims_count = Claim.objects.filter(user=user, status='AWAITING_PROCESSING').count()
@@ -68,17 +69,23 @@ def dashboard_view(request):
     current_target_obj = MonthlySalesTarget.objects.filter(user=user, month=start_of_current_month).first()
     sales_target = current_target_obj.target_quantity if current_target_obj else Decimal('1000.00')
 
+    # The target is in master units. Packed quantities (1.06 = 1 unit + 6 items) can't be
+    # summed directly, so each line is converted to items and divided by its own pack size.
+    net_items = (
+        PackedToItems('quantity_sold_decimal', 'items_per_master_unit_at_sale')
+        - PackedToItems('returned_quantity_decimal', 'items_per_master_unit_at_sale')
+    )
     net_sales_aggregation = SalesTransactionItem.objects.filter(
         transaction__user=user, 
         transaction__transaction_time__gte=start_of_current_month
     ).aggregate(
-        total_dispatched=Sum('quantity_sold_decimal'),
-        total_returned=Sum('returned_quantity_decimal')
+        master_units_sold=Cast(
+            Sum(net_items * Value(1.0) / F('items_per_master_unit_at_sale'), output_field=FloatField()),
+            output_field=DecimalField(max_digits=14, decimal_places=2),
+        )
     )
-    
-    total_dispatched = net_sales_aggregation['total_dispatched'] or Decimal('0.00')
-    total_returned = net_sales_aggregation['total_returned'] or Decimal('0.00')
-    quantity_sold_this_month = total_dispatched - total_returned
+
+    quantity_sold_this_month = (net_sales_aggregation['master_units_sold'] or Decimal('0.00')).quantize(Decimal('0.01'))
 
     remaining_to_target = max(Decimal('0.00'), sales_target - quantity_sold_this_month)
     sales_target_data = [float(quantity_sold_this_month), float(remaining_to_target)]
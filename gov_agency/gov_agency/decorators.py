@@ -1,5 +1,15 @@
+import functools
+import random
+import time
+
 from django.shortcuts import redirect
 from django.contrib import messages
+from django.db import transaction, OperationalError
+
+# Transactions that lose a lock or serialization race are retried this many times,
+# waiting CONFLICT_RETRY_DELAY * 2^attempt seconds (plus jitter) in between.
+CONFLICT_RETRY_ATTEMPTS = 5
+CONFLICT_RETRY_DELAY = 0.05
 
 def admin_mode_required(view_func):
     def _wrapped_view(request, *args, **kwargs):
@@ -9,4 +19,28 @@ def admin_mode_required(view_func):
             # Redirect to a safe, non-protected page like the main dashboard
             return redirect('dashboard:main_dashboard') 
         return view_func(request, *args, **kwargs)
-    return _wrapped_view
\ No newline at end of file
+    return _wrapped_view
+
+
+def retry_on_conflict(func):
+    """
+    Runs `func` in its own transaction.atomic() and, when that is the outermost
+    transaction, retries the whole of it on lock, deadlock and serialization failures
+    (OperationalError) with bounded exponential backoff. A transaction can only be
+    retried from where it starts, so wrap the function that owns the write transaction
+    (a service call, a model's balanced save, a job task), never a whole view: a retry
+    must not repeat session changes or messages. Called inside another atomic block
+    it runs once and the error goes to that block's owner.
+    """
+    @functools.wraps(func)
+    def _wrapped(*args, **kwargs):
+        attempts = 1 if transaction.get_connection().in_atomic_block else CONFLICT_RETRY_ATTEMPTS
+        for attempt in range(1, attempts + 1):
+            try:
+                with transaction.atomic():
+                    return func(*args, **kwargs)
+            except OperationalError:
+                if attempt == attempts:
+                    raise
+                time.sleep(CONFLICT_RETRY_DELAY * 2 ** (attempt - 1) * (1 + random.random()))
+    return _wrapped
@@ -0,0 +1,98 @@
+import base64
+import json
+
+from django.db.models import Q
+
+
+# Keyset (cursor) pagination: instead of OFFSET, each page asks for the rows
+# that sort after the last row of the previous page, so every page costs the
+# same no matter how deep it is. Used by the stock history and ledger pages.
+
+
+def encode_cursor(values):
+    raw = json.dumps([str(value) for value in values]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor, model, keys):
+    """Turns a cursor back into typed key values; returns None for a malformed cursor."""
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(raw) != len(keys):
+            return None
+        return [model._meta.get_field(key).to_python(value) for key, value in zip(keys, raw)]
+    except Exception:
+        return None
+
+
+def _row_value(row, key):
+    return row[key] if isinstance(row, dict) else getattr(row, key)
+
+
+def _beyond(keys, values, descending):
+    """Q for rows strictly after `values` in (keys) order, e.g. (t < t0) OR (t = t0 AND id < id0)."""
+    lookup = 'lt' if descending else 'gt'
+    condition = Q()
+    for index, key in enumerate(keys):
+        step = Q(**{f'{key}__{lookup}': values[index]})
+        for previous_key, previous_value in zip(keys[:index], values[:index]):
+            step &= Q(**{previous_key: previous_value})
+        condition |= step
+    return condition
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def keyset_paginate(queryset, keys, after=None, before=None, per_page=50, descending=True):
+    """
+    Returns one KeysetPage of `queryset` ordered by `keys` (the last key must be unique,
+    normally 'id'). Pass the previous page's next_cursor as `after`, or its
+    previous_cursor as `before` to step back.
+    """
+    keys = list(keys)
+    model = queryset.model
+    forward_order = [f'-{key}' if descending else key for key in keys]
+    backward_order = [key if descending else f'-{key}' for key in keys]
+
+    before_values = decode_cursor(before, model, keys) if before else None
+    if before_values is not None:
+        # Walk backwards from the cursor, then put the rows back in display order.
+        rows = list(queryset.filter(_beyond(keys, before_values, not descending)).order_by(*backward_order)[:per_page + 1])
+        has_more_before = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        return KeysetPage(
+            rows,
+            next_cursor=encode_cursor([_row_value(rows[-1], key) for key in keys]) if rows else None,
+            previous_cursor=encode_cursor([_row_value(rows[0], key) for key in keys]) if rows and has_more_before else None,
+        )
+
+    after_values = decode_cursor(after, model, keys) if after else None
+    if after_values is not None:
+        queryset = queryset.filter(_beyond(keys, after_values, descending))
+    rows = list(queryset.order_by(*forward_order)[:per_page + 1])
+    has_more_after = len(rows) > per_page
+    rows = rows[:per_page]
+    return KeysetPage(
+        rows,
+        next_cursor=encode_cursor([_row_value(rows[-1], key) for key in keys]) if rows and has_more_after else None,
+        previous_cursor=encode_cursor([_row_value(rows[0], key) for key in keys]) if rows and after_values is not None else None,
+    )
@@ -54,6 +54,7 @@ INSTALLED_APPS = [
     'claim.apps.ClaimConfig',
     'expense.apps.ExpenseConfig', 
     'dashboard.apps.DashboardConfig',
+    'jobs.apps.JobsConfig',
     'gov_agency',
 ]
 
@@ -100,6 +101,13 @@ DATABASES = {
     'default': env.db(),
 }
 
+# Shared by the web and worker processes, so invalidating an entry in one reaches the
+# other. Any django-environ cache URL works (e.g. redis://...); the default is a table
+# in the main database, created with `python manage.py createcachetable`.
+CACHES = {
+    'default': env.cache('CACHE_URL', default='dbcache://django_cache'),
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -147,6 +155,11 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Result files written by background jobs (see jobs/tasks.py).
+JOB_RESULTS_DIR = env('JOB_RESULTS_DIR', default=str(BASE_DIR / 'job_results'))
+# Finished jobs and their result files are deleted by the workers after this many days.
+JOB_RESULTS_KEEP_DAYS = env.int('JOB_RESULTS_KEEP_DAYS', default=7)
+
 LOGIN_REDIRECT_URL = 'dashboard:main_dashboard'
 LOGOUT_REDIRECT_URL = 'login'
 LOGIN_URL = 'login/'
@@ -33,6 +33,7 @@ urlpatterns = [
     path('accounts/', include('accounts.urls', namespace='accounts')),
     path('claims/', include('claim.urls')),
     path('expenses/', include('expense.urls', namespace='expense')),
+    path('jobs/', include('jobs.urls', namespace='jobs')),
     path('', include('django.contrib.auth.urls')),
 
 ]
@@ -0,0 +1,61 @@
+import multiprocessing
+import signal
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from jobs.worker import work
+
+
+def _child(**kwargs):
+    # Ctrl+C / SIGTERM reach the whole process group; only the parent reacts, by setting `stop`.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    work(**kwargs)
+
+
+class Command(BaseCommand):
+    help = ("Runs background job workers (exports, balance recalculations, settlements, daily summaries). "
+            "Jobs finished more than JOB_RESULTS_KEEP_DAYS ago are deleted with their result files.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help="Number of worker processes to run.")
+        parser.add_argument('--poll-interval', type=float, default=2.0, help="Seconds to wait when the queue is empty.")
+        parser.add_argument('--stale-after', type=int, default=900,
+                            help="Requeue RUNNING jobs whose worker has not reported for this many seconds. "
+                                 "Checked on every poll.")
+        parser.add_argument('--once', action='store_true', help="Process the queued jobs and exit.")
+
+    def handle(self, *args, **options):
+        processes = max(1, options['processes'])
+        worker_options = {
+            'poll_interval': options['poll_interval'],
+            'stale_after': options['stale_after'],
+            'once': options['once'],
+        }
+        if processes == 1:
+            work(**worker_options)
+            return
+
+        # Children must open their own database connections.
+        connections.close_all()
+        stop = multiprocessing.Event()
+        workers = [
+            multiprocessing.Process(
+                target=_child,
+                kwargs={'index': index, 'stop': stop, **worker_options},
+            )
+            for index in range(processes)
+        ]
+        for process in workers:
+            process.start()
+
+        def shutdown(signum, frame):
+            # Workers finish the job they are running, then exit.
+            stop.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        for process in workers:
+            process.join()
+        self.stdout.write(self.style.SUCCESS("All workers stopped."))
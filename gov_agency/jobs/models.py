@@ -0,0 +1,96 @@
+from pathlib import Path
+
+from django.conf import settings
+from django.db import models, transaction
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+# Create your models here.
+
+
+def remove_result_files(result_files):
+    """Deletes result files (paths relative to settings.JOB_RESULTS_DIR); missing ones are skipped."""
+    results_dir = Path(settings.JOB_RESULTS_DIR)
+    for result_file in result_files:
+        (results_dir / result_file).unlink(missing_ok=True)
+
+
+class Job(models.Model):
+    """
+    A unit of background work. Views enqueue a Job instead of running slow work inside
+    the request; `manage.py run_worker` claims QUEUED jobs and runs the matching task
+    from jobs/tasks.py. Result files (exports) are written under settings.JOB_RESULTS_DIR
+    and removed with their job, by delete() or the workers' retention sweep.
+    """
+    QUEUED = 'QUEUED'
+    RUNNING = 'RUNNING'
+    SUCCEEDED = 'SUCCEEDED'
+    FAILED = 'FAILED'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Completed'),
+        (FAILED, 'Failed'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='jobs')
+    kind = models.CharField(max_length=50)
+    params = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    progress = models.PositiveSmallIntegerField(default=0, help_text="0-100")
+    message = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+    # Path relative to settings.JOB_RESULTS_DIR and the name offered on download.
+    result_file = models.CharField(max_length=255, blank=True)
+    result_filename = models.CharField(max_length=255, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    worker = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            # Workers poll for the oldest QUEUED job.
+            models.Index(fields=['status', 'created_at'], name='job_status_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"Job #{self.pk} {self.kind} ({self.get_status_display()})"
+
+    @classmethod
+    def enqueue(cls, user, kind, params=None):
+        return cls.objects.create(user=user, kind=kind, params=params or {})
+
+    def delete(self, *args, **kwargs):
+        result_file = self.result_file
+        deleted = super().delete(*args, **kwargs)
+        if result_file:
+            # The row could still come back if the surrounding transaction rolls back.
+            transaction.on_commit(lambda: remove_result_files([result_file]))
+        return deleted
+
+    @property
+    def is_finished(self):
+        return self.status in (self.SUCCEEDED, self.FAILED)
+
+    def claim(self, worker_name):
+        """
+        Moves the job from QUEUED to RUNNING with one conditional UPDATE, so when several
+        workers race for the same row exactly one of them gets it. Returns True for the winner.
+        """
+        now = timezone.now()
+        claimed = Job.objects.filter(pk=self.pk, status=self.QUEUED).update(
+            status=self.RUNNING, worker=worker_name, started_at=now, heartbeat_at=now,
+            attempts=models.F('attempts') + 1,
+        )
+        return claimed == 1
+
+    def set_progress(self, progress, message=''):
+        """Reports progress (0-100) to pollers; also serves as the worker heartbeat."""
+        self.progress = max(0, min(100, int(progress)))
+        self.message = message[:255]
+        self.heartbeat_at = timezone.now()
+        Job.objects.filter(pk=self.pk).update(progress=self.progress, message=self.message, heartbeat_at=self.heartbeat_at)
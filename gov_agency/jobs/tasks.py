@@ -0,0 +1,91 @@
+"""
+Background tasks run by `manage.py run_worker`. Each task takes the Job plus its
+params as keyword arguments, may report progress with job.set_progress(), and
+returns the message shown to the user when it succeeds. Tasks that write ledgers
+run under retry_on_conflict, so a lost lock race retries the whole task.
+"""
+from datetime import date
+from pathlib import Path
+
+from django.conf import settings
+
+from gov_agency.decorators import retry_on_conflict
+
+TASKS = {}
+
+
+def task(kind):
+    def register(func):
+        TASKS[kind] = func
+        return func
+    return register
+
+
+def result_path(job, filename):
+    """Where a job's result file lives on disk: JOB_RESULTS_DIR/<job pk>_<filename>."""
+    relative = f"{job.pk}_{Path(filename).name}"
+    results_dir = Path(settings.JOB_RESULTS_DIR)
+    results_dir.mkdir(parents=True, exist_ok=True)
+    return relative, results_dir / relative
+
+
+@task('sales_export')
+def sales_export(job, ids=None, start_date=None, end_date=None, filename='sales_report.xlsx'):
+    from stock.utils import filter_sales_for_export, write_sales_workbook
+
+    transactions_list = filter_sales_for_export(job.user, ids, start_date, end_date)
+    job.set_progress(10, "Writing workbook...")
+    relative, path = result_path(job, filename)
+    write_sales_workbook(transactions_list, path)
+    job.result_file = relative
+    job.result_filename = filename
+    return f"{filename} is ready to download."
+
+
+@task('recalc_shop_balances')
+@retry_on_conflict
+def recalc_shop_balances_task(job, shop_id):
+    from stock.models import Shop
+    from accounts.utils import recalc_shop_balances
+
+    shop = Shop.objects.get(pk=shop_id, user=job.user)
+    final_balance = recalc_shop_balances(shop.pk)
+    return f"Balances recalculated for {shop.name}. Final balance = {final_balance}"
+
+
+@task('recalc_custom_account_balances')
+@retry_on_conflict
+def recalc_custom_account_balances_task(job, account_id):
+    from accounts.models import CustomAccount
+    from accounts.utils import recalc_custom_account_balances
+
+    account = CustomAccount.objects.get(pk=account_id, user=job.user)
+    final_balance = recalc_custom_account_balances(account.pk)
+    return f"Balances recalculated for {account.name}. Final balance = {final_balance}"
+
+
+@task('settle_vehicle_deliveries')
+@retry_on_conflict
+def settle_vehicle_deliveries(job, vehicle_id):
+    from stock.models import Vehicle
+    from stock.utils import settle_pending_for_vehicle
+
+    vehicle = Vehicle.objects.get(pk=vehicle_id)
+    processed = settle_pending_for_vehicle(job.user, vehicle)
+    if not processed:
+        return f"No pending deliveries found for vehicle {vehicle.vehicle_number}."
+    return f"All {processed} pending deliveries for vehicle {vehicle.vehicle_number} processed successfully."
+
+
+@task('daily_summary')
+def daily_summary(job, date=None):
+    from accounts.utils import build_daily_summary
+
+    target_date = _parse_date(date)
+    summary, created = build_daily_summary(job.user, target_date)
+    verb = "generated" if created else "updated"
+    return f"Successfully {verb} financial summary for {target_date.strftime('%B %d, %Y')}."
+
+
+def _parse_date(value):
+    return date.fromisoformat(value)
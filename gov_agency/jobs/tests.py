@@ -0,0 +1,110 @@
+import os
+import tempfile
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .models import Job
+from .tasks import TASKS
+from .worker import MAX_ATTEMPTS, purge_expired_results, requeue_stale_jobs, run_job, work
+
+
+def succeeding_task(job, value):
+    job.result_file = f"{job.pk}_out.txt"
+    return f"Got {value}."
+
+
+def failing_task(job):
+    raise ValueError("Boom.")
+
+
+@mock.patch.dict(TASKS, {'succeed': succeeding_task, 'fail': failing_task})
+class WorkerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('clerk', password='x')
+
+    def test_only_one_worker_claims_a_job(self):
+        job = Job.enqueue(self.user, 'succeed', {'value': 1})
+        self.assertTrue(Job(pk=job.pk, status=Job.QUEUED).claim('a'))
+        self.assertFalse(Job(pk=job.pk, status=Job.QUEUED).claim('b'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker, job.attempts), (Job.RUNNING, 'a', 1))
+
+    def test_work_once_runs_the_queue_and_records_outcomes(self):
+        ok = Job.enqueue(self.user, 'succeed', {'value': 7})
+        failed = Job.enqueue(self.user, 'fail')
+        unknown = Job.enqueue(self.user, 'no_such_task')
+
+        with self.assertLogs('jobs.worker', level='ERROR'):
+            work(once=True)
+
+        ok.refresh_from_db()
+        self.assertEqual((ok.status, ok.progress, ok.message, ok.result_file), (Job.SUCCEEDED, 100, "Got 7.", f"{ok.pk}_out.txt"))
+        failed.refresh_from_db()
+        self.assertEqual((failed.status, failed.message), (Job.FAILED, "Boom."))
+        self.assertIn("ValueError", failed.error)
+        self.assertEqual(Job.objects.get(pk=unknown.pk).status, Job.FAILED)
+
+    def test_a_requeued_job_is_not_finished_by_its_old_worker(self):
+        job = Job.enqueue(self.user, 'succeed', {'value': 1})
+        job.claim('old')
+        job.refresh_from_db()
+        Job.objects.filter(pk=job.pk).update(status=Job.QUEUED, worker='')
+
+        run_job(job)
+
+        self.assertEqual(Job.objects.get(pk=job.pk).status, Job.QUEUED)
+
+    def test_stale_jobs_are_requeued_until_they_run_out_of_attempts(self):
+        long_ago = timezone.now() - timedelta(hours=1)
+        retry = Job.objects.create(user=self.user, kind='succeed', status=Job.RUNNING, heartbeat_at=long_ago, attempts=1)
+        give_up = Job.objects.create(user=self.user, kind='succeed', status=Job.RUNNING, heartbeat_at=long_ago, attempts=MAX_ATTEMPTS)
+        alive = Job.objects.create(user=self.user, kind='succeed', status=Job.RUNNING, heartbeat_at=timezone.now(), attempts=1)
+
+        self.assertEqual(requeue_stale_jobs(stale_after=900), (1, 1))
+        self.assertEqual(
+            [Job.objects.get(pk=job.pk).status for job in (retry, give_up, alive)],
+            [Job.QUEUED, Job.FAILED, Job.RUNNING],
+        )
+
+
+class ResultRetentionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('clerk', password='x')
+        self.results_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.results_dir.cleanup)
+        settings_override = override_settings(JOB_RESULTS_DIR=self.results_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def finished_job(self, days_ago, filename):
+        path = Path(self.results_dir.name) / filename
+        path.write_text("data")
+        return Job.objects.create(
+            user=self.user, kind='sales_export', status=Job.SUCCEEDED, result_file=filename,
+            finished_at=timezone.now() - timedelta(days=days_ago),
+        )
+
+    def test_sweep_deletes_expired_jobs_their_files_and_old_orphans(self):
+        expired = self.finished_job(10, 'expired.xlsx')
+        recent = self.finished_job(1, 'recent.xlsx')
+        orphan = Path(self.results_dir.name) / 'orphan.xlsx'
+        orphan.write_text("data")
+        old = (timezone.now() - timedelta(days=10)).timestamp()
+        os.utime(orphan, (old, old))
+
+        self.assertEqual(purge_expired_results(keep_days=7), 1)
+
+        self.assertFalse(Job.objects.filter(pk=expired.pk).exists())
+        self.assertTrue(Job.objects.filter(pk=recent.pk).exists())
+        self.assertEqual(sorted(path.name for path in Path(self.results_dir.name).iterdir()), ['recent.xlsx'])
+
+    def test_deleting_a_job_removes_its_file_on_commit(self):
+        job = self.finished_job(0, 'report.xlsx')
+        with self.captureOnCommitCallbacks(execute=True):
+            job.delete()
+        self.assertFalse((Path(self.results_dir.name) / 'report.xlsx').exists())
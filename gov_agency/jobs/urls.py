@@ -0,0 +1,10 @@
+from django.urls import path
+from . import views
+
+app_name = 'jobs'
+
+urlpatterns = [
+    path('', views.job_list_view, name='job_list'),
+    path('<int:job_pk>/status/', views.job_status_view, name='job_status'),
+    path('<int:job_pk>/download/', views.job_download_view, name='job_download'),
+]
@@ -0,0 +1,46 @@
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.http import FileResponse, Http404, JsonResponse
+from django.shortcuts import get_object_or_404, render
+from django.urls import reverse
+
+from .models import Job
+
+
+def _job_payload(job):
+    return {
+        'id': job.pk,
+        'kind': job.kind,
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'progress': job.progress,
+        'message': job.message,
+        'is_finished': job.is_finished,
+        'download_url': reverse('jobs:job_download', args=[job.pk]) if job.status == Job.SUCCEEDED and job.result_file else None,
+    }
+
+
+@login_required
+def job_list_view(request):
+    """The user's recent background jobs; running ones are refreshed by polling job_status_view."""
+    jobs = Job.objects.filter(user=request.user)[:50]
+    return render(request, 'jobs/job_list.html', {'jobs': jobs})
+
+
+@login_required
+def job_status_view(request, job_pk):
+    job = get_object_or_404(Job, pk=job_pk, user=request.user)
+    return JsonResponse({'success': True, 'data': _job_payload(job)})
+
+
+@login_required
+def job_download_view(request, job_pk):
+    job = get_object_or_404(Job, pk=job_pk, user=request.user, status=Job.SUCCEEDED)
+    if not job.result_file:
+        raise Http404("This job has no result file.")
+    path = Path(settings.JOB_RESULTS_DIR) / job.result_file
+    if not path.is_file():
+        raise Http404("The result file is no longer available.")
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=job.result_filename or path.name)
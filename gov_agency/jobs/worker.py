@@ -0,0 +1,160 @@
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from .models import Job, remove_result_files
+from .tasks import TASKS
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3
+# Seconds between heartbeats of a running job; keep well under run_worker's --stale-after.
+HEARTBEAT_INTERVAL = 30
+# Seconds between sweeps for expired job results.
+RESULTS_SWEEP_INTERVAL = 3600
+
+
+def worker_name(index=0):
+    return f"{socket.gethostname()}:{os.getpid()}:{index}"
+
+
+def next_job(name):
+    """Claims the oldest QUEUED job for this worker, or returns None when the queue is empty."""
+    candidates = Job.objects.filter(status=Job.QUEUED).order_by('created_at', 'pk').values_list('pk', flat=True)[:10]
+    for pk in candidates:
+        job = Job(pk=pk, status=Job.QUEUED)
+        if job.claim(name):
+            return Job.objects.select_related('user').get(pk=pk)
+    return None
+
+
+@contextmanager
+def heartbeat(job, interval=HEARTBEAT_INTERVAL):
+    """
+    Advances the job's heartbeat_at every `interval` seconds from a background thread
+    while the block runs, so a long task that never calls set_progress is not taken
+    for a dead worker. The thread uses (and closes) its own database connection.
+    """
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(interval):
+                try:
+                    Job.objects.filter(pk=job.pk, status=Job.RUNNING, worker=job.worker).update(heartbeat_at=timezone.now())
+                except Exception:
+                    logger.exception("Heartbeat for job %s failed", job.pk)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f"job-{job.pk}-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_job(job):
+    """Runs one claimed job and records its outcome; task exceptions mark the job FAILED."""
+    func = TASKS.get(job.kind)
+    # Only the worker that still owns the job records the outcome; a job requeued
+    # as stale may already be running elsewhere.
+    owned = Job.objects.filter(pk=job.pk, status=Job.RUNNING, worker=job.worker)
+    try:
+        if func is None:
+            raise LookupError(f"Unknown job kind '{job.kind}'.")
+        with heartbeat(job):
+            message = func(job, **job.params) or ''
+    except Exception as e:
+        logger.exception("Job %s (%s) failed", job.pk, job.kind)
+        owned.update(
+            status=Job.FAILED, message=str(e)[:255], error=traceback.format_exc(), finished_at=timezone.now(),
+        )
+        return False
+
+    owned.update(
+        status=Job.SUCCEEDED, progress=100, message=message[:255],
+        result_file=job.result_file, result_filename=job.result_filename, finished_at=timezone.now(),
+    )
+    return True
+
+
+def requeue_stale_jobs(stale_after):
+    """
+    Jobs left RUNNING by a worker that died (no heartbeat for `stale_after` seconds) go back
+    on the queue, or fail once they have used up MAX_ATTEMPTS.
+    """
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    stale = Job.objects.filter(status=Job.RUNNING, heartbeat_at__lt=cutoff)
+    failed = stale.filter(attempts__gte=MAX_ATTEMPTS).update(
+        status=Job.FAILED, message="Worker stopped responding.", finished_at=timezone.now(),
+    )
+    requeued = stale.filter(attempts__lt=MAX_ATTEMPTS).update(status=Job.QUEUED, worker='')
+    return requeued, failed
+
+
+def purge_expired_results(keep_days=None):
+    """
+    Deletes jobs that finished more than `keep_days` (default settings.JOB_RESULTS_KEEP_DAYS)
+    ago together with their result files, then any file in JOB_RESULTS_DIR that no job
+    refers to and is as old (left behind by bulk or cascading deletes). Returns the
+    number of jobs deleted.
+    """
+    if keep_days is None:
+        keep_days = settings.JOB_RESULTS_KEEP_DAYS
+    cutoff = timezone.now() - timedelta(days=keep_days)
+    expired = Job.objects.filter(status__in=(Job.SUCCEEDED, Job.FAILED), finished_at__lt=cutoff)
+    result_files = list(expired.exclude(result_file='').values_list('result_file', flat=True))
+    deleted = expired.delete()[0]
+    remove_result_files(result_files)
+
+    results_dir = Path(settings.JOB_RESULTS_DIR)
+    if results_dir.is_dir():
+        referenced = set(Job.objects.exclude(result_file='').values_list('result_file', flat=True))
+        for path in results_dir.iterdir():
+            if path.is_file() and path.name not in referenced and path.stat().st_mtime < cutoff.timestamp():
+                path.unlink(missing_ok=True)
+    return deleted
+
+
+def work(index=0, poll_interval=2.0, stale_after=900, once=False, stop=None):
+    """
+    Worker loop: reclaim stale jobs, claim, run, repeat. Stale jobs are reclaimed on
+    every poll, so a crashed worker's job is picked up without restarting the others;
+    expired results are swept every RESULTS_SWEEP_INTERVAL seconds.
+    With once=True it exits when the queue is empty.
+    """
+    name = worker_name(index)
+    logger.info("Worker %s started", name)
+    next_sweep = 0
+    while not (stop and stop.is_set()):
+        close_old_connections()
+        requeued, failed = requeue_stale_jobs(stale_after)
+        if requeued or failed:
+            logger.warning("Worker %s requeued %s stale job(s), failed %s", name, requeued, failed)
+        if time.monotonic() >= next_sweep:
+            purged = purge_expired_results()
+            if purged:
+                logger.info("Worker %s deleted %s expired job(s)", name, purged)
+            next_sweep = time.monotonic() + RESULTS_SWEEP_INTERVAL
+        job = next_job(name)
+        if job is None:
+            if once:
+                break
+            time.sleep(poll_interval)
+            continue
+        logger.info("Worker %s running job %s (%s)", name, job.pk, job.kind)
+        run_job(job)
+    logger.info("Worker %s stopped", name)
@@ -0,0 +1,43 @@
+from django.db.models import F, Value, IntegerField, DecimalField, FloatField, ExpressionWrapper
+from django.db.models.functions import Cast, Floor, Round
+
+
+# Quantities are stored as packed "MasterUnits.Items" decimals: 1.11 means one master
+# unit plus 11 loose items, so the value only means something next to the batch's
+# items_per_master_unit. These expressions do the same conversions as
+# ProductDetail._get_items_from_decimal / _get_decimal_from_items inside the database,
+# so item counts can be annotated and aggregated without loading rows.
+# Both work on SQLite and PostgreSQL.
+
+
+def _as_expression(value):
+    return F(value) if isinstance(value, str) else value
+
+
+class PackedToItems(Cast):
+    """
+    Packed quantity -> individual item count, e.g. PackedToItems('quantity_sold_decimal',
+    'items_per_master_unit_at_sale') turns 1.11 with 12 per unit into 23.
+    """
+
+    def __init__(self, packed, items_per_master_unit):
+        packed = _as_expression(packed)
+        items_per_master_unit = _as_expression(items_per_master_unit)
+        items = Floor(packed) * items_per_master_unit + Round((packed - Floor(packed)) * 100)
+        super().__init__(ExpressionWrapper(items, output_field=IntegerField()), output_field=IntegerField())
+
+
+class ItemsToPacked(Cast):
+    """
+    Individual item count -> packed quantity for display, e.g. 23 items with 12 per unit
+    becomes 1.11. Accepts any integer expression, such as Sum(PackedToItems(...)).
+    """
+
+    def __init__(self, items, items_per_master_unit, max_digits=12):
+        items = _as_expression(items)
+        items_per_master_unit = _as_expression(items_per_master_unit)
+        # Multiplying by 1.0 keeps the division from being an integer division on either backend.
+        full_units = Floor(ExpressionWrapper(items * Value(1.0) / items_per_master_unit, output_field=FloatField()))
+        loose_items = items - full_units * items_per_master_unit
+        packed = ExpressionWrapper(full_units + loose_items * Value(1.0) / Value(100), output_field=FloatField())
+        super().__init__(packed, output_field=DecimalField(max_digits=max_digits, decimal_places=2))
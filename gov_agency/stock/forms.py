@@ -2,6 +2,7 @@ from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 from .models import AddProduct,ProductDetail,Sale, Vehicle, Shop,SalesTransaction,SalesTransactionItem
+from .utils import fefo_available_items
 from decimal import Decimal
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.forms import modelformset_factory
@@ -77,6 +78,17 @@ class AddProductForm(forms.ModelForm):
 class ProductDetailForm(forms.ModelForm):
     product_base = forms.ModelChoiceField(
         queryset=AddProduct.objects.all(), widget=forms.Select(attrs={'class': 'form-select daisy-select w-full'}))
+    # Entered in 'MasterUnits.Items' format; stored on the model as an integer item count.
+    stock = forms.DecimalField(
+        label='New Stock',
+        max_digits=10, decimal_places=2,
+        validators=[MinValueValidator(Decimal('0.01'))],
+        help_text="e.g. 100.00 for 100,",
+        widget=forms.NumberInput(attrs={
+            'class': 'input input-bordered w-full', 
+            'placeholder': '100.00'
+        })
+    )
     class Meta:
         model = ProductDetail
         fields =  [
@@ -122,10 +134,6 @@ class ProductDetailForm(forms.ModelForm):
                 'class': 'date  w-full', 
                 'placeholder': 'Enter expiery date...'
             }),
-            'stock': forms.NumberInput(attrs={
-                'class': 'input input-bordered w-full', 
-                'placeholder': '100.00'
-            }),
             'selling_price_of_item': forms.NumberInput(attrs={
                 'class': 'input input-bordered w-full',
                 'placeholder': 'Selling Price of an Item',
@@ -140,7 +148,6 @@ class ProductDetailForm(forms.ModelForm):
             'items_per_master_unit': 'Items per Master Unit',
             'price_per_item': 'Price per Single Item',
             'expirey_date': 'Expirey Date',
-            'stock':'New Stock'
         }
 
 
@@ -150,6 +157,16 @@ class ProductDetailForm(forms.ModelForm):
         if self.user:
             self.fields['product_base'].queryset = AddProduct.objects.filter(user=self.user)
         self.fields['product_base'].empty_label = None
+        if self.instance and self.instance.pk:
+            self.fields['stock'].initial = self.instance.stock
+
+    def save(self, commit=True):
+        detail = super().save(commit=False)
+        # items_per_master_unit is already on the instance, so the packed value converts correctly.
+        detail.stock = self.cleaned_data['stock']
+        if commit:
+            detail.save()
+        return detail
 
     def clean_price_per_item(self):
         price = self.cleaned_data.get('price_per_item')
@@ -270,12 +287,19 @@ class AddItemToSaleForm(forms.Form):
         })
     )
 
+    allocate_by_expiry = forms.BooleanField(
+        required=False, initial=True,
+        label="Take from earliest-expiring batches first (FEFO)",
+        help_text="The quantity is split across all batches of this product and packing, earliest expiry first.",
+        widget=forms.CheckboxInput(attrs={'class': 'checkbox checkbox-primary', 'id': 'add_item_allocate_by_expiry'})
+    )
+
     def __init__(self, *args, **kwargs):
         user = kwargs.pop('user', None)
         super().__init__(*args, **kwargs)
         if user:
             self.fields['product_detail_batch'].queryset = ProductDetail.objects.filter(
-                user=user, stock__gt=Decimal('0.00') # Only show batches with stock
+                user=user, stock_items__gt=0 # Only show batches with stock
             ).select_related('product_base').order_by('product_base__name', 'expirey_date')
             self.fields['product_detail_batch'].label_from_instance = lambda obj: f"{obj.product_base.name} {obj.quantity_in_packing} {obj.unit_of_measure} (Exp: {obj.expirey_date.strftime('%d-%b-%Y')}, Stock: {obj.stock})"
         self.fields['product_detail_batch'].empty_label = "--- Select Product Batch to Add ---"
@@ -304,8 +328,12 @@ class AddItemToSaleForm(forms.Form):
                  self.add_error('quantity_to_add', f"Loose items part ({loose_items_input}) cannot exceed items per master unit ({product_detail_batch.items_per_master_unit}).")
 
             # Validate against total available stock
-            if items_to_sell > product_detail_batch.total_items_in_stock:
-                self.add_error('quantity_to_add', f"Not enough stock. Available: {product_detail_batch.total_items_in_stock} items.")
+            if cleaned_data.get('allocate_by_expiry'):
+                available_items = fefo_available_items(product_detail_batch)
+            else:
+                available_items = product_detail_batch.total_items_in_stock
+            if items_to_sell > available_items:
+                self.add_error('quantity_to_add', f"Not enough stock. Available: {available_items} items.")
         
         # --- Auto-calculate selling price per item if price per carton is provided ---
         # And if the user hasn't manually changed the selling_price_per_item field.
@@ -590,7 +618,7 @@ class SaleForm(forms.Form): # Not a ModelForm because of dynamic/conditional fie
         super().__init__(*args, **kwargs)
         if user:
             self.fields['product_detail_batch'].queryset = ProductDetail.objects.filter(
-                user=user, stock__gt=Decimal('0.0')
+                user=user, stock_items__gt=0
             ).select_related('product_base').order_by('product_base__name', 'expirey_date')
             self.fields['product_detail_batch'].label_from_instance = lambda obj: f"{obj.product_base.name} (Exp: {obj.expirey_date.strftime('%d-%b-%Y')}, Stock: {obj.stock})"
             
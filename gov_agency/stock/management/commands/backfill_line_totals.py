@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Prefetch
+
+from stock.models import SalesTransaction, SalesTransactionItem
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills allocated_discount, net_line_revenue and net_line_cost on existing "
+        "sales lines, a chunk of transactions at a time. Safe to re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Transactions per chunk.")
+
+    def handle(self, *args, **options):
+        chunk_size = max(options['chunk_size'], 1)
+        items_in_order = Prefetch('items', queryset=SalesTransactionItem.objects.order_by('pk'))
+        last_pk = 0
+        updated = 0
+        while True:
+            chunk = list(
+                SalesTransaction.objects.filter(pk__gt=last_pk)
+                .order_by('pk')
+                .prefetch_related(items_in_order)[:chunk_size]
+            )
+            if not chunk:
+                break
+            items = []
+            for sales_transaction in chunk:
+                transaction_items = list(sales_transaction.items.all())
+                sales_transaction.allocate_line_totals(transaction_items)
+                items.extend(transaction_items)
+            with transaction.atomic():
+                SalesTransactionItem.objects.bulk_update(items, SalesTransactionItem.LINE_TOTAL_FIELDS, batch_size=1000)
+            updated += len(items)
+            last_pk = chunk[-1].pk
+            self.stdout.write(f"Up to transaction #{last_pk}: {updated} line(s)")
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled {updated} sales line(s)."))
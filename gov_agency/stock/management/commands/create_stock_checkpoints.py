@@ -0,0 +1,31 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from stock.utils import create_stock_checkpoints
+
+
+class Command(BaseCommand):
+    help = (
+        "Snapshots every batch's stock at the end of a day so point-in-time stock "
+        "queries only add the movements since. Schedule it daily (or monthly) from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help="Day to checkpoint (YYYY-MM-DD). Defaults to yesterday.")
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                as_of = date.fromisoformat(options['date'])
+            except ValueError:
+                raise CommandError("--date must be in YYYY-MM-DD format.")
+        else:
+            as_of = timezone.localdate() - timedelta(days=1)
+
+        try:
+            count = create_stock_checkpoints(as_of)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} stock checkpoint(s) for {as_of}."))
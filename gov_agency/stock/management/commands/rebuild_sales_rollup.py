@@ -0,0 +1,55 @@
+from datetime import date, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from stock.models import SalesTransaction
+from stock.utils import refresh_sales_rollup
+
+
+class Command(BaseCommand):
+    help = (
+        "Regenerates SalesDailyRollup rows from the raw sales for a date range. "
+        "Run it after migrating the rollup table (migration 0071 empties it) or to repair drift."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', help="First day (YYYY-MM-DD). Defaults to the earliest sale.")
+        parser.add_argument('--to', dest='end', help="Last day (YYYY-MM-DD). Defaults to today.")
+        parser.add_argument('--user', help="Only rebuild this username.")
+        parser.add_argument('--days-per-batch', type=int, default=31, help="Days rebuilt per transaction.")
+
+    def handle(self, *args, **options):
+        try:
+            start = date.fromisoformat(options['start']) if options['start'] else None
+            end = date.fromisoformat(options['end']) if options['end'] else timezone.localdate()
+        except ValueError:
+            raise CommandError("--from and --to must be in YYYY-MM-DD format.")
+
+        users = User.objects.filter(processed_sales_transactions__isnull=False).distinct()
+        if options['user']:
+            users = User.objects.filter(username=options['user'])
+            if not users.exists():
+                raise CommandError(f"User '{options['user']}' does not exist.")
+
+        step = max(options['days_per_batch'], 1)
+        total_rows = 0
+        for user in users:
+            user_start = start
+            if user_start is None:
+                first_sale = SalesTransaction.objects.filter(user=user).order_by('transaction_time').first()
+                if first_sale is None:
+                    continue
+                user_start = timezone.localdate(first_sale.transaction_time)
+
+            day = user_start
+            while day <= end:
+                batch_days = [day + timedelta(days=offset) for offset in range(step) if day + timedelta(days=offset) <= end]
+                with transaction.atomic():
+                    total_rows += refresh_sales_rollup(user.pk, batch_days)
+                day += timedelta(days=step)
+            self.stdout.write(f"Rebuilt {user.username}: {user_start} to {end}")
+
+        self.stdout.write(self.style.SUCCESS(f"Wrote {total_rows} rollup row(s)."))
@@ -0,0 +1,55 @@
+# Generated by Django 4.2.21 on 2026-10-18 14:09
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+def packed_stock_to_items(apps, schema_editor):
+    # 1.11 with 12 items per master unit -> 1 * 12 + 11 = 23 items.
+    ProductDetail = apps.get_model('stock', 'ProductDetail')
+    batches = []
+    for detail in ProductDetail.objects.only('pk', 'stock', 'items_per_master_unit').iterator():
+        stock = detail.stock or 0
+        detail.stock_items = int(stock) * detail.items_per_master_unit + int(round((stock % 1) * 100))
+        batches.append(detail)
+    ProductDetail.objects.bulk_update(batches, ['stock_items'], batch_size=500)
+
+
+def items_to_packed_stock(apps, schema_editor):
+    ProductDetail = apps.get_model('stock', 'ProductDetail')
+    batches = []
+    for detail in ProductDetail.objects.only('pk', 'stock_items', 'items_per_master_unit').iterator():
+        full_units, loose_items = divmod(detail.stock_items, detail.items_per_master_unit)
+        detail.stock = Decimal(full_units) + Decimal(loose_items) / Decimal(100)
+        batches.append(detail)
+    ProductDetail.objects.bulk_update(batches, ['stock'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock', '0062_alter_productdetail_expirey_date'),
+    ]
+
+    operations = [
+        # The old unique_together includes `stock`, so it is moved to stock_items
+        # before the column is dropped.
+        migrations.AlterUniqueTogether(
+            name='productdetail',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='productdetail',
+            name='stock_items',
+            field=models.PositiveIntegerField(default=0, help_text='Authoritative stock on hand, counted in individual items.'),
+        ),
+        migrations.RunPython(packed_stock_to_items, items_to_packed_stock),
+        migrations.AlterUniqueTogether(
+            name='productdetail',
+            unique_together={('product_base', 'packing_type', 'quantity_in_packing', 'unit_of_measure', 'expirey_date', 'stock_items')},
+        ),
+        migrations.RemoveField(
+            model_name='productdetail',
+            name='stock',
+        ),
+    ]
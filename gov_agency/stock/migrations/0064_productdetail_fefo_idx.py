@@ -0,0 +1,17 @@
+# Generated by Django 4.2.21 on 2026-10-18 14:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock', '0063_productdetail_stock_items'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='productdetail',
+            index=models.Index(fields=['user', 'product_base', 'packing_type', 'quantity_in_packing', 'expirey_date'], name='productdetail_fefo_idx'),
+        ),
+    ]
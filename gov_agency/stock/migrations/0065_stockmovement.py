@@ -0,0 +1,46 @@
+# Generated by Django 4.2.21 on 2026-10-18 14:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def opening_balances(apps, schema_editor):
+    """Seeds one OPENING movement per batch so the ledger sums to the current stock."""
+    ProductDetail = apps.get_model('stock', 'ProductDetail')
+    StockMovement = apps.get_model('stock', 'StockMovement')
+    StockMovement.objects.bulk_create(
+        [
+            StockMovement(product_detail_id=pk, delta_items=stock_items, reason='OPENING')
+            for pk, stock_items in ProductDetail.objects.filter(stock_items__gt=0).values_list('pk', 'stock_items').iterator()
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claim', '0002_alter_claim_options_remove_claim_product_detail_and_more'),
+        ('stock', '0064_productdetail_fefo_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delta_items', models.IntegerField(help_text='Signed change in individual items (+ in, - out).')),
+                ('reason', models.CharField(choices=[('OPENING', 'Opening Balance'), ('CREATED', 'Batch Created'), ('ADD', 'Stock Added'), ('SALE', 'Sale'), ('RETURN', 'Delivery Return'), ('DEMAND', 'Increased Demand'), ('REVERSAL', 'Sale Reversal'), ('CLAIM_IN', 'Claim Received'), ('CLAIM_OUT', 'Claim Exchanged'), ('CLAIM_REV', 'Claim Reversal'), ('ADJUST', 'Manual Adjustment')], max_length=10)),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('claim', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_movements', to='claim.claim')),
+                ('product_detail', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='movements', to='stock.productdetail')),
+                ('sales_transaction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_movements', to='stock.salestransaction')),
+            ],
+            options={
+                'ordering': ['created_at', 'id'],
+                'indexes': [models.Index(fields=['product_detail', 'created_at'], name='stockmovement_batch_time_idx')],
+            },
+        ),
+        migrations.RunPython(opening_balances, migrations.RunPython.noop),
+    ]
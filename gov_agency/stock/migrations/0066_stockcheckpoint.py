@@ -0,0 +1,29 @@
+# Generated by Django 4.2.21 on 2026-10-18 14:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock', '0065_stockmovement'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('as_of', models.DateField()),
+                ('cutoff', models.DateTimeField()),
+                ('stock_items', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('product_detail', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='stock.productdetail')),
+            ],
+            options={
+                'ordering': ['-as_of'],
+                'unique_together': {('product_detail', 'as_of')},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.21 on 2026-10-18 14:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock', '0066_stockcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stockhistory',
+            index=models.Index(fields=['user', 'timestamp', 'id'], name='stockhistory_user_keyset_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.21 on 2026-10-18 14:26
+
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('stock', '0067_stockhistory_keyset_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SalesDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('business_date', models.DateField()),
+                ('lines_count', models.PositiveIntegerField(default=0)),
+                ('items_dispatched', models.IntegerField(default=0)),
+                ('items_returned', models.IntegerField(default=0)),
+                ('items_sold', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('cost', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('discount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('paid_cash', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('paid_online', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('on_credit', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('product_detail', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sales_rollups', to='stock.productdetail')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sales_rollups', to=settings.AUTH_USER_MODEL)),
+                ('vehicle', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sales_rollups', to='stock.vehicle')),
+            ],
+            options={
+                'ordering': ['-business_date'],
+                'indexes': [models.Index(fields=['user', 'business_date'], name='salesrollup_user_date_idx')],
+                'unique_together': {('user', 'business_date', 'vehicle', 'product_detail')},
+            },
+        ),
+    ]
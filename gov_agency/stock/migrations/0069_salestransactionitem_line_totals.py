@@ -0,0 +1,29 @@
+# Generated by Django 4.2.21 on 2026-10-18 14:28
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock', '0068_salesdailyrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='salestransactionitem',
+            name='allocated_discount',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='salestransactionitem',
+            name='net_line_cost',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='salestransactionitem',
+            name='net_line_revenue',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.21 on 2026-10-18 14:40
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def backfill_balances(apps, schema_editor):
+    # balance = SUM(debit - credit) over the existing ledger, one UPDATE for all rows.
+    Shop = apps.get_model('stock', 'Shop')
+    Ledger = apps.get_model('accounts', 'ShopFinancialTransaction')
+    totals = (
+        Ledger.objects.filter(shop=models.OuterRef('pk'))
+        .order_by()
+        .values('shop')
+        .annotate(total=models.Sum(models.F('debit_amount') - models.F('credit_amount')))
+        .values('total')
+    )
+    Shop.objects.update(balance=Coalesce(
+        models.Subquery(totals, output_field=models.DecimalField(max_digits=14, decimal_places=2)),
+        models.Value(Decimal('0.00')),
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock', '0069_salestransactionitem_line_totals'),
+        ('accounts', '0019_customaccount_balance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shop',
+            name='balance',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=Decimal('0.00'), max_digits=14),
+        ),
+        migrations.RunPython(backfill_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.2.21 on 2026-10-18 15:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def clear_rollup(apps, schema_editor):
+    # The rows were grouped without shop and packing size and cannot be split afterwards.
+    # The table is derived data: run `manage.py rebuild_sales_rollup` after migrating.
+    apps.get_model('stock', 'SalesDailyRollup').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock', '0070_shop_balance'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_rollup, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='salesdailyrollup',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='salesdailyrollup',
+            name='rollup_key',
+            field=models.CharField(default='', editable=False, max_length=100, unique=True),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='salesdailyrollup',
+            name='shop',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sales_rollups', to='stock.shop'),
+        ),
+        migrations.AddField(
+            model_name='salesdailyrollup',
+            name='items_per_master_unit_at_sale',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='salesdailyrollup',
+            name='sales_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='salesdailyrollup',
+            name='lines_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='salesdailyrollup',
+            index=models.Index(fields=['shop', 'business_date'], name='salesrollup_shop_date_idx'),
+        ),
+    ]
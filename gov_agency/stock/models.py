@@ -5,10 +5,12 @@ from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 from datetime import date, timedelta
 from decimal import Decimal, ROUND_DOWN
-from django.db.models import Sum
+from django.db.models import Sum, F, ExpressionWrapper, DecimalField, IntegerField
+from .expressions import PackedToItems
 
 # Create your models here.
 
+
 class AddProduct(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE,  related_name="products")
     name = models.CharField(max_length=200)
@@ -44,7 +46,7 @@ class ProductDetail(models.Model):
     help_text="Price for one individual item (e.g., one bottle, one piece).")
     selling_price_of_item = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, validators=[MinValueValidator(0.00)],
     help_text="Selling Price of an Item")
-    stock = models.DecimalField(max_digits=10,decimal_places=2  ,blank=False, null=False, validators=[MinValueValidator(0.01)],help_text="e.g. 100.00 for 100,")
+    stock_items = models.PositiveIntegerField(default=0, help_text="Authoritative stock on hand, counted in individual items.")
     expirey_date = models.DateField(blank=False, null=False, default=date.today() + timedelta(days=30))
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -54,7 +56,11 @@ class ProductDetail(models.Model):
     
     class Meta:
         ordering = ['product_base__name', '-created_at']
-        unique_together = [['product_base', 'packing_type', 'quantity_in_packing', 'unit_of_measure','expirey_date','stock']]
+        unique_together = [['product_base', 'packing_type', 'quantity_in_packing', 'unit_of_measure','expirey_date','stock_items']]
+        indexes = [
+            # Serves the FEFO allocator in stock/utils.py (earliest expiry first per product/packing).
+            models.Index(fields=['user', 'product_base', 'packing_type', 'quantity_in_packing', 'expirey_date'], name='productdetail_fefo_idx'),
+        ]
         verbose_name = "Product Detail/Variant"
         verbose_name_plural = "Product Details/Variants"
 
@@ -77,10 +83,19 @@ class ProductDetail(models.Model):
         # Format as X.YY
         return Decimal(full_units) + (Decimal(loose_items) / Decimal(100))
 
+    @property
+    def stock(self) -> Decimal:
+        """Display-only 'MasterUnits.Items' view of stock_items (e.g., 23 items -> 1.11)."""
+        return self._get_decimal_from_items(self.stock_items or 0)
+
+    @stock.setter
+    def stock(self, decimal_value: Decimal):
+        self.stock_items = self._get_items_from_decimal(decimal_value)
+
     @property
     def total_items_in_stock(self) -> int:
-        """Calculates total individual items from the new decimal format."""
-        return self._get_items_from_decimal(self.stock)
+        """Total individual items on hand."""
+        return self.stock_items or 0
 
     @property
     def display_stock(self) -> str:
@@ -105,42 +120,32 @@ class ProductDetail(models.Model):
         return Decimal('0.00')
     
     # --- The ONLY stock modification methods you need ---
+    # Both go through stock.utils, which applies the change as a single
+    # conditional UPDATE instead of a read-modify-write save().
+
+    # `reason` and the optional sales_transaction=/claim= source are recorded
+    # in the StockMovement ledger alongside the change. Afterwards stock_items is
+    # re-read from the row, never computed from this (unlocked) instance, so a later
+    # save() cannot write back a stale count. Save these instances with update_fields
+    # that leave out stock_items.
 
-    def decrease_stock(self, quantity_to_sell_decimal: Decimal) -> bool:
+    def decrease_stock(self, quantity_to_sell_decimal: Decimal, reason='ADJUST', **source) -> bool:
         """Decreases stock using the 'MasterUnits.IndividualItems' decimal format."""
+        from .utils import take_stock_items
         items_to_sell = self._get_items_from_decimal(quantity_to_sell_decimal)
-        if self.total_items_in_stock >= items_to_sell:
-            new_total_items = self.total_items_in_stock - items_to_sell
-            self.stock = self._get_decimal_from_items(new_total_items)
-            self.save()
-            return True
-        return False
-
-    def increase_stock(self, quantity_to_add_decimal: Decimal) -> bool:
+        if not take_stock_items(self.pk, items_to_sell, reason, **source):
+            return False
+        self.refresh_from_db(fields=['stock_items'])
+        return True
+
+    def increase_stock(self, quantity_to_add_decimal: Decimal, reason='ADJUST', **source) -> bool:
         """Increases stock using the 'MasterUnits.IndividualItems' decimal format."""
+        from .utils import put_stock_items
         items_to_add = self._get_items_from_decimal(quantity_to_add_decimal)
-        new_total_items = self.total_items_in_stock + items_to_add
-        self.stock = self._get_decimal_from_items(new_total_items)
-        self.save() 
+        put_stock_items(self.pk, items_to_add, reason, **source)
+        self.refresh_from_db(fields=['stock_items'])
         return True
 
-    
-
-    def sell_one_item(self):
-        if self.stock % 1 == 0:
-        # e.g., 2.0, 1.0 → full carton
-            self.stock -= Decimal('0.5')
-        else:
-        # e.g., 1.5, 1.4, etc. → partial
-            self.stock -= Decimal('0.1')
-
-        if self.stock < 0:
-            self.stock = Decimal('0.0')  # prevent negative
-
-    @property
-    def display_stock(self):
-        return f"{self.stock} cartons"
-    
 
 
 class StockHistory(models.Model):
@@ -168,10 +173,86 @@ class StockHistory(models.Model):
     performed_by = models.CharField(max_length=100, blank=True, null=True)
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of the stock history page walks (timestamp, id) per user.
+            models.Index(fields=['user', 'timestamp', 'id'], name='stockhistory_user_keyset_idx'),
+        ]
+
     def __str__(self):
         return f"{self.get_action_display()} - {self.product_detail} ({self.timestamp:%Y-%m-%d %H:%M})"
 
 
+class StockMovement(models.Model):
+    """
+    Append-only ledger of every change to ProductDetail.stock_items, in individual items.
+    Rows are only ever inserted (see stock.utils.log_stock_movement), so a batch's
+    stock is the sum of its deltas.
+    """
+    OPENING = 'OPENING'
+    CREATED = 'CREATED'
+    ADD = 'ADD'
+    SALE = 'SALE'
+    DELIVERY_RETURN = 'RETURN'
+    INCREASED_DEMAND = 'DEMAND'
+    SALE_REVERSAL = 'REVERSAL'
+    CLAIM_RECEIVED = 'CLAIM_IN'
+    CLAIM_EXCHANGED = 'CLAIM_OUT'
+    CLAIM_REVERSAL = 'CLAIM_REV'
+    ADJUSTMENT = 'ADJUST'
+    REASON_CHOICES = [
+        (OPENING, 'Opening Balance'),
+        (CREATED, 'Batch Created'),
+        (ADD, 'Stock Added'),
+        (SALE, 'Sale'),
+        (DELIVERY_RETURN, 'Delivery Return'),
+        (INCREASED_DEMAND, 'Increased Demand'),
+        (SALE_REVERSAL, 'Sale Reversal'),
+        (CLAIM_RECEIVED, 'Claim Received'),
+        (CLAIM_EXCHANGED, 'Claim Exchanged'),
+        (CLAIM_REVERSAL, 'Claim Reversal'),
+        (ADJUSTMENT, 'Manual Adjustment'),
+    ]
+
+    product_detail = models.ForeignKey(ProductDetail, on_delete=models.CASCADE, related_name='movements')
+    delta_items = models.IntegerField(help_text="Signed change in individual items (+ in, - out).")
+    reason = models.CharField(max_length=10, choices=REASON_CHOICES)
+    # Source of the change. SET_NULL keeps the trail when a sale or claim is deleted.
+    sales_transaction = models.ForeignKey('SalesTransaction', on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_movements')
+    claim = models.ForeignKey('claim.Claim', on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_movements')
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        ordering = ['created_at', 'id']
+        indexes = [
+            models.Index(fields=['product_detail', 'created_at'], name='stockmovement_batch_time_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_reason_display()} {self.delta_items:+d} - {self.product_detail}"
+
+
+class StockCheckpoint(models.Model):
+    """
+    Snapshot of a batch's stock at the end of `as_of` (local time). Stock on any later
+    date is this snapshot plus the StockMovement deltas since, so historical lookups
+    never have to replay the whole ledger. Written by the create_stock_checkpoints command.
+    """
+    product_detail = models.ForeignKey(ProductDetail, on_delete=models.CASCADE, related_name='checkpoints')
+    as_of = models.DateField()
+    # Movements with created_at before this instant are included in stock_items.
+    cutoff = models.DateTimeField()
+    stock_items = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-as_of']
+        unique_together = [['product_detail', 'as_of']]
+
+    def __str__(self):
+        return f"{self.product_detail} @ {self.as_of}: {self.stock_items} items"
+
+
 class SalesTransaction(models.Model):
     """
     Represents the header of a single sales transaction, which can contain multiple items.
@@ -259,14 +340,21 @@ class SalesTransaction(models.Model):
         if new_discount_amount is not None:
             self.total_discount_amount = new_discount_amount
 
-        items_queryset = self.items.all()
-        
-        gross_subtotal = sum(item.gross_line_subtotal for item in items_queryset) or Decimal('0.00')
+        # One SQL aggregate over the items instead of a Python loop over gross_line_subtotal.
+        sold_items = (
+            PackedToItems('quantity_sold_decimal', 'items_per_master_unit_at_sale')
+            - PackedToItems('returned_quantity_decimal', 'items_per_master_unit_at_sale')
+        )
+        totals = self.items.aggregate(
+            gross_subtotal=Sum(sold_items * F('selling_price_per_item'), output_field=DecimalField(max_digits=14, decimal_places=2)),
+            total_cost=Sum(sold_items * F('cost_price_per_item_at_sale'), output_field=DecimalField(max_digits=14, decimal_places=2)),
+        )
+        gross_subtotal = totals['gross_subtotal'] or Decimal('0.00')
         
         # This will now use either the existing discount or the new one we just set.
         self.grand_total_revenue = gross_subtotal - (self.total_discount_amount or Decimal('0.00'))
         
-        self.grand_total_cost = sum(item.total_item_cost for item in items_queryset) or Decimal('0.00')
+        self.grand_total_cost = totals['total_cost'] or Decimal('0.00')
         
         # Save all relevant fields at once.
         self.save(
@@ -276,6 +364,28 @@ class SalesTransaction(models.Model):
                 'total_discount_amount'
             ]
         )
+        self.refresh_line_totals()
+
+    def refresh_line_totals(self):
+        """Re-allocates the header discount over the saved lines and writes them back in one bulk_update."""
+        items = list(self.items.order_by('pk'))
+        self.allocate_line_totals(items)
+        SalesTransactionItem.objects.bulk_update(items, SalesTransactionItem.LINE_TOTAL_FIELDS, batch_size=500)
+
+    def allocate_line_totals(self, items):
+        """
+        Shares total_discount_amount out over `items` (this transaction's lines, in pk
+        order) by their revenue after returns and sets allocated_discount, net_line_revenue
+        and net_line_cost on each. The cents always add up to the header discount.
+        The caller saves the items.
+        """
+        from .utils import allocate_by_weight
+        gross_subtotals = [item.gross_line_subtotal for item in items]
+        discounts = allocate_by_weight(self.total_discount_amount or Decimal('0.00'), gross_subtotals)
+        for item, gross_subtotal, discount in zip(items, gross_subtotals, discounts):
+            item.allocated_discount = discount
+            item.net_line_revenue = gross_subtotal - discount
+            item.net_line_cost = item.total_item_cost
         
     @property
     def grand_total_after_credit(self):
@@ -297,6 +407,8 @@ class SalesTransactionItem(models.Model):
     """
     Represents one line item (a specific product batch sold) within a SalesTransaction.
     """
+    LINE_TOTAL_FIELDS = ['allocated_discount', 'net_line_revenue', 'net_line_cost']
+
     transaction = models.ForeignKey(SalesTransaction, on_delete=models.CASCADE, related_name="items")
     product_detail_snapshot = models.ForeignKey('ProductDetail', on_delete=models.PROTECT, help_text="The specific product batch sold.")
     quantity_sold_decimal = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(Decimal('0.01'))])
@@ -313,6 +425,11 @@ class SalesTransactionItem(models.Model):
         default=Decimal('0.00'),
         help_text="Additional demand beyond dispatched quantity."
     )
+    # Header discount pushed down to the line, and the line's totals after returns and
+    # discount. Set by SalesTransaction.allocate_line_totals whenever the header is recomputed.
+    allocated_discount = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    net_line_revenue = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    net_line_cost = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
     # --- HELPER METHODS AND PROPERTIES (These are all correct) ---
     def _get_individual_items_from_decimal(self, decimal_qty: Decimal, items_per_mu: int) -> int:
         if decimal_qty is None or items_per_mu is None or items_per_mu <= 0: return 0
@@ -353,17 +470,11 @@ class SalesTransactionItem(models.Model):
             self.items_per_master_unit_at_sale
         )
     
-    def save(self, *args, update_parent=True, **kwargs):
+    def set_dispatched_totals(self):
         """
-        Calculates and saves the gross totals for this item.
-        The 'update_parent' flag gives the view control over when to
-        trigger the parent transaction's update_grand_totals method.
+        Fills total_item_dispatched_revenue/cost from the dispatched quantity.
+        Called by save() and by bulk paths that bypass save().
         """
-        # (The logic for populating snapshots and calculating totals is the same)
-        if not self.pk and self.product_detail_snapshot:
-            self.expiry_date_at_sale = self.product_detail_snapshot.expirey_date 
-            self.items_per_master_unit_at_sale = self.product_detail_snapshot.items_per_master_unit
-        
         dispatched_items_count = self._get_individual_items_from_decimal(
             self.quantity_sold_decimal or Decimal('0.00'),
             self.items_per_master_unit_at_sale
@@ -376,12 +487,28 @@ class SalesTransactionItem(models.Model):
         self.total_item_dispatched_cost = (
             dispatched_items_count * (self.cost_price_per_item_at_sale or Decimal('0.0'))
         ).quantize(Decimal('0.01'))
+
+    def save(self, *args, update_parent=True, **kwargs):
+        """
+        Calculates and saves the gross totals for this item.
+        The 'update_parent' flag gives the view control over when to
+        trigger the parent transaction's update_grand_totals method.
+        """
+        # (The logic for populating snapshots and calculating totals is the same)
+        if not self.pk and self.product_detail_snapshot:
+            self.expiry_date_at_sale = self.product_detail_snapshot.expirey_date 
+            self.items_per_master_unit_at_sale = self.product_detail_snapshot.items_per_master_unit
+        
+        self.set_dispatched_totals()
         
         super().save(*args, **kwargs)
 
-        # Only update the parent if the flag is True
+        # Only update the parent if the flag is True. Inside a deferred_totals()
+        # block the header is queued and recomputed once when the block exits.
         if self.transaction and update_parent:
-            self.transaction.update_grand_totals()
+            from .utils import defer_grand_totals
+            if not defer_grand_totals(self.transaction):
+                self.transaction.update_grand_totals()
 
 
 
@@ -394,6 +521,69 @@ class SalesTransactionItem(models.Model):
         verbose_name_plural = "Sales Transaction Items"
 
 
+class SalesDailyRollup(models.Model):
+    """
+    Per-day sales totals for one batch, split by delivery vehicle (NULL = store/counter
+    sale), customer shop (NULL = walk-in or manual customer) and the packing size at
+    sale time. Every sale write applies the change in its transactions' contribution
+    to the affected rows in the same DB transaction (see stock.utils.sales_rollup_tracked),
+    so reports read these rows instead of scanning SalesTransactionItem.
+    Header amounts (discount, cash/online/credit) are shared out over the lines of each
+    transaction in proportion to line revenue, so they add up at any grouping level;
+    sales_count is counted on each transaction's first line.
+    """
+    # NULL vehicle/shop values would not collide in a unique index, so rows are
+    # addressed by this key built from every grouping column instead.
+    rollup_key = models.CharField(max_length=100, unique=True, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sales_rollups')
+    business_date = models.DateField()
+    vehicle = models.ForeignKey('Vehicle', on_delete=models.SET_NULL, null=True, blank=True, related_name='sales_rollups')
+    shop = models.ForeignKey('Shop', on_delete=models.SET_NULL, null=True, blank=True, related_name='sales_rollups')
+    product_detail = models.ForeignKey(ProductDetail, on_delete=models.CASCADE, related_name='sales_rollups')
+    items_per_master_unit_at_sale = models.PositiveIntegerField()
+
+    sales_count = models.IntegerField(default=0)
+    lines_count = models.IntegerField(default=0)
+    items_dispatched = models.IntegerField(default=0)
+    items_returned = models.IntegerField(default=0)
+    items_sold = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+    cost = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+    discount = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+    paid_cash = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+    paid_online = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+    on_credit = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+    updated_at = models.DateTimeField(auto_now=True)
+
+    GROUPING_FIELDS = ('user_id', 'business_date', 'vehicle_id', 'shop_id', 'product_detail_id', 'items_per_master_unit_at_sale')
+    MEASURE_FIELDS = (
+        'sales_count', 'lines_count', 'items_dispatched', 'items_returned', 'items_sold',
+        'revenue', 'cost', 'discount', 'paid_cash', 'paid_online', 'on_credit',
+    )
+
+    class Meta:
+        ordering = ['-business_date']
+        indexes = [
+            models.Index(fields=['user', 'business_date'], name='salesrollup_user_date_idx'),
+            models.Index(fields=['shop', 'business_date'], name='salesrollup_shop_date_idx'),
+        ]
+
+    @staticmethod
+    def make_key(user_id, business_date, vehicle_id, shop_id, product_detail_id, items_per_master_unit_at_sale):
+        return f"{user_id}:{business_date.isoformat()}:{vehicle_id or '-'}:{shop_id or '-'}:{product_detail_id}:{items_per_master_unit_at_sale}"
+
+    @property
+    def net_revenue(self):
+        return self.revenue - self.discount
+
+    @property
+    def profit(self):
+        return self.net_revenue - self.cost
+
+    def __str__(self):
+        return f"{self.business_date} {self.product_detail}: {self.items_sold} items"
+
+
 
 class Sale(models.Model): # Renamed from SaleRecord if you prefer
     PAYMENT_TYPE_CHOICES = [
@@ -585,6 +775,9 @@ class Shop(models.Model):
     
     is_active = models.BooleanField(default=True, help_text="Is this shop currently operational?")
     notes = models.TextField(blank=True, null=True)
+    # Total debits - total credits of the shop's ledger, kept up to date by every ledger
+    # write (see accounts.models.LedgerBalanceMixin). Check it with verify_ledger_balances.
+    balance = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'), db_index=True)
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -594,21 +787,21 @@ class Shop(models.Model):
 
     @property
     def current_balance(self):
-        """
-        Calculates the current outstanding balance for the shop by summing
-        all its related financial transactions from the 'accounts' app.
-        Balance = Total Debits - Total Credits
-        """
-        # self.financial_transactions comes from the related_name in ShopFinancialTransaction model
-        totals = self.financial_transactions.aggregate(
-            total_debit=Sum('debit_amount'),
-            total_credit=Sum('credit_amount')
-        )
-        
-        total_debit = totals.get('total_debit') or Decimal('0.00')
-        total_credit = totals.get('total_credit') or Decimal('0.00')
-        
-        return total_debit - total_credit
+        """The outstanding balance for the shop: Total Debits - Total Credits."""
+        return self.balance
+
+    def save(self, *args, **kwargs):
+        from .utils import invalidate_shop_leaderboard
+        super().save(*args, **kwargs)
+        # Name, address and is_active all show up in (or filter) the cached leaderboard.
+        invalidate_shop_leaderboard(self.user_id)
+
+    def delete(self, *args, **kwargs):
+        from .utils import invalidate_shop_leaderboard
+        user_id = self.user_id
+        result = super().delete(*args, **kwargs)
+        invalidate_shop_leaderboard(user_id)
+        return result
 
     class Meta:
         ordering = ['name'] # Order by name alphabetically
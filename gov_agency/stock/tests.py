@@ -1,3 +1,608 @@
-from django.test import TestCase
+import json
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db import OperationalError, transaction
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import ShopFinancialTransaction
+from accounts.utils import build_daily_summary
+
+from .expressions import ItemsToPacked, PackedToItems
+from .models import AddProduct, ProductDetail, SalesDailyRollup, SalesTransaction, SalesTransactionItem, Shop, StockMovement, Vehicle
+from .utils import (
+    InsufficientStock, allocate_by_weight, allocate_fefo_many, create_stock_checkpoints, finalize_sale_items, put_stock_items, refresh_sales_rollup,
+    reverse_sales, sales_rollup_tracked, settle_pending_for_vehicle, shop_leaderboard, stock_as_of, take_stock_items,
+    take_stock_items_many, vehicle_loading_sheets,
+)
+
+
+class StockFixtureMixin:
+    def setUp(self):
+        self.user = User.objects.create_user('clerk', password='x')
+        self.product = AddProduct.objects.create(user=self.user, name='Mango Juice')
+        self.carton = self.make_batch('Carton', 12, stock_items=30)
+        self.pet = self.make_batch('PET', 6, stock_items=10)
+
+    def make_batch(self, packing_type, items_per_master_unit, stock_items, expires_in=60, price_per_item='2.00'):
+        return ProductDetail.objects.create(
+            product_base=self.product, user=self.user, packing_type=packing_type,
+            quantity_in_packing=Decimal('1.00'), unit_of_measure='L',
+            items_per_master_unit=items_per_master_unit, price_per_item=Decimal(price_per_item),
+            selling_price_of_item=Decimal('3.00'), stock_items=stock_items,
+            expirey_date=timezone.localdate() + timedelta(days=expires_in),
+        )
+
+    def cart_line(self, batch, quantity, allocation=None):
+        return {
+            'product_detail_id': batch.pk, 'quantity_decimal': quantity, 'selling_price_per_item': '3.00',
+            'cost_price_per_item': str(batch.price_per_item), 'allocation': allocation,
+        }
+
+    def stock_of(self, batch):
+        return ProductDetail.objects.values_list('stock_items', flat=True).get(pk=batch.pk)
+
+
+class StockServiceTests(StockFixtureMixin, TestCase):
+    """Stock changes are conditional UPDATEs that never take a batch below zero."""
+
+    def test_take_stock_items_refuses_to_go_negative(self):
+        self.assertTrue(take_stock_items(self.carton.pk, 25, StockMovement.SALE))
+        self.assertFalse(take_stock_items(self.carton.pk, 6, StockMovement.SALE))
+        self.assertEqual(self.stock_of(self.carton), 5)
+        self.assertEqual(
+            list(StockMovement.objects.filter(product_detail=self.carton).values_list('delta_items', flat=True)), [-25]
+        )
+
+    def test_take_stock_items_many_is_all_or_nothing(self):
+        with self.assertRaises(InsufficientStock):
+            take_stock_items_many({self.carton.pk: 12, self.pet.pk: 11}, StockMovement.SALE)
+        self.assertEqual((self.stock_of(self.carton), self.stock_of(self.pet)), (30, 10))
+        self.assertFalse(StockMovement.objects.exists())
+
+        take_stock_items_many({self.carton.pk: 12, self.pet.pk: 10}, StockMovement.SALE)
+        self.assertEqual((self.stock_of(self.carton), self.stock_of(self.pet)), (18, 0))
+
+    def test_put_stock_items_and_packed_display(self):
+        put_stock_items(self.carton.pk, 5, StockMovement.DELIVERY_RETURN)
+        self.carton.refresh_from_db()
+        self.assertEqual(self.carton.stock_items, 35)
+        self.assertEqual(self.carton.stock, Decimal('2.11'))
+
+    def test_decrease_stock_leaves_stock_untouched_when_short(self):
+        self.assertFalse(self.pet.decrease_stock(Decimal('1.05')))
+        self.assertEqual(self.stock_of(self.pet), 10)
+        self.assertTrue(self.pet.decrease_stock(Decimal('1.04')))
+        self.assertEqual(self.stock_of(self.pet), 0)
+
+    def test_stale_instance_picks_up_the_stored_count(self):
+        stale = ProductDetail.objects.get(pk=self.carton.pk)
+        take_stock_items(self.carton.pk, 10, StockMovement.SALE)
+        self.assertTrue(stale.increase_stock(Decimal('0.02')))
+        self.assertEqual(stale.stock_items, 22)
+        stale.save(update_fields=['expirey_date', 'updated_at'])
+        self.assertEqual(self.stock_of(self.carton), 22)
+
+
+class FefoAllocationTests(StockFixtureMixin, TestCase):
+    """Interchangeable batches are drawn down earliest expiry first."""
+
+    def setUp(self):
+        super().setUp()
+        self.early_pet = self.make_batch('PET', 6, stock_items=4, expires_in=5, price_per_item='1.50')
+        self.empty_pet = self.make_batch('PET', 6, stock_items=0, expires_in=1)
+
+    def test_requests_share_one_pass_and_respect_taken_stock(self):
+        first, second = allocate_fefo_many([(self.pet, 3), (self.pet, 5)], taken={self.early_pet.pk: 2})
+        self.assertEqual([(batch.pk, items) for batch, items in first], [(self.early_pet.pk, 2), (self.pet.pk, 1)])
+        self.assertEqual([(batch.pk, items) for batch, items in second], [(self.pet.pk, 5)])
+
+    def test_short_group_raises(self):
+        with self.assertRaises(InsufficientStock):
+            allocate_fefo_many([(self.pet, 15)])
+        # Cartons are a different group, so their stock never makes up for PET.
+        with self.assertRaises(InsufficientStock):
+            allocate_fefo_many([(self.carton, 12), (self.pet, 15)])
+
+    def test_finalize_splits_fefo_lines_per_batch(self):
+        sale = SalesTransaction.objects.create(user=self.user, status='COMPLETED')
+        cart = [self.cart_line(self.early_pet, '0.01'), self.cart_line(self.pet, '1.00', 'FEFO')]
+        with transaction.atomic():
+            lines = finalize_sale_items(sale, cart)
+
+        # The explicit line takes 1 early item, so FEFO gets the other 3 and 3 more from the later batch.
+        self.assertEqual(
+            [(line.product_detail_snapshot_id, line.quantity_sold_decimal, line.cost_price_per_item_at_sale) for line in lines],
+            [
+                (self.early_pet.pk, Decimal('0.01'), Decimal('1.50')),
+                (self.early_pet.pk, Decimal('0.03'), Decimal('1.50')),
+                (self.pet.pk, Decimal('0.03'), Decimal('2.00')),
+            ],
+        )
+        self.assertEqual((self.stock_of(self.early_pet), self.stock_of(self.pet)), (0, 7))
+
+
+class StockAsOfTests(StockFixtureMixin, TestCase):
+    """Historical stock is the latest checkpoint plus the movements logged after it."""
+
+    def setUp(self):
+        super().setUp()
+        self.today = timezone.localdate()
+        for days_ago, delta in [(5, 20), (3, -5), (1, 10)]:
+            self.move(days_ago, delta)
+
+    def move(self, days_ago, delta):
+        return StockMovement.objects.create(
+            product_detail=self.carton, delta_items=delta, reason=StockMovement.ADJUSTMENT,
+            created_at=timezone.make_aware(datetime.combine(self.today - timedelta(days=days_ago), time(12))),
+        )
+
+    def as_of(self, days_ago):
+        return stock_as_of(self.user, self.today - timedelta(days=days_ago), [self.carton.pk])[self.carton.pk]
+
+    def test_replays_movements_up_to_the_end_of_the_day(self):
+        self.assertEqual([self.as_of(days_ago) for days_ago in (6, 5, 4, 3, 1, 0)], [0, 20, 20, 15, 25, 25])
+        self.assertEqual(stock_as_of(self.user, self.today)[self.pet.pk], 0)
+
+    def test_later_dates_start_from_the_checkpoint(self):
+        self.assertEqual(create_stock_checkpoints(self.today - timedelta(days=3), users=[self.user]), 2)
+        # Rewriting history before the checkpoint no longer reaches later dates.
+        StockMovement.objects.filter(delta_items=20).delete()
+        self.assertEqual(self.as_of(1), 25)
+        self.assertEqual(self.as_of(4), 0)
+
+    def test_refuses_to_checkpoint_an_unfinished_day(self):
+        with self.assertRaises(ValueError):
+            create_stock_checkpoints(self.today)
+
+
+class SalesRollupTests(StockFixtureMixin, TestCase):
+    """Sale writes keep SalesDailyRollup equal to a rebuild from the sale lines."""
+
+    def setUp(self):
+        super().setUp()
+        self.today = timezone.localdate()
+
+    def sell(self, *cart, discount='0.00', status='COMPLETED', cash='0.00'):
+        sale = SalesTransaction.objects.create(
+            user=self.user, status=status, total_discount_amount=Decimal(discount), amount_paid_cash=Decimal(cash),
+        )
+        with transaction.atomic():
+            finalize_sale_items(sale, list(cart))
+        return sale
+
+    def rollup_rows(self):
+        return sorted(
+            SalesDailyRollup.objects.values_list('rollup_key', *SalesDailyRollup.MEASURE_FIELDS)
+        )
+
+    def assert_matches_rebuild(self):
+        incremental = self.rollup_rows()
+        refresh_sales_rollup(self.user.pk, [self.today])
+        self.assertEqual(incremental, self.rollup_rows())
+        return incremental
+
+    def test_finalize_and_edit_apply_deltas(self):
+        sale = self.sell(self.cart_line(self.carton, '1.00'), self.cart_line(self.pet, '0.04'), discount='3.00', cash='45.00')
+        self.sell(self.cart_line(self.carton, '0.02'), cash='6.00')
+        self.assert_matches_rebuild()
+        carton_row = SalesDailyRollup.objects.get(product_detail=self.carton)
+        self.assertEqual((carton_row.sales_count, carton_row.lines_count, carton_row.items_sold), (2, 2, 14))
+
+        # A delivery return on one line moves only that line's figures and the shared discount.
+        with transaction.atomic(), sales_rollup_tracked([sale]):
+            line = sale.items.get(product_detail_snapshot=self.carton)
+            line.returned_quantity_decimal = Decimal('0.06')
+            line.save()
+            sale.refresh_line_totals()
+        self.assert_matches_rebuild()
+        carton_row = SalesDailyRollup.objects.get(product_detail=self.carton)
+        self.assertEqual((carton_row.items_returned, carton_row.items_sold, carton_row.revenue), (6, 8, Decimal('24.00')))
+
+    def test_reversal_removes_the_sales_contribution(self):
+        kept = self.sell(self.cart_line(self.pet, '0.02'))
+        reversed_sale = self.sell(self.cart_line(self.pet, '0.03'), self.cart_line(self.carton, '0.01'))
+
+        reverse_sales(SalesTransaction.objects.filter(pk=reversed_sale.pk))
+
+        self.assert_matches_rebuild()
+        self.assertEqual(
+            list(SalesDailyRollup.objects.values_list('product_detail_id', 'sales_count', 'items_sold')),
+            [(self.pet.pk, 1, 2)],
+        )
+        self.assertTrue(SalesTransaction.objects.filter(pk=kept.pk).exists())
+
+    def test_daily_summary_reads_the_rollup_without_pending_deliveries(self):
+        self.sell(self.cart_line(self.carton, '1.00'), discount='2.00', cash='34.00')
+        self.sell(self.cart_line(self.pet, '0.05'), status='PENDING_DELIVERY')
+
+        summary, created = build_daily_summary(self.user, self.today)
+
+        # 12 items at 3.00 less a 2.00 discount, against 12 items bought at 2.00.
+        self.assertTrue(created)
+        self.assertEqual((summary.total_revenue, summary.total_profit), (Decimal('34.00'), Decimal('10.00')))
+
+
+class ShopLeaderboardTests(StockFixtureMixin, TestCase):
+    """The cached leaderboard is dropped by every writer that changes its rankings."""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.shop = Shop.objects.create(user=self.user, name='Corner Store')
+
+    def sell_to_shop(self, quantity):
+        sale = SalesTransaction.objects.create(user=self.user, customer_shop=self.shop, amount_paid_cash=Decimal('0.00'))
+        with transaction.atomic():
+            finalize_sale_items(sale, [self.cart_line(self.pet, quantity)])
+        return sale
+
+    def test_reversal_drops_the_cached_rankings(self):
+        sale = self.sell_to_shop('0.02')
+        self.assertEqual([row['total_revenue'] for row in shop_leaderboard(self.user)], [Decimal('6.00')])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reverse_sales(SalesTransaction.objects.filter(pk=sale.pk))
+
+        self.assertEqual(shop_leaderboard(self.user), [])
+
+    def test_deactivating_a_shop_drops_the_cached_rankings(self):
+        self.sell_to_shop('0.02')
+        self.assertEqual(len(shop_leaderboard(self.user)), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shop.is_active = False
+            self.shop.save()
+
+        self.assertEqual(shop_leaderboard(self.user), [])
+
+
+class LoadingSheetTests(StockFixtureMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.vehicle = Vehicle.objects.create(user=self.user, vehicle_number='TRK-1')
+
+    def test_quantities_use_the_packing_at_sale(self):
+        sale = SalesTransaction.objects.create(
+            user=self.user, status='PENDING_DELIVERY', assigned_vehicle=self.vehicle, amount_paid_cash=Decimal('0.00'),
+        )
+        with transaction.atomic():
+            finalize_sale_items(sale, [self.cart_line(self.carton, '1.06')])
+        # Repacked after dispatch: the 18 items on the vehicle are still 1 carton and 6.
+        ProductDetail.objects.filter(pk=self.carton.pk).update(items_per_master_unit=24)
+
+        [(vehicle, sheet)] = vehicle_loading_sheets(self.user)
+
+        self.assertEqual(vehicle, self.vehicle)
+        [line] = sheet['items']
+        self.assertEqual((line['total_items'], line['total_quantity_decimal']), (18, Decimal('1.06')))
+
+
+class VehicleFixtureMixin(StockFixtureMixin):
+    def setUp(self):
+        super().setUp()
+        self.vehicle = Vehicle.objects.create(user=self.user, vehicle_number='TRK-1')
+        self.shop = Shop.objects.create(user=self.user, name='Corner Store')
+
+    def dispatch(self, *cart, payment_type='CASH', shop=None):
+        sale = SalesTransaction.objects.create(
+            user=self.user, status='PENDING_DELIVERY', assigned_vehicle=self.vehicle, customer_shop=shop,
+            payment_type=payment_type, amount_paid_cash=Decimal('0.00'),
+        )
+        with transaction.atomic():
+            finalize_sale_items(sale, list(cart))
+        return sale
+
+
+class VehicleSettlementTests(VehicleFixtureMixin, TestCase):
+    def test_settles_every_pending_sale_on_the_vehicle(self):
+        credit_sale = self.dispatch(self.cart_line(self.carton, '1.00'), payment_type='CREDIT', shop=self.shop)
+        cash_sale = self.dispatch(self.cart_line(self.carton, '0.06'))
+        # 4 items come back from the credit sale and the cash customer takes 2 more.
+        SalesTransactionItem.objects.filter(transaction=credit_sale).update(returned_quantity_decimal=Decimal('0.04'))
+        SalesTransactionItem.objects.filter(transaction=cash_sale).update(increased_demand=Decimal('0.02'))
+
+        self.assertEqual(settle_pending_for_vehicle(self.user, self.vehicle), 2)
+
+        self.assertEqual(self.stock_of(self.carton), 30 - 12 - 6 + 4 - 2)
+        credit_sale.refresh_from_db()
+        cash_sale.refresh_from_db()
+        self.assertEqual((credit_sale.status, credit_sale.amount_on_credit), ('COMPLETED', Decimal('24.00')))
+        self.assertEqual((cash_sale.status, cash_sale.amount_paid_cash), ('COMPLETED', Decimal('24.00')))
+        self.assertEqual(cash_sale.items.get().quantity_sold_decimal, Decimal('0.08'))
+        self.assertEqual(
+            list(ShopFinancialTransaction.objects.filter(shop=self.shop).values_list('source_sale_id', 'debit_amount', 'balance')),
+            [(credit_sale.pk, Decimal('24.00'), Decimal('24.00'))],
+        )
+        self.shop.refresh_from_db()
+        self.assertEqual(self.shop.balance, Decimal('24.00'))
+        self.assertEqual(
+            sorted(StockMovement.objects.filter(sales_transaction__isnull=False).exclude(reason=StockMovement.SALE)
+                   .values_list('reason', 'delta_items')),
+            sorted([(StockMovement.DELIVERY_RETURN, 4), (StockMovement.INCREASED_DEMAND, -2)]),
+        )
+        self.assertEqual(settle_pending_for_vehicle(self.user, self.vehicle), 0)
+
+    def test_short_stock_for_increased_demand_settles_nothing(self):
+        sale = self.dispatch(self.cart_line(self.pet, '1.00'))
+        SalesTransactionItem.objects.filter(transaction=sale).update(increased_demand=Decimal('0.05'))
+
+        with self.assertRaises(Exception):
+            settle_pending_for_vehicle(self.user, self.vehicle)
+
+        self.assertEqual(self.stock_of(self.pet), 4)
+        self.assertEqual(SalesTransaction.objects.get(pk=sale.pk).status, 'PENDING_DELIVERY')
+
+
+class RouteReturnsApiTests(VehicleFixtureMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+        self.url = reverse('stock:submit_route_returns', args=[self.vehicle.pk])
+
+    def submit(self, payload):
+        return self.client.post(self.url, json.dumps(payload), content_type='application/json')
+
+    def invoice(self, sale, returned='0.00', **fields):
+        return {'sale_id': sale.pk, 'items': [{'item_id': sale.items.get().pk, 'returned': returned}], **fields}
+
+    def test_accepted_route_is_left_ready_for_settlement(self):
+        cash_sale = self.dispatch(self.cart_line(self.carton, '1.00'))
+        split_sale = self.dispatch(self.cart_line(self.pet, '1.00'), shop=self.shop)
+
+        response = self.submit({'invoices': [
+            self.invoice(cash_sale, returned='0.02'),
+            self.invoice(split_sale, payment_type='SPLIT', amount_paid_cash='10.00', amount_on_credit='8.00'),
+        ]})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['final_total'] for result in response.json()['data']['invoices']], ['30.00', '18.00'])
+        cash_sale.refresh_from_db()
+        self.assertEqual((cash_sale.status, cash_sale.is_ready_for_processing, cash_sale.amount_paid_cash),
+                         ('PENDING_DELIVERY', True, Decimal('30.00')))
+        self.assertEqual(cash_sale.items.get().returned_quantity_decimal, Decimal('0.02'))
+        # Returns only reach stock on settlement.
+        self.assertEqual(self.stock_of(self.carton), 18)
+
+    def test_one_bad_invoice_rejects_the_whole_route(self):
+        good = self.dispatch(self.cart_line(self.carton, '1.00'))
+        bad = self.dispatch(self.cart_line(self.pet, '0.03'))
+
+        response = self.submit({'invoices': [self.invoice(good, returned='0.02'), self.invoice(bad, returned='0.04')]})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([result['ok'] for result in response.json()['data']['invoices']], [True, False])
+        self.assertEqual(SalesTransactionItem.objects.get(transaction=good).returned_quantity_decimal, Decimal('0.00'))
+        self.assertFalse(SalesTransaction.objects.filter(is_ready_for_processing=True).exists())
+
+    def test_settle_completes_the_route_in_the_same_request(self):
+        sale = self.dispatch(self.cart_line(self.carton, '1.00'), shop=self.shop)
+
+        response = self.submit({'invoices': [self.invoice(sale, returned='0.03', payment_type='CREDIT')], 'settle': True})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['data']['settled'])
+        sale.refresh_from_db()
+        self.assertEqual((sale.status, sale.amount_on_credit), ('COMPLETED', Decimal('27.00')))
+        self.assertEqual(self.stock_of(self.carton), 21)
+        self.shop.refresh_from_db()
+        self.assertEqual(self.shop.balance, Decimal('27.00'))
+
+    def test_rejects_a_malformed_payload(self):
+        response = self.client.post(self.url, 'not json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.submit({'invoices': []}).status_code, 400)
+
+
+class ReverseSalesTests(StockFixtureMixin, TestCase):
+    """Bulk reversal restores stock and rebalances shop and manual-customer ledgers."""
+
+    def setUp(self):
+        super().setUp()
+        self.shop = Shop.objects.create(user=self.user, name='Corner Store')
+        self.start = timezone.now() - timedelta(days=10)
+        ShopFinancialTransaction.objects.create(
+            shop=self.shop, user=self.user, transaction_type='OPENING_BALANCE',
+            debit_amount=Decimal('100.00'), transaction_date=self.start,
+        )
+        ShopFinancialTransaction.objects.create(
+            customer_name_snapshot='Walk-in Ali', user=self.user, transaction_type='OPENING_BALANCE',
+            debit_amount=Decimal('50.00'), transaction_date=self.start,
+        )
+
+    def make_sale(self, day, batch, quantity, returned='0.00', status='COMPLETED', shop=None, customer_name=None, credit='0.00'):
+        take_stock_items(batch.pk, batch._get_items_from_decimal(Decimal(quantity)), StockMovement.SALE)
+        sale = SalesTransaction.objects.create(
+            user=self.user, customer_shop=shop, customer_name_manual=customer_name, status=status,
+            transaction_time=self.start + timedelta(days=day), amount_on_credit=Decimal(credit),
+        )
+        SalesTransactionItem.objects.create(
+            transaction=sale, product_detail_snapshot=batch, quantity_sold_decimal=Decimal(quantity),
+            returned_quantity_decimal=Decimal(returned), selling_price_per_item=Decimal('3.00'),
+            cost_price_per_item_at_sale=Decimal('2.00'),
+        )
+        if Decimal(credit):
+            ShopFinancialTransaction.objects.create(
+                shop=shop, customer_name_snapshot=customer_name, user=self.user, source_sale=sale,
+                transaction_type='CREDIT_SALE', debit_amount=Decimal(credit),
+                transaction_date=self.start + timedelta(days=day),
+            )
+        return sale
+
+    def test_restores_sold_stock_net_of_returns(self):
+        settled = self.make_sale(1, self.carton, '1.02', returned='0.02')
+        pending = self.make_sale(2, self.carton, '0.05', status='PENDING_DELIVERY')
+        self.assertEqual(self.stock_of(self.carton), 30 - 14 - 5)
+
+        count, restored = reverse_sales(SalesTransaction.objects.filter(pk__in=[settled.pk, pending.pk]))
+
+        # The settled sale holds 12 items (2 came back already), the pending one all 5.
+        self.assertEqual((count, restored), (2, 17))
+        self.assertEqual(self.stock_of(self.carton), 30 - 14 - 5 + 17)
+        self.assertFalse(SalesTransaction.objects.exists())
+        self.assertEqual(
+            sum(StockMovement.objects.filter(reason=StockMovement.SALE_REVERSAL).values_list('delta_items', flat=True)), 17
+        )
+
+    def test_rebalances_shop_and_manual_customer_ledgers(self):
+        shop_sale = self.make_sale(1, self.pet, '0.02', shop=self.shop, credit='6.00')
+        manual_sale = self.make_sale(2, self.pet, '0.01', customer_name='Walk-in Ali', credit='3.00')
+        ShopFinancialTransaction.objects.create(
+            shop=self.shop, user=self.user, transaction_type='CASH_RECEIPT',
+            credit_amount=Decimal('10.00'), transaction_date=self.start + timedelta(days=3),
+        )
+        ShopFinancialTransaction.objects.create(
+            customer_name_snapshot='Walk-in Ali', user=self.user, transaction_type='CASH_RECEIPT',
+            credit_amount=Decimal('5.00'), transaction_date=self.start + timedelta(days=3),
+        )
+
+        reverse_sales(SalesTransaction.objects.filter(pk__in=[shop_sale.pk, manual_sale.pk]))
+
+        shop_ledger = ShopFinancialTransaction.objects.filter(shop=self.shop).order_by('transaction_date', 'pk')
+        manual_ledger = ShopFinancialTransaction.objects.filter(
+            shop__isnull=True, customer_name_snapshot='Walk-in Ali'
+        ).order_by('transaction_date', 'pk')
+        self.assertEqual(list(shop_ledger.values_list('balance', flat=True)), [Decimal('100.00'), Decimal('90.00')])
+        self.assertEqual(list(manual_ledger.values_list('balance', flat=True)), [Decimal('50.00'), Decimal('45.00')])
+        self.shop.refresh_from_db()
+        self.assertEqual(self.shop.balance, Decimal('90.00'))
+        self.assertEqual(self.stock_of(self.pet), 10)
+
+    def test_bulk_view_reverses_credit_sales_in_the_date_range(self):
+        cash_sale = self.make_sale(1, self.pet, '0.02')
+        credit_sale = self.make_sale(1, self.pet, '0.01', shop=self.shop, credit='3.00')
+        pending = self.make_sale(1, self.pet, '0.01', status='PENDING_DELIVERY')
+        self.client.force_login(self.user)
+        day = timezone.localdate(self.start + timedelta(days=1)).isoformat()
+
+        response = self.client.post(reverse('stock:bulk_reverse_sales'), {'start_date': day})
+        self.assertEqual(response.context['summary']['count'], 2)
+        self.assertEqual(response.context['summary']['pending_count'], 1)
+
+        self.client.post(reverse('stock:bulk_reverse_sales'), {'sale_ids': response.context['sale_ids'], 'confirm': '1'})
+
+        self.assertEqual(list(SalesTransaction.objects.values_list('pk', flat=True)), [pending.pk])
+        self.assertFalse(ShopFinancialTransaction.objects.filter(source_sale_id__in=[cash_sale.pk, credit_sale.pk]).exists())
+        self.shop.refresh_from_db()
+        self.assertEqual(self.shop.balance, Decimal('100.00'))
+
+    def test_malformed_dates_are_reported_not_raised(self):
+        self.client.force_login(self.user)
+
+        response = self.client.post(reverse('stock:bulk_reverse_sales'), {'start_date': '2024-13-45'})
+        self.assertRedirects(response, reverse('stock:all_transactions_list'), fetch_redirect_response=False)
+
+        response = self.client.get(reverse('stock:all_transactions_list'), {'start_date': 'yesterday'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Invalid date filter ignored. Use YYYY-MM-DD.", [str(message) for message in response.context['messages']])
+
+
+class SalesProcessingViewTests(StockFixtureMixin, TransactionTestCase):
+    # Not TestCase: retry_on_conflict only retries as the outermost transaction.
+
+    def setUp(self):
+        super().setUp()
+        self.shop = Shop.objects.create(user=self.user, name='Corner Store')
+        self.client.force_login(self.user)
+        session = self.client.session
+        session[f'current_transaction_items_{self.user.pk}'] = [
+            {**self.cart_line(self.carton, '1.00'), 'line_subtotal': '36.00', 'product_display_name': 'Mango Juice'},
+        ]
+        session.save()
+
+    @mock.patch('gov_agency.decorators.CONFLICT_RETRY_DELAY', 0)
+    def test_a_lock_conflict_retries_only_the_sale_write(self):
+        attempts = []
+
+        def finalize_once_conflicted(sale, cart):
+            attempts.append(sale.pk)
+            if len(attempts) == 1:
+                raise OperationalError('deadlock detected')
+            return finalize_sale_items(sale, cart)
+
+        with mock.patch('stock.views.finalize_sale_items', side_effect=finalize_once_conflicted):
+            response = self.client.post(reverse('stock:sales'), {
+                'action': 'finalize_transaction', 'customer_shop': self.shop.pk, 'payment_type': 'CREDIT',
+                'total_discount_amount': '0.00',
+            })
+
+        sale = SalesTransaction.objects.get()
+        self.assertEqual(len(attempts), 2)
+        self.assertRedirects(response, reverse('stock:sale_receipt', args=[sale.pk]), fetch_redirect_response=False)
+        self.assertEqual([str(message) for message in get_messages(response.wsgi_request)], [f"Transaction #{sale.pk} completed successfully!"])
+        self.assertNotIn(f'current_transaction_items_{self.user.pk}', self.client.session)
+        self.assertEqual(self.stock_of(self.carton), 18)
+        self.assertEqual(list(ShopFinancialTransaction.objects.values_list('source_sale_id', 'debit_amount')), [(sale.pk, Decimal('36.00'))])
+
+
+class AllocateByWeightTests(SimpleTestCase):
+    def test_parts_always_add_up_to_the_amount(self):
+        cases = [
+            ('10.00', [1, 1, 1]),
+            ('0.05', [Decimal('33.33'), Decimal('33.33'), Decimal('33.34')]),
+            ('-7.01', [Decimal('3'), Decimal('5'), Decimal('0')]),
+            ('99.99', [Decimal('0.01'), Decimal('1000'), Decimal('7.77'), Decimal('12.5')]),
+        ]
+        for amount, weights in cases:
+            with self.subTest(amount=amount, weights=weights):
+                parts = allocate_by_weight(Decimal(amount), weights)
+                self.assertEqual(sum(parts), Decimal(amount))
+                self.assertTrue(all(part == part.quantize(Decimal('0.01')) for part in parts))
+
+    def test_leftover_cents_go_to_the_largest_remainders_then_earliest(self):
+        self.assertEqual(allocate_by_weight(Decimal('10.00'), [1, 1, 1]), [Decimal('3.34'), Decimal('3.33'), Decimal('3.33')])
+        self.assertEqual(allocate_by_weight(Decimal('1.00'), [1, 2]), [Decimal('0.33'), Decimal('0.67')])
+
+    def test_zero_weights_split_evenly(self):
+        self.assertEqual(allocate_by_weight(Decimal('0.03'), [0, 0, 0]), [Decimal('0.01')] * 3)
+        self.assertEqual(allocate_by_weight(Decimal('5.00'), []), [])
+
+
+class LineTotalTests(StockFixtureMixin, TestCase):
+    def test_line_discounts_add_up_to_the_header_discount(self):
+        sale = SalesTransaction.objects.create(user=self.user, status='COMPLETED', total_discount_amount=Decimal('1.00'))
+        with transaction.atomic():
+            finalize_sale_items(sale, [self.cart_line(self.carton, '0.01'), self.cart_line(self.pet, '0.01'), self.cart_line(self.carton, '0.01')])
+
+        lines = list(sale.items.order_by('pk'))
+        self.assertEqual([line.allocated_discount for line in lines], [Decimal('0.34'), Decimal('0.33'), Decimal('0.33')])
+        self.assertEqual(sum(line.net_line_revenue for line in lines), Decimal('8.00'))
+        sale.refresh_from_db()
+        self.assertEqual(sale.grand_total_revenue, Decimal('8.00'))
+
+
+class PackedExpressionTests(StockFixtureMixin, TestCase):
+    """The SQL conversions agree with ProductDetail's Python ones."""
+
+    def test_items_to_packed_and_back(self):
+        self.make_batch('Crate', 24, stock_items=0)
+        self.make_batch('Crate', 24, stock_items=23)
+        rows = ProductDetail.objects.annotate(
+            packed=ItemsToPacked('stock_items', 'items_per_master_unit'),
+        ).annotate(
+            items=PackedToItems('packed', 'items_per_master_unit'),
+        )
+        for batch in rows:
+            with self.subTest(batch=batch.packing_type, stock_items=batch.stock_items):
+                self.assertEqual(batch.packed, batch.stock)
+                self.assertEqual(batch.items, batch.stock_items)
+
+    def test_item_counts_aggregate_in_the_database(self):
+        sale = SalesTransaction.objects.create(user=self.user, status='COMPLETED')
+        with transaction.atomic():
+            finalize_sale_items(sale, [self.cart_line(self.carton, '1.11'), self.cart_line(self.pet, '0.05'), self.cart_line(self.carton, '0.01')])
+        SalesTransactionItem.objects.filter(product_detail_snapshot=self.pet).update(returned_quantity_decimal=Decimal('0.02'))
+
+        totals = SalesTransactionItem.objects.aggregate(
+            dispatched=Sum(PackedToItems('quantity_sold_decimal', 'items_per_master_unit_at_sale')),
+            returned=Sum(PackedToItems('returned_quantity_decimal', 'items_per_master_unit_at_sale')),
+        )
+        self.assertEqual(totals, {'dispatched': 23 + 5 + 1, 'returned': 2})
@@ -22,6 +22,9 @@ urlpatterns = [
    path('product-details/add-stock/<int:pk>/', views.add_stock_to_product_detail_view, name='add_stock_to_product_detail'),
    path('get-last-vehicle/', views.get_last_assigned_vehicle, name='get_last_vehicle'),
    path('stock_history', views.stock_history_view, name='product_detail_history'),
+   path('stock_history/export/', views.export_stock_history_csv, name='export_stock_history_csv'),
+   path('stock-as-of/', views.stock_as_of_view, name='stock_as_of'),
+   path('api/stock-as-of/', views.stock_as_of_api, name='stock_as_of_api'),
 
 
    #views about sales.................
@@ -33,6 +36,7 @@ urlpatterns = [
    path('sales/pending-deliveries/', views.pending_deliveries_view, name='pending_deliveries'),
    path('sales/process-delivery/<int:sale_pk>/', views.process_delivery_return_view, name='process_delivery_return'),
    path('process-all/<int:vehicle_id>/', views.process_all_pending_for_vehicle, name='process_all_pending_for_vehicle'),
+   path('api/route-returns/<int:vehicle_pk>/', views.submit_route_returns_api, name='submit_route_returns'),
    path('reports/sales/', views.sales_report_view, name='sales_report'),
 
 
@@ -40,6 +44,7 @@ urlpatterns = [
    path('sales/reverse/', views.reverse_sale_prompt_view, name='reverse_sale_prompt'),
    path('api/get-sale-info/<int:sale_id>/', views.get_sale_info, name='get_sale_info'),
    path('sales/reverse/<int:sale_id>/confirm/', views.confirm_reverse_sale, name='reverse_sale_confirm'),
+   path('sales/reverse/bulk/', views.bulk_reverse_sales_view, name='bulk_reverse_sales'),
 
 
    # Recipt view ...........
@@ -1,4 +1,22 @@
 from django.contrib.auth.models import User
+from django.db.models import F, Q, Sum, Count, Avg, Max, Min, Case, When, OuterRef, Subquery, Value, IntegerField, DateTimeField, DecimalField, ExpressionWrapper
+from django.db.models.functions import Coalesce, TruncDate
+from django.db import transaction
+from django.core.cache import cache
+from django.utils import timezone
+from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
+from datetime import datetime, time, timedelta
+from contextlib import contextmanager
+from contextvars import ContextVar
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from fractions import Fraction
+from .models import ProductDetail, SalesTransaction, SalesTransactionItem, StockMovement, StockCheckpoint, SalesDailyRollup, Shop, Vehicle
+from .expressions import PackedToItems, ItemsToPacked
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
 
 def authenticate(email, password):
     try:
@@ -8,4 +26,1424 @@ def authenticate(email, password):
         else:
             return None
     except User.DoesNotExist:
-        return None
\ No newline at end of file
+        return None
+
+
+# --- Stock service ---------------------------------------------------------------
+# ProductDetail.stock_items is the authoritative on-hand count. Every sale, return
+# and claim goes through these helpers so the change is one conditional UPDATE
+# executed by the database, with no read-modify-write round trip in Python.
+
+
+def take_stock_items(product_detail_id, items, reason=StockMovement.ADJUSTMENT, **source):
+    """
+    Removes `items` individual items from a batch.
+    Runs `UPDATE ... SET stock_items = stock_items - n WHERE stock_items >= n`
+    and returns False (changing nothing) when the batch does not hold enough stock.
+    A successful change is logged as a StockMovement with `reason` and `source`.
+    """
+    if items <= 0:
+        return True
+    updated = ProductDetail.objects.filter(
+        pk=product_detail_id, stock_items__gte=items
+    ).update(stock_items=F('stock_items') - items, updated_at=timezone.now())
+    if updated != 1:
+        return False
+    log_stock_movement(product_detail_id, -items, reason, **source)
+    return True
+
+
+def take_stock_items_many(items_by_batch, reason=StockMovement.ADJUSTMENT, **source):
+    """
+    take_stock_items for several batches in one statement:
+    `UPDATE ... SET stock_items = stock_items - CASE pk WHEN .. THEN n .. END
+    WHERE pk IN (..) AND stock_items >= CASE pk WHEN .. THEN n .. END`.
+    Either every batch is changed or none is: when one of them is short the
+    statement is rolled back to a savepoint and InsufficientStock names the batches.
+    """
+    wanted = {pk: items for pk, items in items_by_batch.items() if items > 0}
+    if not wanted:
+        return
+    needed = Case(*[When(pk=pk, then=Value(items)) for pk, items in wanted.items()], output_field=IntegerField())
+    try:
+        with transaction.atomic():
+            updated = ProductDetail.objects.filter(pk__in=wanted, stock_items__gte=needed).update(
+                stock_items=F('stock_items') - needed, updated_at=timezone.now()
+            )
+            if updated != len(wanted):
+                raise InsufficientStock()
+    except InsufficientStock:
+        short = ProductDetail.objects.select_related('product_base').filter(pk__in=wanted, stock_items__lt=needed)
+        raise InsufficientStock(
+            "Not enough stock for " + ", ".join(f"{batch} (has {batch.stock_items} items, needs {wanted[batch.pk]})" for batch in short) + "."
+        )
+    log_stock_movements([
+        StockMovement(product_detail_id=pk, delta_items=-items, reason=reason, **source)
+        for pk, items in wanted.items()
+    ])
+
+
+def put_stock_items(product_detail_id, items, reason=StockMovement.ADJUSTMENT, **source):
+    """Adds `items` individual items back to a batch (returns, claims, reversals)."""
+    if items <= 0:
+        return True
+    updated = ProductDetail.objects.filter(pk=product_detail_id).update(
+        stock_items=F('stock_items') + items, updated_at=timezone.now()
+    )
+    if updated != 1:
+        return False
+    log_stock_movement(product_detail_id, items, reason, **source)
+    return True
+
+
+# --- Stock movement ledger ----------------------------------------------------------
+# Every stock change appends a StockMovement row. Inside `with batched_movements():`
+# the rows are collected and written with a single bulk_create when the block exits,
+# which must happen inside the same transaction.atomic() as the stock changes.
+
+_pending_movements = ContextVar('pending_movements', default=None)
+
+
+@contextmanager
+def batched_movements():
+    """
+    Collects StockMovement rows and bulk inserts them on successful exit.
+    Nested blocks join the outermost one. Nothing is written if the block raises.
+    """
+    pending = _pending_movements.get()
+    if pending is not None:
+        yield pending
+        return
+
+    pending = []
+    token = _pending_movements.set(pending)
+    try:
+        yield pending
+    finally:
+        _pending_movements.reset(token)
+    if pending:
+        StockMovement.objects.bulk_create(pending)
+
+
+def log_stock_movement(product_detail_id, delta_items, reason, sales_transaction=None, claim=None):
+    """Appends one movement, either to the active batched_movements() block or straight to the table."""
+    if not delta_items:
+        return
+    log_stock_movements([StockMovement(
+        product_detail_id=product_detail_id,
+        delta_items=delta_items,
+        reason=reason,
+        sales_transaction=sales_transaction,
+        claim=claim,
+    )])
+
+
+def log_stock_movements(movements):
+    pending = _pending_movements.get()
+    if pending is None:
+        StockMovement.objects.bulk_create(movements)
+    else:
+        pending.extend(movements)
+
+
+def ledger_stock_items(product_detail_ids):
+    """
+    Rebuilds stock on hand from the ledger: {product_detail_id: SUM(delta_items)},
+    one aggregate over the (product_detail, created_at) index.
+    """
+    return dict(
+        StockMovement.objects.filter(product_detail_id__in=product_detail_ids)
+        .order_by()
+        .values('product_detail_id')
+        .annotate(total=Sum('delta_items'))
+        .values_list('product_detail_id', 'total')
+    )
+
+
+
+# --- FEFO allocation ---------------------------------------------------------------
+# Batches of the same product/packing are interchangeable on the shelf, so instead
+# of the cashier hunting for the right batch the quantity is taken from the batches
+# that expire first. The lookup is served by ProductDetail's 'productdetail_fefo_idx'.
+
+
+class InsufficientStock(Exception):
+    pass
+
+
+FEFO_GROUP_FIELDS = ('user_id', 'product_base_id', 'packing_type', 'quantity_in_packing', 'unit_of_measure', 'items_per_master_unit')
+
+
+def fefo_group_key(batch):
+    """The fields that make two batches interchangeable for FEFO allocation."""
+    return tuple(getattr(batch, field) for field in FEFO_GROUP_FIELDS)
+
+
+def fefo_batches(template_batch):
+    """All in-stock batches interchangeable with `template_batch`, earliest expiry first."""
+    return ProductDetail.objects.filter(
+        **{field: getattr(template_batch, field) for field in FEFO_GROUP_FIELDS},
+        stock_items__gt=0,
+    ).order_by('expirey_date', 'pk')
+
+
+def fefo_available_items(template_batch):
+    """Total individual items on hand across every batch `allocate_fefo` could draw from."""
+    return fefo_batches(template_batch).aggregate(total=Sum('stock_items'))['total'] or 0
+
+
+def allocate_fefo_many(requests, taken=None, lock=False):
+    """
+    Allocates several (template_batch, items_needed) requests in one pass and returns
+    one list of (batch, items) pairs per request, in request order.
+    The candidate batches of every product/packing group are read with one query and
+    drawn down from a shared in-memory map, so two requests for the same group never
+    allocate the same items. `taken` ({batch_pk: items}) is stock already claimed by
+    other lines of the same cart. With lock=True the candidate rows are read with
+    select_for_update. Raises InsufficientStock for the first request that cannot be met.
+    Stock is not changed here; callers record and apply the allocation.
+    """
+    if not requests:
+        return []
+    group_filter = Q()
+    for key in {fefo_group_key(template_batch) for template_batch, _ in requests}:
+        group_filter |= Q(**dict(zip(FEFO_GROUP_FIELDS, key)))
+    candidates = ProductDetail.objects.filter(group_filter, stock_items__gt=0).order_by('expirey_date', 'pk')
+    if lock:
+        candidates = candidates.select_for_update()
+
+    taken = taken or {}
+    groups = defaultdict(list)
+    remaining = {}
+    for batch in candidates:
+        groups[fefo_group_key(batch)].append(batch)
+        remaining[batch.pk] = batch.stock_items - taken.get(batch.pk, 0)
+
+    results = []
+    for template_batch, items_needed in requests:
+        allocations = []
+        still_needed = items_needed
+        for batch in groups[fefo_group_key(template_batch)]:
+            if still_needed <= 0:
+                break
+            items = min(remaining[batch.pk], still_needed)
+            if items <= 0:
+                continue
+            allocations.append((batch, items))
+            remaining[batch.pk] -= items
+            still_needed -= items
+
+        if still_needed > 0:
+            raise InsufficientStock(
+                f"Not enough stock for {template_batch.product_base.name} {template_batch.quantity_in_packing} "
+                f"{template_batch.unit_of_measure}. Short by {still_needed} items across all batches."
+            )
+        results.append(allocations)
+    return results
+
+
+def allocate_fefo(template_batch, items_needed, lock=True):
+    """
+    Splits `items_needed` individual items across the batches of `template_batch`'s
+    product/packing in expiry order and returns a list of (batch, items) pairs.
+    With lock=True the candidate rows are read with one select_for_update, so the
+    result stays valid until the surrounding transaction.atomic() block ends.
+    Raises InsufficientStock when the batches together do not hold enough stock.
+    """
+    return allocate_fefo_many([(template_batch, items_needed)], lock=lock)[0]
+
+
+def expand_fefo_cart_items(cart_items):
+    """
+    Replaces every sale cart line flagged 'allocation': 'FEFO' with one line per
+    batch consumed, so each batch gets its own SalesTransactionItem with its own
+    expiry and cost price. The cart's batches are read with one query and every
+    FEFO line is allocated in a single pass, after the stock that explicit-batch
+    lines take, so lines never allocate the same items twice. The candidate batches
+    are read with select_for_update, so a concurrent sale waits instead of being given
+    the same expiring items. Must be called inside transaction.atomic().
+    """
+    fefo_lines = [item_data for item_data in cart_items if item_data.get('allocation') == 'FEFO']
+    if not fefo_lines:
+        return cart_items
+
+    batches = ProductDetail.objects.select_related('product_base').in_bulk(
+        {int(item_data['product_detail_id']) for item_data in cart_items}
+    )
+    taken = defaultdict(int)
+    requests = []
+    for item_data in cart_items:
+        batch = batches.get(int(item_data['product_detail_id']))
+        if batch is None:
+            raise ProductDetail.DoesNotExist("A product batch in the transaction no longer exists.")
+        items = batch._get_items_from_decimal(Decimal(item_data['quantity_decimal']))
+        if item_data.get('allocation') == 'FEFO':
+            requests.append((batch, items))
+        else:
+            taken[batch.pk] += items
+
+    allocations = iter(allocate_fefo_many(requests, taken=taken, lock=True))
+    expanded = []
+    for item_data in cart_items:
+        if item_data.get('allocation') != 'FEFO':
+            expanded.append(item_data)
+            continue
+        for batch, items in next(allocations):
+            expanded.append({
+                **item_data,
+                'product_detail_id': batch.pk,
+                'quantity_decimal': str(batch._get_decimal_from_items(items)),
+                'cost_price_per_item': str(batch.price_per_item),
+                'allocation': None,
+            })
+    return expanded
+
+
+def finalize_sale_items(sales_transaction, cart_items):
+    """
+    Bulk finalize engine for a multi-item sale.
+
+    `cart_items` are the session cart dicts built by sales_processing_view. The batches
+    are read with one query, the items are written with bulk_create and the header
+    totals are computed once, so the query count does not grow with the cart. Stock
+    is taken with take_stock_items_many: one conditional UPDATE for every batch, so a
+    short batch fails the sale. FEFO cart lines are expanded into per-batch lines
+    first, with their candidate batches locked.
+    Must be called inside transaction.atomic().
+    """
+    cart_items = expand_fefo_cart_items(cart_items)
+    batch_ids = sorted({int(item_data['product_detail_id']) for item_data in cart_items})
+    batches = ProductDetail.objects.in_bulk(batch_ids)
+    if len(batches) != len(batch_ids):
+        raise ProductDetail.DoesNotExist("A product batch in the transaction no longer exists.")
+
+    line_items = []
+    items_needed = defaultdict(int)
+    for item_data in cart_items:
+        batch = batches[int(item_data['product_detail_id'])]
+        quantity_decimal = Decimal(item_data['quantity_decimal'])
+        items_needed[batch.pk] += batch._get_items_from_decimal(quantity_decimal)
+
+        line_item = SalesTransactionItem(
+            transaction=sales_transaction,
+            product_detail_snapshot=batch,
+            quantity_sold_decimal=quantity_decimal,
+            selling_price_per_item=Decimal(item_data['selling_price_per_item']),
+            cost_price_per_item_at_sale=Decimal(item_data['cost_price_per_item']),
+            expiry_date_at_sale=batch.expirey_date,
+            items_per_master_unit_at_sale=batch.items_per_master_unit,
+        )
+        line_item.set_dispatched_totals()
+        line_items.append(line_item)
+
+    try:
+        take_stock_items_many(items_needed, StockMovement.SALE, sales_transaction=sales_transaction)
+    except InsufficientStock as e:
+        raise Exception(f"Stock update failed. {e} Transaction rolled back.")
+
+    # Lines are inserted in cart order, which is also their pk order.
+    sales_transaction.allocate_line_totals(line_items)
+    SalesTransactionItem.objects.bulk_create(line_items)
+
+    # Nothing has been returned yet, so the dispatched totals are the sold totals.
+    gross_subtotal = sum((line.total_item_dispatched_revenue for line in line_items), Decimal('0.00'))
+    sales_transaction.grand_total_revenue = gross_subtotal - (sales_transaction.total_discount_amount or Decimal('0.00'))
+    sales_transaction.grand_total_cost = sum((line.total_item_dispatched_cost for line in line_items), Decimal('0.00'))
+    sales_transaction.save(update_fields=['grand_total_revenue', 'grand_total_cost', 'total_discount_amount'])
+    refresh_sales_rollup_for([sales_transaction])
+    return line_items
+
+
+
+# --- Deferred grand totals -------------------------------------------------------
+# SalesTransactionItem.save() normally recomputes its header on every save. Inside
+# `with deferred_totals():` the headers are collected instead and each one is
+# recomputed exactly once when the block exits successfully.
+
+_pending_grand_totals = ContextVar('pending_grand_totals', default=None)
+
+
+@contextmanager
+def deferred_totals():
+    """
+    Unit of work for SalesTransactionItem writes.
+
+        with deferred_totals():
+            for item in items:
+                item.save()   # header is only queued here
+
+    Nested blocks join the outermost one. Nothing is recomputed if the block raises.
+    """
+    pending = _pending_grand_totals.get()
+    if pending is not None:
+        yield pending
+        return
+
+    pending = {}
+    token = _pending_grand_totals.set(pending)
+    try:
+        yield pending
+    finally:
+        _pending_grand_totals.reset(token)
+    for sales_transaction in pending.values():
+        sales_transaction.update_grand_totals()
+
+
+def defer_grand_totals(sales_transaction):
+    """
+    Queues a header for recomputation if a deferred_totals() block is active.
+    The most recently queued instance for a pk wins, so callers can queue their
+    own copy (e.g. with a new discount set) after the item saves.
+    Returns False when there is no active block.
+    """
+    pending = _pending_grand_totals.get()
+    if pending is None:
+        return False
+    pending[sales_transaction.pk] = sales_transaction
+    return True
+
+
+# --- Daily sales rollup ---------------------------------------------------------------
+# SalesDailyRollup rows are derived data, maintained incrementally. Every sale write
+# (finalize, delivery return, settlement, reversal, delete) reads the contribution of
+# the transactions it touches before and after the write and applies only the
+# difference to the affected rows, inside the caller's DB transaction. The cost is
+# proportional to the transactions written, not to the day's other sales.
+
+def allocate_by_weight(amount, weights):
+    """
+    Splits a 2-decimal `amount` over `weights` proportionally. Cents lost to rounding
+    go to the largest remainders (earliest first on ties), so the parts always add
+    up to `amount` and the same inputs always give the same split.
+    """
+    if not weights:
+        return []
+    if sum(weights) <= 0:
+        weights = [1] * len(weights)
+    cents = int((Decimal(amount) * 100).to_integral_value(ROUND_HALF_UP))
+    sign = -1 if cents < 0 else 1
+    cents = abs(cents)
+
+    total_weight = sum(Fraction(weight) for weight in weights)
+    shares = [Fraction(cents) * Fraction(weight) / total_weight for weight in weights]
+    parts = [int(share) for share in shares]
+    leftover = cents - sum(parts)
+    by_remainder = sorted(range(len(shares)), key=lambda index: (-(shares[index] - parts[index]), index))
+    for index in by_remainder[:leftover]:
+        parts[index] += 1
+    return [Decimal(sign * part) / 100 for part in parts]
+
+
+def iter_allocated_sale_lines(items_queryset, chunk_size=2000):
+    """
+    Streams SalesTransactionItem rows once, ordered by transaction, as dicts with the
+    line's item counts, revenue and cost after returns, plus its share of the header's
+    discount and cash/online/credit split (see allocate_by_weight). Each transaction is
+    allocated exactly once, when its last line has been read.
+    """
+    lines = (
+        items_queryset
+        .annotate(
+            business_date=TruncDate('transaction__transaction_time'),
+            dispatched=PackedToItems('quantity_sold_decimal', 'items_per_master_unit_at_sale'),
+            returned=PackedToItems('returned_quantity_decimal', 'items_per_master_unit_at_sale'),
+        )
+        .order_by('transaction_id', 'pk')
+        .values(
+            'transaction_id', 'business_date', 'transaction__user_id', 'transaction__assigned_vehicle_id',
+            'transaction__customer_shop_id', 'product_detail_snapshot_id',
+            'items_per_master_unit_at_sale', 'dispatched', 'returned', 'selling_price_per_item', 'cost_price_per_item_at_sale',
+            'transaction__total_discount_amount', 'transaction__amount_paid_cash',
+            'transaction__amount_paid_online', 'transaction__amount_on_credit',
+        )
+        .iterator(chunk_size=chunk_size)
+    )
+
+    header_fields = {
+        'discount': 'transaction__total_discount_amount',
+        'paid_cash': 'transaction__amount_paid_cash',
+        'paid_online': 'transaction__amount_paid_online',
+        'on_credit': 'transaction__amount_on_credit',
+    }
+    for transaction_id, transaction_lines in groupby(lines, key=itemgetter('transaction_id')):
+        transaction_lines = list(transaction_lines)
+        for line in transaction_lines:
+            line['items_sold'] = line['dispatched'] - line['returned']
+            line['revenue'] = (Decimal(line['items_sold']) * line['selling_price_per_item']).quantize(Decimal('0.01'))
+            line['cost'] = (Decimal(line['items_sold']) * line['cost_price_per_item_at_sale']).quantize(Decimal('0.01'))
+
+        weights = [line['revenue'] for line in transaction_lines]
+        header = transaction_lines[0]
+        for field, source in header_fields.items():
+            for line, share in zip(transaction_lines, allocate_by_weight(header[source] or Decimal('0.00'), weights)):
+                line[field] = share
+        yield from transaction_lines
+
+
+def _rollup_contributions(items_queryset):
+    """{rollup grouping tuple: [measure totals in MEASURE_FIELDS order]} for these items."""
+    contributions = {}
+    first_lines = set()
+    for line in iter_allocated_sale_lines(items_queryset):
+        key = (
+            line['transaction__user_id'], line['business_date'], line['transaction__assigned_vehicle_id'],
+            line['transaction__customer_shop_id'], line['product_detail_snapshot_id'], line['items_per_master_unit_at_sale'],
+        )
+        values = (
+            0 if line['transaction_id'] in first_lines else 1, 1,
+            line['dispatched'], line['returned'], line['items_sold'],
+            line['revenue'], line['cost'], line['discount'], line['paid_cash'], line['paid_online'], line['on_credit'],
+        )
+        first_lines.add(line['transaction_id'])
+        totals = contributions.get(key)
+        contributions[key] = list(values) if totals is None else [total + value for total, value in zip(totals, values)]
+    return contributions
+
+
+def sales_rollup_contributions(sales_transactions):
+    """
+    The current rollup contribution of `sales_transactions`, one pass over their items.
+    Take it before writing to them and pass it to refresh_sales_rollup_for afterwards.
+    """
+    transaction_ids = [sales_transaction.pk for sales_transaction in sales_transactions if sales_transaction.pk]
+    if not transaction_ids:
+        return {}
+    return _rollup_contributions(SalesTransactionItem.objects.filter(transaction_id__in=transaction_ids))
+
+
+def apply_sales_rollup_deltas(deltas):
+    """
+    Adds {grouping tuple: [measure deltas]} to SalesDailyRollup. Missing rows are
+    inserted first (ignoring ones another writer just created), then the affected rows
+    are locked in key order, incremented in memory and written back with one
+    bulk_update. Rows left without any line are deleted.
+    """
+    deltas = {
+        SalesDailyRollup.make_key(*key): (key, values)
+        for key, values in deltas.items() if any(values)
+    }
+    if not deltas:
+        return
+    SalesDailyRollup.objects.bulk_create(
+        [SalesDailyRollup(rollup_key=rollup_key, **dict(zip(SalesDailyRollup.GROUPING_FIELDS, key))) for rollup_key, (key, _) in deltas.items()],
+        ignore_conflicts=True,
+    )
+    rows = list(SalesDailyRollup.objects.select_for_update().filter(rollup_key__in=deltas).order_by('rollup_key'))
+    now = timezone.now()
+    emptied = []
+    for row in rows:
+        for field, value in zip(SalesDailyRollup.MEASURE_FIELDS, deltas[row.rollup_key][1]):
+            setattr(row, field, getattr(row, field) + value)
+        row.updated_at = now
+        if row.lines_count <= 0:
+            emptied.append(row.pk)
+    SalesDailyRollup.objects.bulk_update(rows, SalesDailyRollup.MEASURE_FIELDS + ('updated_at',), batch_size=500)
+    if emptied:
+        SalesDailyRollup.objects.filter(pk__in=emptied).delete()
+
+
+def refresh_sales_rollup(user_id, business_days):
+    """
+    Rebuilds a user's SalesDailyRollup rows for the given local dates from scratch.
+    Only used to repair drift (rebuild_sales_rollup); sale writes go through
+    refresh_sales_rollup_for. Returns the row count.
+    """
+    business_days = sorted(set(business_days))
+    if user_id is None or not business_days:
+        return 0
+
+    contributions = _rollup_contributions(SalesTransactionItem.objects.filter(
+        transaction__user_id=user_id, transaction__transaction_time__date__in=business_days
+    ))
+    rollups = []
+    for key, values in contributions.items():
+        rollup = SalesDailyRollup(rollup_key=SalesDailyRollup.make_key(*key), **dict(zip(SalesDailyRollup.GROUPING_FIELDS, key)))
+        for field, value in zip(SalesDailyRollup.MEASURE_FIELDS, values):
+            setattr(rollup, field, value)
+        rollups.append(rollup)
+
+    with transaction.atomic():
+        SalesDailyRollup.objects.filter(user_id=user_id, business_date__in=business_days).delete()
+        SalesDailyRollup.objects.bulk_create(rollups, batch_size=500)
+    return len(rollups)
+
+
+def refresh_sales_rollup_for(sales_transactions, before=None):
+    """
+    Applies the change in the rollup contribution of `sales_transactions` since `before`
+    (from sales_rollup_contributions, taken before the write; None for new sales) and
+    drops the cached shop leaderboard and vehicle loading sheets they affect.
+    Deleted transactions simply contribute nothing any more.
+    """
+    sales_transactions = list(sales_transactions)
+    deltas = sales_rollup_contributions(sales_transactions)
+    for key, values in (before or {}).items():
+        current = deltas.get(key, [0] * len(values))
+        deltas[key] = [after - old for after, old in zip(current, values)]
+    apply_sales_rollup_deltas(deltas)
+
+    for user_id in {sales_transaction.user_id for sales_transaction in sales_transactions if sales_transaction.customer_shop_id}:
+        invalidate_shop_leaderboard(user_id)
+    for vehicle_id in {sales_transaction.assigned_vehicle_id for sales_transaction in sales_transactions if sales_transaction.assigned_vehicle_id}:
+        invalidate_loading_sheet(vehicle_id)
+
+
+@contextmanager
+def sales_rollup_tracked(sales_transactions):
+    """
+    Keeps SalesDailyRollup in step with writes to `sales_transactions` made inside
+    the block: their contribution is read on entry and the difference is applied on
+    successful exit. Use it inside the write's transaction.atomic().
+    """
+    sales_transactions = list(sales_transactions)
+    before = sales_rollup_contributions(sales_transactions)
+    yield
+    refresh_sales_rollup_for(sales_transactions, before)
+
+
+# --- Shop leaderboard ---------------------------------------------------------------
+# One grouped query over SalesDailyRollup, cached per user. Every sale write goes through
+# refresh_sales_rollup_for, which drops the cached copy when a shop sale changes; the bulk
+# settlement and reversal paths drop it for their user as well, and Shop.save/delete
+# whenever a shop (or its is_active flag) changes.
+
+SHOP_LEADERBOARD_CACHE_SECONDS = 60 * 60
+
+
+def _shop_leaderboard_cache_key(user_id):
+    return f'stock:shop_leaderboard:{user_id}'
+
+
+def invalidate_shop_leaderboard(user_id):
+    cache_key = _shop_leaderboard_cache_key(user_id)
+    cache.delete(cache_key)
+    # Again after commit, in case another request cached the old rows meanwhile.
+    transaction.on_commit(lambda: cache.delete(cache_key))
+
+
+def shop_leaderboard(user):
+    """
+    Active shops with sales revenue for `user`, as dicts with sales_count, total_revenue,
+    total_profit, last_purchase (business date) and average_ticket, highest revenue first.
+    """
+    cache_key = _shop_leaderboard_cache_key(user.pk)
+    rows = cache.get(cache_key)
+    if rows is not None:
+        return rows
+
+    net_revenue = F('revenue') - F('discount')
+    totals = (
+        SalesDailyRollup.objects.filter(user=user, shop__user=user, shop__is_active=True)
+        .values('shop_id', 'shop__name', 'shop__location_address')
+        .annotate(
+            sales_count=Sum('sales_count'),
+            total_revenue=Sum(net_revenue),
+            total_profit=Sum(net_revenue - F('cost'), output_field=DecimalField(max_digits=14, decimal_places=2)),
+            last_purchase=Max('business_date'),
+        )
+        .filter(total_revenue__gt=0)
+        .order_by('-total_revenue', 'shop__name')
+    )
+    rows = [
+        {
+            'pk': row['shop_id'],
+            'name': row['shop__name'],
+            'location_address': row['shop__location_address'],
+            'sales_count': row['sales_count'],
+            'total_revenue': row['total_revenue'],
+            'total_profit': row['total_profit'],
+            'average_ticket': (row['total_revenue'] / row['sales_count']).quantize(Decimal('0.01')) if row['sales_count'] else None,
+            'last_purchase': row['last_purchase'],
+        }
+        for row in totals
+    ]
+    cache.set(cache_key, rows, SHOP_LEADERBOARD_CACHE_SECONDS)
+    return rows
+
+
+# --- Vehicle loading sheets -------------------------------------------------------------
+# Per-vehicle totals of everything still PENDING_DELIVERY: quantities per batch (as item
+# counts summed in SQL) plus the invoice and payment totals. Cached per vehicle and
+# dropped by refresh_sales_rollup_for whenever one of the vehicle's sales changes.
+
+LOADING_SHEET_CACHE_SECONDS = 60 * 60 * 12
+
+
+def _loading_sheet_cache_key(vehicle_id):
+    return f'stock:loading_sheet:{vehicle_id}'
+
+
+def invalidate_loading_sheet(vehicle_id):
+    cache_key = _loading_sheet_cache_key(vehicle_id)
+    cache.delete(cache_key)
+    transaction.on_commit(lambda: cache.delete(cache_key))
+
+
+def _build_loading_sheets(user, vehicle_ids):
+    pending = SalesTransaction.objects.filter(
+        user=user, status='PENDING_DELIVERY', assigned_vehicle_id__in=vehicle_ids
+    )
+    sheets = {
+        row['assigned_vehicle_id']: {**row, 'items': []}
+        for row in pending.values('assigned_vehicle_id').annotate(
+            invoice_count=Count('id'),
+            total_revenue=Sum('grand_total_revenue'),
+            total_discount=Sum('total_discount_amount'),
+            total_credit=Sum('amount_on_credit'),
+            total_online=Sum('amount_paid_online'),
+        ).order_by()
+    }
+    for sheet in sheets.values():
+        sheet['remaining_amount'] = sheet['total_revenue'] - sheet['total_credit'] - sheet['total_online']
+
+    # Grouped and converted on the packing snapshotted at sale, like performance_summary,
+    # so a batch repacked since dispatch still adds up the items that were loaded.
+    ipmu = 'items_per_master_unit_at_sale'
+    batch_rows = (
+        SalesTransactionItem.objects.filter(transaction__in=pending)
+        .values(
+            'transaction__assigned_vehicle_id', 'product_detail_snapshot_id',
+            'product_detail_snapshot__product_base__name', 'product_detail_snapshot__quantity_in_packing',
+            'product_detail_snapshot__unit_of_measure', ipmu,
+        )
+        .annotate(
+            total_items=Sum(PackedToItems('quantity_sold_decimal', ipmu)),
+            returned_items=Sum(PackedToItems('returned_quantity_decimal', ipmu)),
+            increased_demand_items=Sum(PackedToItems('increased_demand', ipmu)),
+        )
+        .annotate(
+            total_quantity_decimal=ItemsToPacked(F('total_items'), ipmu),
+            returned_quantity_decimal=ItemsToPacked(F('returned_items'), ipmu),
+            increased_demand_decimal=ItemsToPacked(F('increased_demand_items'), ipmu),
+        )
+        .order_by('product_detail_snapshot__product_base__name', 'product_detail_snapshot_id')
+    )
+    for row in batch_rows:
+        sheets[row['transaction__assigned_vehicle_id']]['items'].append({
+            'product_detail_id': row['product_detail_snapshot_id'],
+            'product_name': row['product_detail_snapshot__product_base__name'],
+            'quantity_in_packing': row['product_detail_snapshot__quantity_in_packing'],
+            'unit_of_measure': row['product_detail_snapshot__unit_of_measure'],
+            'total_items': row['total_items'],
+            'returned_items': row['returned_items'],
+            'increased_demand_items': row['increased_demand_items'],
+            'total_quantity_decimal': row['total_quantity_decimal'],
+            'returned_quantity_decimal': row['returned_quantity_decimal'],
+            'increased_demand_decimal': row['increased_demand_decimal'],
+        })
+    return sheets
+
+
+def vehicle_loading_sheets(user):
+    """
+    [(vehicle, sheet)] for every vehicle with pending deliveries, ordered by vehicle number.
+    Sheets come from the cache where possible; the missing ones are built together.
+    """
+    vehicles = list(
+        Vehicle.objects.filter(user=user, assigned_sales_transactions__status='PENDING_DELIVERY')
+        .distinct().order_by('vehicle_number')
+    )
+    cached = cache.get_many([_loading_sheet_cache_key(vehicle.pk) for vehicle in vehicles])
+    sheets = {vehicle.pk: cached.get(_loading_sheet_cache_key(vehicle.pk)) for vehicle in vehicles}
+
+    missing = [vehicle_id for vehicle_id, sheet in sheets.items() if sheet is None]
+    if missing:
+        built = _build_loading_sheets(user, missing)
+        cache.set_many(
+            {_loading_sheet_cache_key(vehicle_id): sheet for vehicle_id, sheet in built.items()},
+            LOADING_SHEET_CACHE_SECONDS,
+        )
+        sheets.update(built)
+    return [(vehicle, sheets[vehicle.pk]) for vehicle in vehicles if sheets.get(vehicle.pk)]
+
+
+# --- Performance summary ----------------------------------------------------------------
+# Daily and monthly sales buckets for one vehicle (or the store), built from a single
+# pass over the SalesDailyRollup rows of the months shown on the current page.
+
+def items_to_packed(total_items, items_per_master_unit):
+    """ProductDetail._get_decimal_from_items for a given items_per_master_unit (e.g. a sale snapshot)."""
+    if total_items < 0 or not items_per_master_unit or items_per_master_unit <= 0:
+        return Decimal('0.00')
+    full_units, loose_items = divmod(total_items, items_per_master_unit)
+    return Decimal(full_units) + Decimal(loose_items) / Decimal(100)
+
+
+def performance_summary(rollup_queryset, days):
+    """
+    Returns (daily_summary, monthly_summary) for `days` (local dates, newest first) and
+    the whole months they fall in, in the shapes group_performance_summary.html expects.
+    `rollup_queryset` is the group's SalesDailyRollup rows.
+    """
+    if not days:
+        return [], []
+    months = sorted({day.replace(day=1) for day in days}, reverse=True)
+    next_month = (months[0].replace(day=28) + timedelta(days=4)).replace(day=1)
+    wanted_days = set(days)
+
+    daily = {day: {'revenue': Decimal('0.00'), 'credit': Decimal('0.00'), 'online': Decimal('0.00'), 'items': defaultdict(int)} for day in days}
+    monthly = {month: {'revenue': Decimal('0.00'), 'credit': Decimal('0.00'), 'online': Decimal('0.00'), 'items': defaultdict(int)} for month in months}
+
+    rows = (
+        rollup_queryset.filter(business_date__gte=months[-1], business_date__lt=next_month)
+        .order_by()
+        .values_list('business_date', 'product_detail_id', 'items_per_master_unit_at_sale', 'items_sold',
+                     'revenue', 'discount', 'on_credit', 'paid_online')
+    )
+    for business_date, product_detail_id, items_per_master_unit, items_sold, revenue, discount, on_credit, paid_online in rows:
+        buckets = [monthly[business_date.replace(day=1)]]
+        if business_date in wanted_days:
+            buckets.append(daily[business_date])
+        for bucket in buckets:
+            bucket['revenue'] += revenue - discount
+            bucket['credit'] += on_credit
+            bucket['online'] += paid_online
+            # Items are counted per packing size at sale time, so a batch whose
+            # items_per_master_unit was edited later still converts back correctly.
+            bucket['items'][product_detail_id, items_per_master_unit] += items_sold
+
+    product_detail_ids = {pk for bucket in monthly.values() for pk, _ in bucket['items']}
+    product_details = ProductDetail.objects.in_bulk(product_detail_ids)
+
+    def quantity_breakdown(items_by_batch):
+        breakdown = [
+            {
+                'net_quantity': items_to_packed(total_items, items_per_master_unit),
+                'product_detail_snapshot__quantity_in_packing': product_details[pk].quantity_in_packing,
+                'product_detail_snapshot__unit_of_measure': product_details[pk].unit_of_measure,
+            }
+            for (pk, items_per_master_unit), total_items in items_by_batch.items() if total_items > 0
+        ]
+        return sorted(breakdown, key=lambda x: x['net_quantity'], reverse=True)
+
+    daily_summary = [
+        {
+            'day': day,
+            'total_revenue': bucket['revenue'],
+            'quantity_breakdown': quantity_breakdown(bucket['items']),
+            'credit_total': bucket['credit'],
+            'online_total': bucket['online'],
+        }
+        for day, bucket in daily.items()
+    ]
+    monthly_summary = [
+        {
+            'month': month,
+            'total_revenue': bucket['revenue'],
+            'quantity_breakdown': quantity_breakdown(bucket['items']),
+            'monthly_credit_total': bucket['credit'],
+            'monthly_online_total': bucket['online'],
+        }
+        for month, bucket in monthly.items()
+    ]
+    return daily_summary, monthly_summary
+
+
+# --- Point-in-time stock ------------------------------------------------------------
+# Stock at the end of a day = the batch's latest StockCheckpoint on or before that day
+# + the StockMovement deltas between the checkpoint's cutoff and the end of the day.
+# Both lookups are correlated subqueries on indexed (product_detail, ...) columns.
+
+LEDGER_START = timezone.make_aware(datetime(2000, 1, 1))
+
+
+def end_of_day(day):
+    """First instant of the following local day; movements before it belong to `day`."""
+    return timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+
+
+def with_stock_as_of(queryset, as_of):
+    """
+    Annotates a ProductDetail queryset with `stock_items_as_of`: the batch's stock
+    in individual items at the end of `as_of`.
+    """
+    cutoff = end_of_day(as_of)
+    latest_checkpoint = StockCheckpoint.objects.filter(
+        product_detail=OuterRef('pk'), as_of__lte=as_of
+    ).order_by('-as_of')
+    deltas_since_checkpoint = StockMovement.objects.filter(
+        product_detail=OuterRef('pk'),
+        created_at__gte=OuterRef('checkpoint_cutoff'),
+        created_at__lt=cutoff,
+    ).order_by().values('product_detail').annotate(total=Sum('delta_items')).values('total')
+
+    return queryset.annotate(
+        checkpoint_items=Coalesce(Subquery(latest_checkpoint.values('stock_items')[:1]), Value(0)),
+        checkpoint_cutoff=Coalesce(
+            Subquery(latest_checkpoint.values('cutoff')[:1]), Value(LEDGER_START), output_field=DateTimeField()
+        ),
+    ).annotate(
+        stock_items_as_of=F('checkpoint_items') + Coalesce(Subquery(deltas_since_checkpoint, output_field=IntegerField()), Value(0)),
+    )
+
+
+def stock_as_of(user, as_of, product_detail_ids=None):
+    """{product_detail_id: stock items at the end of `as_of`} for a user's batches."""
+    batches = ProductDetail.objects.filter(user=user)
+    if product_detail_ids is not None:
+        batches = batches.filter(pk__in=product_detail_ids)
+    return dict(with_stock_as_of(batches.order_by(), as_of).values_list('pk', 'stock_items_as_of'))
+
+
+def create_stock_checkpoints(as_of, users=None):
+    """
+    Writes (or refreshes) a StockCheckpoint for every batch at the end of `as_of`,
+    computed from the previous checkpoint plus the deltas since. Returns the row count.
+    """
+    cutoff = end_of_day(as_of)
+    if cutoff > timezone.now():
+        # Movements could still arrive for a day that has not ended yet.
+        raise ValueError(f"Cannot checkpoint {as_of}: the day has not ended yet.")
+
+    batches = ProductDetail.objects.all()
+    if users is not None:
+        batches = batches.filter(user__in=users)
+    with transaction.atomic():
+        # Drop the day's old rows first so they are not used as the base for the new ones.
+        StockCheckpoint.objects.filter(product_detail__in=batches, as_of=as_of).delete()
+        checkpoints = [
+            StockCheckpoint(product_detail_id=pk, as_of=as_of, cutoff=cutoff, stock_items=items)
+            for pk, items in with_stock_as_of(batches.order_by(), as_of).values_list('pk', 'stock_items_as_of').iterator()
+        ]
+        StockCheckpoint.objects.bulk_create(checkpoints, batch_size=500)
+    return len(checkpoints)
+
+
+# --- Sales export -------------------------------------------------------------------
+
+def sales_export_rows(transactions_list):
+    """
+    Yields the header and then one row per sold item (or one per transaction without items).
+    The LEFT JOIN to items is read as flat tuples in chunks; no model instances are built.
+    """
+    yield [
+        "Tx ID", "Date", "Time", "Customer", "Payment", "Status",
+        "Total Revenue", "Total Profit", "Notes",  # Transaction-level info
+        "Product Name", "Price Per Unit", "Quantity Sold", "Returned", "Discount", "Unit", # Item-level info
+    ]
+    payment_labels = dict(SalesTransaction.PAYMENT_TYPE_CHOICES)
+    status_labels = dict(SalesTransaction.SALE_STATUS_CHOICES)
+    rows = transactions_list.order_by('-transaction_time', '-pk', 'items__id').values_list(
+        'pk', 'transaction_time', 'customer_shop__name', 'customer_name_manual', 'payment_type', 'status',
+        'grand_total_revenue', 'grand_total_cost', 'notes', 'total_discount_amount',
+        'items__id', 'items__product_detail_snapshot__product_base__name', 'items__selling_price_per_item',
+        'items__quantity_sold_decimal', 'items__returned_quantity_decimal',
+        'items__product_detail_snapshot__quantity_in_packing', 'items__product_detail_snapshot__unit_of_measure',
+    ).iterator(chunk_size=2000)
+
+    for (pk, transaction_time, shop_name, manual_name, payment_type, status, revenue, cost, notes, discount,
+         item_id, product_name, price, quantity_sold, returned, quantity_in_packing, unit) in rows:
+        local_time = timezone.localtime(transaction_time)
+        row = [
+            pk,
+            local_time.date(),
+            local_time.strftime('%H:%M:%S'),
+            shop_name or manual_name or "N/A",
+            payment_labels.get(payment_type, payment_type),
+            status_labels.get(status, status),
+            revenue,
+            revenue - cost,
+            notes,
+        ]
+        if item_id is not None:
+            row += [product_name, price, quantity_sold, returned, f'{discount}', f'{quantity_in_packing} {unit}']
+        yield row
+
+
+def filter_sales_for_export(user, ids=None, start_date=None, end_date=None):
+    """The export's queryset: either the comma-separated `ids`, or a date range (one day if only start_date)."""
+    transactions_list = SalesTransaction.objects.filter(user=user)
+    if ids:
+        # Convert comma-separated string of IDs to a list of integers
+        ids_list = [int(id_str) for id_str in ids.split(',') if id_str.isdigit()]
+        if ids_list:
+            transactions_list = transactions_list.filter(pk__in=ids_list)
+    elif start_date and not end_date:
+        transactions_list = transactions_list.filter(transaction_time__date=start_date)
+    else:
+        if start_date:
+            transactions_list = transactions_list.filter(transaction_time__date__gte=start_date)
+        if end_date:
+            transactions_list = transactions_list.filter(transaction_time__date__lte=end_date)
+    return transactions_list
+
+
+def write_sales_workbook(transactions_list, output):
+    """
+    Writes the sales export as .xlsx to `output` (a path or binary file).
+    Write-only workbooks spool rows to disk, so memory stays flat for any range.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sales Report")
+    bold_font = Font(bold=True)
+    for row_number, row in enumerate(sales_export_rows(transactions_list)):
+        if row_number == 0:
+            header = []
+            for title in row:
+                cell = WriteOnlyCell(ws, value=title)
+                cell.font = bold_font
+                header.append(cell)
+            row = header
+        ws.append(row)
+    wb.save(output)
+
+
+# --- Period reporting -------------------------------------------------------------
+# The sales report shows today / this week / this month / this year side by side.
+# Each source table is scanned once over the union of those ranges and every
+# period becomes a SUM(CASE WHEN ... ) column, so the query count is fixed.
+
+def sum_by_period(queryset, date_field, periods, measures):
+    """
+    periods: {name: (start_dt, end_dt)}; measures: {name: expression or field}.
+    Returns {period: {measure: total}} from a single aggregate query.
+    """
+    overall_start = min(start for start, _ in periods.values())
+    overall_end = max(end for _, end in periods.values())
+    queryset = queryset.filter(**{f'{date_field}__range': (overall_start, overall_end)})
+
+    aggregates = {}
+    for period, (start, end) in periods.items():
+        in_period = Q(**{f'{date_field}__range': (start, end)})
+        for measure, expression in measures.items():
+            if isinstance(expression, str):
+                expression = F(expression)
+            aggregates[f'{period}__{measure}'] = Sum(Case(
+                When(in_period, then=expression),
+                default=Value(0),
+                output_field=DecimalField(max_digits=16, decimal_places=2),
+            ))
+    totals = queryset.aggregate(**aggregates)
+    return {
+        period: {measure: (totals[f'{period}__{measure}'] or Decimal('0')).quantize(Decimal('0.01')) for measure in measures}
+        for period in periods
+    }
+
+
+def claim_loss_expression():
+    """
+    Cost of an EXCHANGED ClaimItem in SQL, the same figure as ClaimItem.total_cost.
+    Uses the packing snapshotted on the claim item, not the batch's current one.
+    """
+    return ExpressionWrapper(
+        PackedToItems('quantity_decimal', 'items_per_master_unit_at_claim') * F('cost_price_at_claim'),
+        output_field=DecimalField(max_digits=16, decimal_places=2),
+    )
+
+
+# --- Vehicle settlement ---------------------------------------------------------------
+# Settling a truck touches every pending sale on it at once, so the work is done in
+# bulk: the batches are locked once, stock changes are netted per batch, items and
+# headers go back with bulk_update and the shop ledger is rebalanced in one pass.
+
+
+def settle_pending_for_vehicle(user, vehicle):
+    """
+    Completes every PENDING_DELIVERY sale on `vehicle`: applies returns and increased
+    demand to stock, finalizes the payment split and syncs the shop ledger.
+    Runs as one transaction and returns the number of sales processed. The number of
+    statements does not grow with the number of invoices on the vehicle.
+    """
+    with transaction.atomic():
+        sales = list(
+            SalesTransaction.objects.select_for_update()
+            .filter(assigned_vehicle=vehicle, user=user, status='PENDING_DELIVERY')
+            .order_by('pk')
+            .prefetch_related('items')
+        )
+        if not sales:
+            return 0
+        rollup_before = sales_rollup_contributions(sales)
+
+        batch_ids = sorted({item.product_detail_snapshot_id for sale in sales for item in sale.items.all()})
+        # Locked in pk order, so two settlements never deadlock each other.
+        batches = {
+            batch.pk: batch
+            for batch in ProductDetail.objects.select_for_update().filter(pk__in=batch_ids).order_by('pk')
+        }
+        if len(batches) != len(batch_ids):
+            raise ProductDetail.DoesNotExist("A product batch on this vehicle no longer exists.")
+
+        stock_deltas = defaultdict(int)
+        movements = []
+        settled_items = []
+        for sale in sales:
+            items = sorted(sale.items.all(), key=lambda line: line.pk)
+            for item in items:
+                batch = batches[item.product_detail_snapshot_id]
+                dispatched_items = batch._get_items_from_decimal(item.quantity_sold_decimal or Decimal('0.00'))
+                returned_items = batch._get_items_from_decimal(item.returned_quantity_decimal or Decimal('0.00'))
+                increased_items = batch._get_items_from_decimal(item.increased_demand or Decimal('0.00'))
+
+                stock_deltas[batch.pk] += returned_items - increased_items
+                if returned_items > 0:
+                    movements.append(StockMovement(product_detail_id=batch.pk, delta_items=returned_items, reason=StockMovement.DELIVERY_RETURN, sales_transaction=sale))
+                if increased_items > 0:
+                    movements.append(StockMovement(product_detail_id=batch.pk, delta_items=-increased_items, reason=StockMovement.INCREASED_DEMAND, sales_transaction=sale))
+
+                # Sold quantity becomes original + increased demand.
+                item.quantity_sold_decimal = batch._get_decimal_from_items(dispatched_items + increased_items)
+                item.set_dispatched_totals()
+                settled_items.append(item)
+
+            sale.allocate_line_totals(items)
+            gross_subtotal = sum((item.gross_line_subtotal for item in items), Decimal('0.00'))
+            final_total = gross_subtotal - (sale.total_discount_amount or Decimal('0.00'))
+            sale.grand_total_revenue = final_total
+            sale.grand_total_cost = sum((item.total_item_cost for item in items), Decimal('0.00'))
+
+            if sale.payment_type == 'SPLIT':
+                cash = sale.amount_paid_cash or Decimal('0.00')
+                online = sale.amount_paid_online or Decimal('0.00')
+                credit = sale.amount_on_credit or Decimal('0.00')
+                sale.notes = f"Split Payment: Cash = Rs {cash:.2f}, Online = Rs {online:.2f}, Credit = Rs {credit:.2f}"
+            else:
+                cash = final_total if sale.payment_type == 'CASH' else Decimal('0.00')
+                online = final_total if sale.payment_type == 'ONLINE' else Decimal('0.00')
+                credit = final_total if sale.payment_type == 'CREDIT' else Decimal('0.00')
+                sale.notes = ""
+
+            sale.amount_paid_cash = cash
+            sale.amount_paid_online = online
+            sale.amount_on_credit = credit
+            sale.status = 'COMPLETED'
+            sale.is_ready_for_processing = False  # Reset manual flag
+
+        # One netted change per batch: returns on one invoice can cover extra demand on another.
+        now = timezone.now()
+        changed_batches = []
+        for batch_pk, delta in stock_deltas.items():
+            if not delta:
+                continue
+            batch = batches[batch_pk]
+            if batch.stock_items + delta < 0:
+                raise Exception(f"Not enough stock in {batch} for the increased demand on this vehicle.")
+            batch.stock_items += delta
+            batch.updated_at = now
+            changed_batches.append(batch)
+
+        ProductDetail.objects.bulk_update(changed_batches, ['stock_items', 'updated_at'])
+        log_stock_movements(movements)
+        SalesTransactionItem.objects.bulk_update(
+            settled_items,
+            ['quantity_sold_decimal', 'total_item_dispatched_revenue', 'total_item_dispatched_cost'] + SalesTransactionItem.LINE_TOTAL_FIELDS,
+            batch_size=500,
+        )
+        SalesTransaction.objects.bulk_update(
+            sales,
+            ['grand_total_revenue', 'grand_total_cost', 'amount_paid_cash', 'amount_paid_online',
+             'amount_on_credit', 'notes', 'status', 'is_ready_for_processing'],
+            batch_size=500,
+        )
+        _settle_credit_ledger(user, sales)
+        refresh_sales_rollup_for(sales, rollup_before)
+        invalidate_shop_leaderboard(user.pk)
+    return len(sales)
+
+
+def _settle_credit_ledger(user, sales):
+    """
+    Brings the CREDIT_SALE ledger rows of settled `sales` in line with their final
+    credit: amounts are updated, rows without credit are deleted and missing rows are
+    created, each in one statement. Every affected shop ledger is then rebalanced once,
+    from its earliest changed row onwards.
+    """
+    from accounts.models import ShopFinancialTransaction
+    from accounts.utils import recalc_shop_balances, lock_shop_ledgers
+
+    lock_shop_ledgers({sale.customer_shop_id for sale in sales if sale.customer_shop_id})
+    existing = {
+        entry.source_sale_id: entry
+        for entry in ShopFinancialTransaction.objects.filter(source_sale__in=sales).only('pk', 'shop_id', 'source_sale_id', 'transaction_date')
+    }
+    now = timezone.now()
+    changed_entries = []
+    obsolete_ids = []
+    new_entries = []
+    rebalance_from = {}
+
+    def touch(shop_id, when):
+        if shop_id is not None:
+            rebalance_from[shop_id] = min(when, rebalance_from.get(shop_id, when))
+
+    for sale in sales:
+        entry = existing.get(sale.pk)
+        if sale.amount_on_credit > 0 and sale.customer_shop_id:
+            if entry:
+                entry.debit_amount = sale.amount_on_credit
+                changed_entries.append(entry)
+                touch(entry.shop_id, entry.transaction_date)
+            else:
+                new_entries.append(ShopFinancialTransaction(
+                    shop_id=sale.customer_shop_id,
+                    user=user,
+                    source_sale=sale,
+                    transaction_type='CREDIT_SALE',
+                    debit_amount=sale.amount_on_credit,
+                    notes=f"Credit from Sale Transaction #{sale.pk}",
+                    transaction_date=now,
+                ))
+                touch(sale.customer_shop_id, now)
+        elif entry:
+            obsolete_ids.append(entry.pk)
+            touch(entry.shop_id, entry.transaction_date)
+
+    if obsolete_ids:
+        ShopFinancialTransaction.objects.filter(pk__in=obsolete_ids).delete()
+    ShopFinancialTransaction.objects.bulk_update(changed_entries, ['debit_amount'], batch_size=500)
+    ShopFinancialTransaction.objects.bulk_create(new_entries)
+    for shop_id, since in sorted(rebalance_from.items()):
+        recalc_shop_balances(shop_id, since=since)
+
+
+# --- Route return submission -----------------------------------------------------------
+# A driver checks in a whole route at once: returned quantities, increased demand and
+# the payment split for every invoice on the vehicle arrive in one payload. The route is
+# loaded with one prefetch, every invoice is validated in memory and nothing is written
+# unless all of them pass. Accepted invoices are left ready for settlement, exactly as
+# "mark as done" on process_delivery_return_view leaves a single invoice.
+
+# Only unsettled invoices. A PARTIALLY_RETURNED sale has already had its returns put back
+# into stock; reopening it as PENDING_DELIVERY would book them a second time on settlement.
+ROUTE_RETURN_STATUSES = ('PENDING_DELIVERY',)
+
+
+def _payload_decimal(data, key, errors, label):
+    value = data.get(key)
+    if value in (None, ''):
+        return Decimal('0.00')
+    try:
+        number = Decimal(str(value)).quantize(Decimal('0.01'))
+    except (InvalidOperation, ValueError):
+        errors.append(f"{label} must be a number.")
+        return Decimal('0.00')
+    if number < 0:
+        errors.append(f"{label} cannot be negative.")
+    return number
+
+
+def _apply_route_invoice(sale, data):
+    """
+    Applies one invoice of a route payload to `sale` and its prefetched items in memory.
+    Returns (items, final_total, errors); nothing is saved.
+    """
+    errors = []
+    items = {item.pk: item for item in sale.items.all()}
+    for line in data.get('items') or []:
+        try:
+            item = items[int(line.get('item_id'))]
+        except (KeyError, TypeError, ValueError):
+            errors.append(f"Item {line.get('item_id')} is not part of this invoice.")
+            continue
+        label = f"Item {item.pk}"
+        returned = _payload_decimal(line, 'returned', errors, f"{label} returned quantity")
+        increased = _payload_decimal(line, 'increased_demand', errors, f"{label} increased demand")
+        ipmu = item.items_per_master_unit_at_sale
+        if item._get_individual_items_from_decimal(returned, ipmu) > item.dispatched_individual_items_count:
+            errors.append(f"{label}: returned quantity ({returned}) cannot exceed dispatched quantity ({item.quantity_sold_decimal}).")
+        item.returned_quantity_decimal = returned
+        item.increased_demand = increased
+
+    payment_type = data.get('payment_type') or sale.payment_type
+    if payment_type not in dict(SalesTransaction.PAYMENT_TYPE_CHOICES):
+        errors.append(f"Unknown payment type '{payment_type}'.")
+    discount = _payload_decimal(data, 'total_discount_amount', errors, "Discount")
+    cash = _payload_decimal(data, 'amount_paid_cash', errors, "Cash amount")
+    online = _payload_decimal(data, 'amount_paid_online', errors, "Online amount")
+    credit = _payload_decimal(data, 'amount_on_credit', errors, "Credit amount")
+    if errors:
+        return [], None, errors
+
+    # The customer pays for dispatched + increased demand - returned, less the discount.
+    lines = sorted(items.values(), key=lambda line: line.pk)
+    expected_total = sum((
+        (item.dispatched_individual_items_count
+         + item._get_individual_items_from_decimal(item.increased_demand or Decimal('0.00'), item.items_per_master_unit_at_sale)
+         - item.returned_individual_items_count) * item.selling_price_per_item
+        for item in lines
+    ), Decimal('0.00')).quantize(Decimal('0.01')) - discount
+    if expected_total < 0:
+        errors.append(f"Discount (Rs {discount}) exceeds the invoice total.")
+        return [], None, errors
+
+    if payment_type == 'SPLIT':
+        paid_total = cash + online + credit
+        if paid_total != expected_total:
+            errors.append(f"Split payments (Rs {paid_total}) do not match the final total (Rs {expected_total}).")
+            return [], None, errors
+    else:
+        cash = expected_total if payment_type == 'CASH' else Decimal('0.00')
+        online = expected_total if payment_type == 'ONLINE' else Decimal('0.00')
+        credit = expected_total if payment_type == 'CREDIT' else Decimal('0.00')
+
+    sale.payment_type = payment_type
+    sale.total_discount_amount = discount
+    sale.amount_paid_cash = cash
+    sale.amount_paid_online = online
+    sale.amount_on_credit = credit
+    sale.allocate_line_totals(lines)
+    sale.grand_total_revenue = sum((item.gross_line_subtotal for item in lines), Decimal('0.00')) - discount
+    sale.grand_total_cost = sum((item.total_item_cost for item in lines), Decimal('0.00'))
+    sale.is_ready_for_processing = True
+    sale.status = 'PENDING_DELIVERY'
+    return lines, expected_total, errors
+
+
+def apply_route_returns(user, vehicle, invoices, settle=False):
+    """
+    Validates and applies a driver's route check-in for `vehicle` in one transaction.
+
+    `invoices` is a list of dicts: {'sale_id', 'payment_type', 'total_discount_amount',
+    'amount_paid_cash', 'amount_paid_online', 'amount_on_credit', 'items': [{'item_id',
+    'returned', 'increased_demand'}]}. Returns (ok, results) where results has one entry
+    per invoice; when any invoice fails nothing is written. With `settle`, every pending
+    sale on the vehicle is then settled in the same transaction.
+    """
+    results = []
+    sale_ids = []
+    for data in invoices:
+        try:
+            sale_ids.append(int(data.get('sale_id')))
+        except (AttributeError, TypeError, ValueError):
+            sale_ids.append(None)
+
+    with transaction.atomic():
+        sales = {
+            sale.pk: sale
+            for sale in SalesTransaction.objects.select_for_update()
+            .filter(pk__in=[pk for pk in sale_ids if pk], user=user, assigned_vehicle=vehicle, status__in=ROUTE_RETURN_STATUSES)
+            .prefetch_related('items')
+        }
+        rollup_before = sales_rollup_contributions(sales.values())
+
+        changed_sales = []
+        changed_items = []
+        seen = set()
+        for sale_id, data in zip(sale_ids, invoices):
+            sale = sales.get(sale_id)
+            if sale is None or sale_id in seen:
+                reason = "appears twice in the payload" if sale_id in seen else "is not a pending delivery on this vehicle"
+                results.append({'sale_id': sale_id, 'ok': False, 'errors': [f"Invoice {sale_id} {reason}."]})
+                continue
+            seen.add(sale_id)
+            items, final_total, errors = _apply_route_invoice(sale, data)
+            if errors:
+                results.append({'sale_id': sale_id, 'ok': False, 'errors': errors})
+                continue
+            changed_sales.append(sale)
+            changed_items.extend(items)
+            results.append({
+                'sale_id': sale_id,
+                'ok': True,
+                'final_total': str(final_total),
+                'payment_type': sale.payment_type,
+                'amount_paid_cash': str(sale.amount_paid_cash),
+                'amount_paid_online': str(sale.amount_paid_online),
+                'amount_on_credit': str(sale.amount_on_credit),
+            })
+
+        ok = bool(results) and all(result['ok'] for result in results)
+        if not ok:
+            return False, results
+
+        SalesTransactionItem.objects.bulk_update(
+            changed_items,
+            ['returned_quantity_decimal', 'increased_demand'] + SalesTransactionItem.LINE_TOTAL_FIELDS,
+            batch_size=500,
+        )
+        SalesTransaction.objects.bulk_update(
+            changed_sales,
+            ['payment_type', 'total_discount_amount', 'amount_paid_cash', 'amount_paid_online', 'amount_on_credit',
+             'grand_total_revenue', 'grand_total_cost', 'is_ready_for_processing', 'status'],
+            batch_size=500,
+        )
+        refresh_sales_rollup_for(sales.values(), rollup_before)
+        if settle:
+            settle_pending_for_vehicle(user, vehicle)
+    return True, results
+
+
+# --- Bulk reversal -----------------------------------------------------------------------
+# Reversing or deleting many sales at once: the stock they still hold is netted per batch
+# into one update each, their ledger rows go in one DELETE and each affected ledger (shop
+# or manual customer) is rebalanced once, however many of its sales were removed.
+
+
+def reverse_sales(sales_queryset):
+    """
+    Deletes the sales in `sales_queryset` and puts back the stock they took.
+    A settled sale holds its sold quantity less returns; a PENDING_DELIVERY sale still
+    holds everything dispatched, since its returns have not been booked yet.
+    Returns (sales reversed, items restored). Runs in one transaction.
+    """
+    from accounts.models import ShopFinancialTransaction
+    from accounts.utils import recompute_running_balances, sync_shop_balances
+
+    with transaction.atomic():
+        sales = list(
+            sales_queryset.select_for_update()
+            .order_by('pk')
+            .only('pk', 'user_id', 'status', 'transaction_time', 'customer_shop_id', 'assigned_vehicle_id')
+        )
+        if not sales:
+            return 0, 0
+        sales_by_pk = {sale.pk: sale for sale in sales}
+        rollup_before = sales_rollup_contributions(sales)
+        lines = list(
+            SalesTransactionItem.objects.filter(transaction_id__in=sales_by_pk)
+            .values_list('transaction_id', 'product_detail_snapshot_id', 'quantity_sold_decimal', 'returned_quantity_decimal')
+        )
+
+        batch_ids = sorted({line[1] for line in lines})
+        batches = {
+            batch.pk: batch
+            for batch in ProductDetail.objects.select_for_update().filter(pk__in=batch_ids).order_by('pk')
+        }
+        restored = defaultdict(int)
+        restored_by_sale = defaultdict(int)
+        for sale_id, batch_id, sold, returned in lines:
+            batch = batches[batch_id]
+            items = batch._get_items_from_decimal(sold or Decimal('0.00'))
+            if sales_by_pk[sale_id].status != 'PENDING_DELIVERY':
+                items -= batch._get_items_from_decimal(returned or Decimal('0.00'))
+            restored[batch_id] += items
+            restored_by_sale[(sale_id, batch_id)] += items
+
+        now = timezone.now()
+        changed_batches = []
+        for batch_id, items in restored.items():
+            if items:
+                batch = batches[batch_id]
+                batch.stock_items += items
+                batch.updated_at = now
+                changed_batches.append(batch)
+        ProductDetail.objects.bulk_update(changed_batches, ['stock_items', 'updated_at'])
+        log_stock_movements([
+            StockMovement(product_detail_id=batch_id, delta_items=items, reason=StockMovement.SALE_REVERSAL, sales_transaction_id=sale_id)
+            for (sale_id, batch_id), items in restored_by_sale.items() if items
+        ])
+
+        # Shop and manual-customer ledgers alike: every ledger losing a row is locked the
+        # way its own entries lock it, and only changes from its earliest deleted row on.
+        entries = list(
+            ShopFinancialTransaction.objects.filter(source_sale_id__in=sales_by_pk)
+            .only('pk', 'shop_id', 'customer_name_snapshot', 'transaction_date')
+        )
+        rebalance_from = {}
+        for entry in entries:
+            key = entry.ledger_lock_key()
+            if key not in rebalance_from or entry.transaction_date < rebalance_from[key].transaction_date:
+                rebalance_from[key] = entry
+        if entries:
+            entries[0].lock_ledger(*entries[1:])
+            ShopFinancialTransaction.objects.filter(pk__in=[entry.pk for entry in entries]).delete()
+        SalesTransaction.objects.filter(pk__in=sales_by_pk).delete()
+        for _key, entry in sorted(rebalance_from.items()):
+            recompute_running_balances(
+                ShopFinancialTransaction.objects.filter(**entry.ledger_filter()), since=entry.transaction_date
+            )
+        sync_shop_balances({entry.shop_id for entry in rebalance_from.values() if entry.shop_id})
+        refresh_sales_rollup_for(sales, rollup_before)
+        for user_id in {sale.user_id for sale in sales}:
+            invalidate_shop_leaderboard(user_id)
+    return len(sales), sum(restored.values())
@@ -3,36 +3,40 @@ from .forms import RegisterForm, AddProductForm, ProductDetailForm,VehicleForm,
 from .forms import SalesTransactionItemReturnForm,AddItemToSaleForm,FinalizeSaleForm,SalesTransactionItemReturnFormSet # Import the formset
 from .forms import  AddStockForm #,UpdatePaymentTypeForm
 from django.contrib.auth import login, logout
-from .utils import authenticate 
+from .utils import authenticate, finalize_sale_items, deferred_totals, defer_grand_totals, batched_movements, log_stock_movement, with_stock_as_of
+from .utils import filter_sales_for_export, sales_export_rows, sum_by_period, claim_loss_expression, sales_rollup_tracked, performance_summary, shop_leaderboard, vehicle_loading_sheets
+from .utils import apply_route_returns, reverse_sales
+from jobs.models import Job
 from django.contrib.auth.models import User 
 from django.contrib.auth.decorators import login_required
-from .models import AddProduct, ProductDetail,Sale, Vehicle, Shop, SalesTransaction, SalesTransactionItem,StockHistory
+from .models import AddProduct, ProductDetail,Sale, Vehicle, Shop, SalesTransaction, SalesTransactionItem,StockHistory, StockMovement, SalesDailyRollup
 from accounts.models import ShopFinancialTransaction  # model from account app
-from claim.models import Claim
+from claim.models import Claim, ClaimItem
 from gov_agency.models import AdminProfile
 from django.contrib import messages
 from django.db.models  import Q,ProtectedError
 from django.db import transaction,IntegrityError# For atomic operations
 from django.http import JsonResponse
 from decimal import Decimal ,ROUND_HALF_UP
-from django.db.models import Sum,Count,F, ExpressionWrapper, fields, DecimalField
+from django.db.models import Sum,Count,F, ExpressionWrapper, fields, DecimalField, DateField, Value
 from django.utils import timezone
 from datetime import timedelta, date
 import json 
 from django.db.models.functions import TruncMonth,TruncDay
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.urls import resolve
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from urllib.parse import urlencode
+import csv
+from gov_agency.pagination import keyset_paginate
 from openpyxl import Workbook
 from openpyxl.utils import get_column_letter
 from openpyxl.styles import Font
 from expense.models import Expense
 from django.db.models.functions import TruncDate,TruncMonth
 from collections import defaultdict
-from gov_agency.decorators import admin_mode_required
+from gov_agency.decorators import admin_mode_required, retry_on_conflict
 from django import forms
-from itertools import groupby
-from operator import attrgetter
 from django.views.decorators.http import require_POST
 
 
@@ -135,9 +139,11 @@ def add_product_details(request):
         # This POST is for adding a new ProductDetail via the modal
         form = ProductDetailForm(request.POST, user = request.user)
         if form.is_valid():
-            detail = form.save(commit=False)
-            detail.user = request.user
-            detail.save()
+            with transaction.atomic():
+                detail = form.save(commit=False)
+                detail.user = request.user
+                detail.save()
+                log_stock_movement(detail.pk, detail.stock_items, StockMovement.CREATED)
             messages.success(request, f"Details for '{detail.product_base.name}' added successfully!")
             # creating history.........
             performed_by_name = request.POST.get('performed_by_name', request.user.username)
@@ -216,7 +222,11 @@ def product_detail_update_view(request, pk):
     if request.method == 'POST':
         form = ProductDetailForm(request.POST, instance=instance , user=request.user)
         if form.is_valid(): 
-            form.save()
+            with transaction.atomic():
+                # The form sets stock outright; the movement is measured against the locked row.
+                stock_items_before = ProductDetail.objects.select_for_update().values_list('stock_items', flat=True).get(pk=instance.pk)
+                form.save()
+                log_stock_movement(instance.pk, instance.stock_items - stock_items_before, StockMovement.ADJUSTMENT)
             messages.success(request, f"Details for '{instance .product_base.name}' updated successfully!")
             query = request.GET.get('q_after_update', '')
             redirect_url = redirect('stock:add_product_details').url
@@ -247,9 +257,9 @@ def add_stock_to_product_detail_view(request, pk):
                     stock_before = existing_batch.stock
                     if existing_batch:
                         # Add stock to the existing batch with the same expiry date
-                        existing_batch.increase_stock(new_stock_quantity)   
+                        existing_batch.increase_stock(new_stock_quantity, StockMovement.ADD)
                         existing_batch.expirey_date = new_expiry_date
-                        existing_batch.save(update_fields=['stock', 'expirey_date', 'updated_at'])
+                        existing_batch.save(update_fields=['expirey_date', 'updated_at'])
                         messages.success(request, f"Added {new_stock_quantity} stock to existing batch of {existing_batch.product_base.name} (Exp: {new_expiry_date}). New stock: {existing_batch.stock}.")
                         # creating history .......
                         performed_by_name = request.POST.get('performed_by_name', request.user.username)
@@ -276,6 +286,7 @@ def add_stock_to_product_detail_view(request, pk):
                             stock=new_stock_quantity,
                             expirey_date=new_expiry_date
                         )
+                        log_stock_movement(new_batch.pk, new_batch.stock_items, StockMovement.ADD)
                         messages.success(request, f"New stock batch created for {new_batch.product_base.name} with quantity {new_stock_quantity} and expiry {new_expiry_date}.")
                     
                 return redirect('stock:add_product_details')
@@ -291,19 +302,221 @@ def add_stock_to_product_detail_view(request, pk):
     # This view is for POST only from the modal
     return redirect('stock:add_product_details')
 
+def _filtered_stock_history(request):
+    """The user's StockHistory narrowed by the product/batch/action/date GET filters."""
+    history = StockHistory.objects.filter(user=request.user)
+    filters = {
+        'product': request.GET.get('product', ''),
+        'batch': request.GET.get('batch', ''),
+        'action': request.GET.get('action', ''),
+        'start_date': request.GET.get('start_date', ''),
+        'end_date': request.GET.get('end_date', ''),
+    }
+    if filters['product'].isdigit():
+        history = history.filter(product_detail__product_base_id=filters['product'])
+    if filters['batch'].isdigit():
+        history = history.filter(product_detail_id=filters['batch'])
+    if filters['action'] in dict(StockHistory.ACTION_CHOICES):
+        history = history.filter(action=filters['action'])
+    try:
+        if filters['start_date']:
+            history = history.filter(timestamp__date__gte=date.fromisoformat(filters['start_date']))
+        if filters['end_date']:
+            history = history.filter(timestamp__date__lte=date.fromisoformat(filters['end_date']))
+    except ValueError:
+        messages.warning(request, "Invalid date filter ignored. Use YYYY-MM-DD.")
+    return history, filters
+
+
 @login_required
 # @admin_mode_required
 def stock_history_view(request):
-    all_stock_history = StockHistory.objects.filter(user=request.user).order_by('-timestamp')
-    history = (StockHistory.objects.select_related(
-        'product_detail','product_detail__product_base','user')
-        .order_by('-timestamp')
-        .filter(user =request.user))
-    print(all_stock_history)
-    return render(request, 'stock/stock_history.html', {'history': history})
+    history, filters = _filtered_stock_history(request)
+    page = keyset_paginate(
+        history.select_related('product_detail', 'product_detail__product_base', 'user'),
+        keys=('timestamp', 'id'),
+        after=request.GET.get('after'),
+        before=request.GET.get('before'),
+        per_page=50,
+    )
+    context = {
+        'history': page,
+        'filters': filters,
+        'filter_query': urlencode({key: value for key, value in filters.items() if value}),
+        'products': AddProduct.objects.filter(user=request.user).order_by('name'),
+        'batches': ProductDetail.objects.filter(user=request.user).select_related('product_base').order_by('product_base__name', 'expirey_date'),
+        'action_choices': StockHistory.ACTION_CHOICES,
+    }
+    return render(request, 'stock/stock_history.html', context)
+
+
+class _Echo:
+    """Pseudo-buffer for csv.writer: hands each formatted row straight to the response."""
+    def write(self, value):
+        return value
+
+
+@login_required
+def export_stock_history_csv(request):
+    """Streams the filtered stock history as CSV, reading the table in chunks."""
+    history, _ = _filtered_stock_history(request)
+    rows = history.order_by('-timestamp', '-id').values_list(
+        'timestamp', 'product_detail__product_base__name', 'product_detail__quantity_in_packing',
+        'product_detail__unit_of_measure', 'product_detail__packing_type', 'product_detail__expirey_date',
+        'action', 'quantity_change', 'stock_before', 'stock_after', 'performed_by', 'notes',
+    ).iterator(chunk_size=2000)
+    action_labels = dict(StockHistory.ACTION_CHOICES)
+    writer = csv.writer(_Echo())
+
+    def stream():
+        yield writer.writerow(['Date & Time', 'Product', 'Packing', 'Expiry', 'Action', 'Qty Change', 'Stock Before', 'Stock After', 'Performed By', 'Notes'])
+        for timestamp, name, quantity_in_packing, unit, packing_type, expiry, action, change, before, after, performed_by, notes in rows:
+            yield writer.writerow([
+                timezone.localtime(timestamp).strftime('%Y-%m-%d %H:%M'),
+                f"{name} {quantity_in_packing} {unit}",
+                packing_type,
+                expiry.strftime('%Y-%m-%d') if expiry else '',
+                action_labels.get(action, action),
+                change, before, after,
+                performed_by or 'System',
+                notes or '',
+            ])
+
+    response = StreamingHttpResponse(stream(), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="stock_history_{timezone.localdate():%Y-%m-%d}.csv"'
+    return response
 
 #  sales views...................................................................................................................
 
+def _parse_as_of_date(value):
+    """Parses a YYYY-MM-DD query parameter, defaulting to today (local)."""
+    if value:
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            pass
+    return timezone.localdate()
+
+
+def _stock_as_of_rows(user, as_of, product_base_id=None):
+    batches = ProductDetail.objects.filter(user=user).select_related('product_base').order_by('product_base__name', 'expirey_date')
+    if product_base_id and str(product_base_id).isdigit():
+        batches = batches.filter(product_base_id=product_base_id)
+    rows = []
+    for batch in with_stock_as_of(batches, as_of):
+        if not batch.stock_items_as_of and not batch.stock_items:
+            continue
+        rows.append({
+            'batch': batch,
+            'stock_items_as_of': batch.stock_items_as_of,
+            'stock_as_of': batch._get_decimal_from_items(batch.stock_items_as_of),
+        })
+    return rows
+
+
+@login_required
+def stock_as_of_view(request):
+    """Every batch's stock at the end of a chosen day, next to its current stock."""
+    as_of = _parse_as_of_date(request.GET.get('date'))
+    product_base_id = request.GET.get('product')
+    rows = _stock_as_of_rows(request.user, as_of, product_base_id)
+    context = {
+        'rows': rows,
+        'as_of': as_of,
+        'products': AddProduct.objects.filter(user=request.user).order_by('name'),
+        'selected_product': product_base_id or '',
+        'ledger_start': StockMovement.objects.filter(product_detail__user=request.user).order_by('created_at').values_list('created_at', flat=True).first(),
+    }
+    return render(request, 'stock/stock_as_of.html', context)
+
+
+@login_required
+def stock_as_of_api(request):
+    """JSON variant of stock_as_of_view: ?date=YYYY-MM-DD[&product=<product id>]."""
+    as_of = _parse_as_of_date(request.GET.get('date'))
+    rows = _stock_as_of_rows(request.user, as_of, request.GET.get('product'))
+    data = [
+        {
+            'pk': row['batch'].pk,
+            'product_name_display': f"{row['batch'].product_base.name} {row['batch'].quantity_in_packing} {row['batch'].unit_of_measure}",
+            'expiry_date_display': row['batch'].expirey_date.strftime('%Y-%m-%d'),
+            'stock_items_as_of': row['stock_items_as_of'],
+            'stock_as_of_display': str(row['stock_as_of']),
+            'current_stock_items': row['batch'].stock_items,
+        }
+        for row in rows
+    ]
+    return JsonResponse({'success': True, 'as_of': as_of.isoformat(), 'data': data})
+
+
+@retry_on_conflict
+def _record_sale(user, form, current_items):
+    """
+    Writes a finalized cart as one sale: header, items, stock and any credit ledger entry.
+    Runs in its own transaction and is retried on lock conflicts; the session cart and
+    messages are left to the view, so a retry never repeats them.
+    """
+    # 1. CALCULATE GRAND TOTAL FROM SESSION DATA
+    gross_subtotal = sum(Decimal(item['line_subtotal']) for item in current_items)
+    discount = form.cleaned_data.get('total_discount_amount') or Decimal('0.00')
+    grand_total = (gross_subtotal - discount).quantize(Decimal('0.01'))
+
+    # 2. GET ALL PAYMENT-RELATED DATA FROM THE FORM
+    payment_type = form.cleaned_data.get('payment_type')
+    cash = form.cleaned_data.get('amount_paid_cash') or Decimal('0.00')
+    online = form.cleaned_data.get('amount_paid_online') or Decimal('0.00')
+    credit = form.cleaned_data.get('amount_on_credit') or Decimal('0.00')
+
+    # 3. CREATE THE TRANSACTION INSTANCE (but don't save yet)
+    sales_transaction_header = form.save(commit=False)
+    # A retried attempt inserts a new row; the rolled back one's pk is gone.
+    sales_transaction_header.pk = None
+    sales_transaction_header._state.adding = True
+    sales_transaction_header.user = user
+    sales_transaction_header.status = 'PENDING_DELIVERY' if sales_transaction_header.needs_vehicle else 'COMPLETED'
+
+    # 4. HANDLE PAYMENT LOGIC (Single vs. Split)
+    if payment_type == 'SPLIT':
+        # For split payments, validate that the sum matches the grand total
+        if (cash + online + credit).quantize(Decimal('0.01')) != grand_total:
+            raise forms.ValidationError(f"Split payments (Rs {cash + online + credit}) do not match Grand Total (Rs {grand_total}).")
+
+        sales_transaction_header.notes = (
+        f"Split Payment: Cash = Rs {cash:.2f}, "
+        f"Online = Rs {online:.2f}, "
+        f"Credit = Rs {credit:.2f}"
+        )
+        # The amounts from the form are already correct on the instance
+    else:
+        # For single payments, we override the amount fields
+        sales_transaction_header.amount_paid_cash = grand_total if payment_type == 'CASH' else Decimal('0.00')
+        sales_transaction_header.amount_paid_online = grand_total if payment_type == 'ONLINE' else Decimal('0.00')
+        sales_transaction_header.amount_on_credit = grand_total if payment_type == 'CREDIT' else Decimal('0.00')
+
+    # Set grand totals manually before saving
+    sales_transaction_header.grand_total_revenue = grand_total
+    # grand_total_cost will be calculated later
+
+    sales_transaction_header.save() # First save to get a PK
+
+    # 5. CREATE SALE ITEMS, DECREASE STOCK AND SET GRAND TOTALS
+    # One batched pass: lock all batches, bulk insert items, compute totals once.
+    finalize_sale_items(sales_transaction_header, current_items)
+
+    # Create a ledger entry if there is a credit amount
+    if sales_transaction_header.amount_on_credit > 0:
+        ShopFinancialTransaction.objects.create(
+            shop=sales_transaction_header.customer_shop,
+            customer_name_snapshot=sales_transaction_header.customer_name_manual,
+            user=user,
+            source_sale=sales_transaction_header,
+            transaction_type='CREDIT_SALE',
+            debit_amount=sales_transaction_header.amount_on_credit,
+            notes=f"Credit from Sale Transaction #{sales_transaction_header.pk}"
+        )
+    return sales_transaction_header
+
+
 @login_required
 def sales_processing_view(request):
     """
@@ -327,23 +540,33 @@ def sales_processing_view(request):
                 product_detail_batch = add_item_form.cleaned_data['product_detail_batch']
                 quantity_to_add = add_item_form.cleaned_data['quantity_to_add']
                 selling_price_item = add_item_form.cleaned_data['selling_price_per_item']
+                allocate_by_expiry = add_item_form.cleaned_data.get('allocate_by_expiry')
                 current_items = request.session.get(current_transaction_items_session_key, [])
+                # FEFO lines are matched on product/packing, since the batches are picked at finalize.
+                fefo_group = f"{product_detail_batch.product_base_id}|{product_detail_batch.packing_type}|{product_detail_batch.quantity_in_packing}|{product_detail_batch.unit_of_measure}|{product_detail_batch.items_per_master_unit}"
 
                 # Check for duplicates
-                if any(item['product_detail_id'] == product_detail_batch.id for item in current_items):
+                if any(item['product_detail_id'] == product_detail_batch.id or (allocate_by_expiry and item.get('fefo_group') == fefo_group) for item in current_items):
                     messages.warning(request, f"{product_detail_batch.product_base.name} is already in the list. Remove to re-add with new quantity/price.")
                 else:
                     # Calculate gross subtotal for this line (no discount here)
                     individual_items_count = product_detail_batch._get_items_from_decimal(quantity_to_add)
                     gross_subtotal = individual_items_count * selling_price_item
-                    
+                    if allocate_by_expiry:
+                        display_name = f"{product_detail_batch.product_base.name} {product_detail_batch.quantity_in_packing} {product_detail_batch.unit_of_measure} (Earliest expiry first)"
+                    else:
+                        display_name = f"{product_detail_batch.product_base.name} {product_detail_batch.quantity_in_packing} {product_detail_batch.unit_of_measure} (Exp: {product_detail_batch.expirey_date.strftime('%d-%b-%Y')})"
+
                     current_items.append({
                         'product_detail_id': product_detail_batch.id,
-                        'product_display_name': f"{product_detail_batch.product_base.name} {product_detail_batch.quantity_in_packing} {product_detail_batch.unit_of_measure} (Exp: {product_detail_batch.expirey_date.strftime('%d-%b-%Y')})",
+                        'product_display_name': display_name,
                         'quantity_decimal': str(quantity_to_add),
                         'selling_price_per_item': str(selling_price_item),
                         'cost_price_per_item': str(product_detail_batch.price_per_item),
-                        'line_subtotal': str(gross_subtotal.quantize(Decimal('0.01'))) # Store the gross (undiscounted) subtotal
+                        'line_subtotal': str(gross_subtotal.quantize(Decimal('0.01'))), # Store the gross (undiscounted) subtotal
+                        # 'FEFO' lines are split across batches by finalize_sale_items.
+                        'allocation': 'FEFO' if allocate_by_expiry else None,
+                        'fefo_group': fefo_group if allocate_by_expiry else None,
                     })
                     messages.success(request, f"Added {quantity_to_add} of {product_detail_batch.product_base.name} to transaction.")
                 
@@ -377,85 +600,16 @@ def sales_processing_view(request):
             form_to_validate = FinalizeSaleForm(request.POST, user=request.user)
             if form_to_validate.is_valid():
                 try:
-                    with transaction.atomic():
-                        # 1. CALCULATE GRAND TOTAL FROM SESSION DATA
-                        gross_subtotal = sum(Decimal(item['line_subtotal']) for item in current_items)
-                        discount = form_to_validate.cleaned_data.get('total_discount_amount') or Decimal('0.00')
-                        grand_total = (gross_subtotal - discount).quantize(Decimal('0.01'))
-
-                        # 2. GET ALL PAYMENT-RELATED DATA FROM THE FORM
-                        payment_type = form_to_validate.cleaned_data.get('payment_type')
-                        cash = form_to_validate.cleaned_data.get('amount_paid_cash') or Decimal('0.00')
-                        online = form_to_validate.cleaned_data.get('amount_paid_online') or Decimal('0.00')
-                        credit = form_to_validate.cleaned_data.get('amount_on_credit') or Decimal('0.00')
-
-                        # 3. CREATE THE TRANSACTION INSTANCE (but don't save yet)
-                        sales_transaction_header = form_to_validate.save(commit=False)
-                        sales_transaction_header.user = request.user
-                        if sales_transaction_header.needs_vehicle and sales_transaction_header.assigned_vehicle:
-                            request.session['assigned_vehicle_id'] = sales_transaction_header.assigned_vehicle.id
-                            request.session['need_vehicle'] = True
-                        else:
-                            request.session.pop('assigned_vehicle_id', None)
-                            request.session.pop('need_vehicle', None)
-                        sales_transaction_header.status = 'PENDING_DELIVERY' if sales_transaction_header.needs_vehicle else 'COMPLETED'
-                        
-                        # 4. HANDLE PAYMENT LOGIC (Single vs. Split)
-                        if payment_type == 'SPLIT':
-                            # For split payments, validate that the sum matches the grand total
-                            if (cash + online + credit).quantize(Decimal('0.01')) != grand_total:
-                                raise forms.ValidationError(f"Split payments (Rs {cash + online + credit}) do not match Grand Total (Rs {grand_total}).")
-                            
-                            sales_transaction_header.notes = (
-                            f"Split Payment: Cash = Rs {cash:.2f}, "
-                            f"Online = Rs {online:.2f}, "
-                            f"Credit = Rs {credit:.2f}"
-                            )
-                            # The amounts from the form are already correct on the instance
-                        else:
-                            # For single payments, we override the amount fields
-                            sales_transaction_header.amount_paid_cash = grand_total if payment_type == 'CASH' else Decimal('0.00')
-                            sales_transaction_header.amount_paid_online = grand_total if payment_type == 'ONLINE' else Decimal('0.00')
-                            sales_transaction_header.amount_on_credit = grand_total if payment_type == 'CREDIT' else Decimal('0.00')
-                        
-                        # Set grand totals manually before saving
-                        sales_transaction_header.grand_total_revenue = grand_total
-                        # grand_total_cost will be calculated later
-
-                        sales_transaction_header.save() # First save to get a PK
-
-                        # 5. CREATE SALE ITEMS AND DECREASE STOCK (Unchanged logic)
-                        for item_data in current_items:
-                            pd_batch = ProductDetail.objects.select_for_update().get(pk=item_data['product_detail_id'])
-                            if not pd_batch.decrease_stock(Decimal(item_data['quantity_decimal'])):
-                                raise Exception(f"Stock update failed for {pd_batch}. Transaction rolled back.")
-                            SalesTransactionItem.objects.create(
-                                transaction=sales_transaction_header,
-                                product_detail_snapshot=pd_batch,
-                                quantity_sold_decimal=Decimal(item_data['quantity_decimal']),
-                                selling_price_per_item=Decimal(item_data['selling_price_per_item']),
-                                cost_price_per_item_at_sale=Decimal(item_data['cost_price_per_item']),
-                            )
-                        
-                        # 6. UPDATE GRAND TOTALS (especially grand_total_cost) AND CREATE LEDGER ENTRY
-                        sales_transaction_header.update_grand_totals() # This will calculate and save the cost
-                        
-                        # Create a ledger entry if there is a credit amount
-                        if sales_transaction_header.amount_on_credit > 0:
-                            ShopFinancialTransaction.objects.create(
-                                shop=sales_transaction_header.customer_shop,
-                                customer_name_snapshot=sales_transaction_header.customer_name_manual,
-                                user=request.user,
-                                source_sale=sales_transaction_header,
-                                transaction_type='CREDIT_SALE',
-                                debit_amount=sales_transaction_header.amount_on_credit,
-                                notes=f"Credit from Sale Transaction #{sales_transaction_header.pk}"
-                            )
-                        
-                        messages.success(request, f"Transaction #{sales_transaction_header.pk} completed successfully!")
-                        del request.session[current_transaction_items_session_key] # Clear the cart
-                        return redirect('stock:sale_receipt', sale_pk=sales_transaction_header.pk)
-
+                    sales_transaction_header = _record_sale(request.user, form_to_validate, current_items)
+                    if sales_transaction_header.needs_vehicle and sales_transaction_header.assigned_vehicle:
+                        request.session['assigned_vehicle_id'] = sales_transaction_header.assigned_vehicle.id
+                        request.session['need_vehicle'] = True
+                    else:
+                        request.session.pop('assigned_vehicle_id', None)
+                        request.session.pop('need_vehicle', None)
+                    messages.success(request, f"Transaction #{sales_transaction_header.pk} completed successfully!")
+                    del request.session[current_transaction_items_session_key] # Clear the cart
+                    return redirect('stock:sale_receipt', sale_pk=sales_transaction_header.pk)
                 except ProductDetail.DoesNotExist:
                     messages.error(request, "Error: A product in the transaction could not be found. Transaction cancelled.")
                 except Exception as e:
@@ -511,7 +665,8 @@ def bulk_delete_sales_view(request):
                 count = transactions_to_delete.count()
                 
                 if count > 0:
-                    transactions_to_delete.delete()
+                    # Puts their stock back and rebalances the shop ledgers in one pass.
+                    count, _restored = retry_on_conflict(reverse_sales)(transactions_to_delete)
                     messages.success(request, f"Successfully deleted {count} conflicting sales record(s). You may now try deleting the product(s) again.")
                 else:
                     messages.warning(request, "No matching sales records were found to delete.")
@@ -565,8 +720,12 @@ def all_transactions_list_view(request):
         'items__product_detail_snapshot__product_base' # For product summary
     ).order_by('-transaction_time')
 
-    start_date = request.GET.get('start_date')
-    end_date = request.GET.get('end_date')
+    try:
+        start_date = date.fromisoformat(request.GET['start_date']) if request.GET.get('start_date') else None
+        end_date = date.fromisoformat(request.GET['end_date']) if request.GET.get('end_date') else None
+    except ValueError:
+        messages.warning(request, "Invalid date filter ignored. Use YYYY-MM-DD.")
+        start_date = end_date = None
 
     if start_date and not end_date:
         # **Special Case**: If only start_date is provided, filter for that single day.
@@ -617,25 +776,14 @@ def get_sale_info(request, sale_id):
         return JsonResponse({"success": False})
 
 @login_required
-@transaction.atomic
 def confirm_reverse_sale(request, sale_id):
     sale = get_object_or_404(SalesTransaction, pk=sale_id, user=request.user)
 
     if request.method == "POST":
         try:
             if sale.status != "PENDING_DELIVERY":
-                # 1. Restore Stock
-                for item in sale.items.select_related("product_detail_snapshot"):
-                    item.product_detail_snapshot.increase_stock(item.quantity_sold_decimal)
-                    item.product_detail_snapshot.decrease_stock(item.returned_quantity_decimal)
-
-                # 2. Delete Ledger Entry if it was CREDIT
-                if sale.payment_type == 'CREDIT' or sale.payment_type == 'SPLIT':
-                    ShopFinancialTransaction.objects.filter(source_sale=sale).delete()
-
-                # 3. Delete Sale Items and Sale
-                sale.items.all().delete()
-                sale.delete()
+                # Restores stock, deletes the ledger entry and the sale, rebalances the shop.
+                retry_on_conflict(reverse_sales)(SalesTransaction.objects.filter(pk=sale.pk))
 
                 messages.success(request, f"Sale #{sale_id} reversed and deleted successfully.")
                 return redirect('stock:all_transactions_list')
@@ -648,133 +796,113 @@ def confirm_reverse_sale(request, sale_id):
     return redirect('stock:all_transactions_list')
 
 
+# Bulk reversal takes settled sales, including those with credit on a customer ledger:
+# reverse_sales locks every affected ledger and rebalances each once. Pending deliveries
+# still hold their returns and are settled or reversed one at a time.
+BULK_REVERSIBLE_STATUSES = ('COMPLETED', 'PARTIALLY_RETURNED', 'FULLY_RETURNED')
+
+
 @login_required
-def export_sales_to_excel(request):
+@require_POST
+def bulk_reverse_sales_view(request):
     """
-    Handles the export of sales transactions to an Excel (.xlsx) file.
-    Can be filtered by a date range OR a specific list of transaction IDs.
+    Reverses many settled sales in one go: either the comma separated `sale_ids`, or
+    every sale in the `start_date`/`end_date` filter of the transactions list.
+    The first POST only renders a confirmation page with the count and totals of the
+    sales that would be reversed and of those skipped. The page posts back exactly
+    those sale IDs with `confirm` set, and only that request reverses them.
     """
-    # Start with the base queryset for the logged-in user
-    transactions_list = SalesTransaction.objects.filter(user=request.user)
-
-    # --- NEW: Check for a specific list of IDs first ---
-    ids_to_export_str = request.GET.get('ids')
-    if ids_to_export_str:
-        try:
-            # Convert comma-separated string of IDs to a list of integers
-            ids_list = [int(id_str) for id_str in ids_to_export_str.split(',') if id_str.isdigit()]
-            if ids_list:
-                transactions_list = transactions_list.filter(pk__in=ids_list)
-        except (ValueError, TypeError):
-            # If IDs are invalid, ignore and proceed to date filters
-            pass
+    sale_ids_str = request.POST.get('sale_ids', '')
+    try:
+        start_date = date.fromisoformat(request.POST['start_date']) if request.POST.get('start_date') else None
+        end_date = date.fromisoformat(request.POST['end_date']) if request.POST.get('end_date') else None
+    except ValueError:
+        messages.error(request, "Invalid date range. Use YYYY-MM-DD.")
+        return redirect('stock:all_transactions_list')
+    matched = SalesTransaction.objects.filter(user=request.user)
+
+    if sale_ids_str.strip():
+        sale_ids = [int(id_str) for id_str in sale_ids_str.replace(' ', '').split(',') if id_str.isdigit()]
+        matched = matched.filter(pk__in=sale_ids)
+    elif start_date:
+        matched = matched.filter(transaction_time__date__gte=start_date, transaction_time__date__lte=end_date or start_date)
     else:
-        # --- EXISTING DATE FILTER LOGIC ---
-        start_date = request.GET.get('start_date')
-        end_date = request.GET.get('end_date')
+        messages.warning(request, "Enter sale IDs or filter a date range before reversing.")
+        return redirect('stock:all_transactions_list')
+
+    reversible = Q(status__in=BULK_REVERSIBLE_STATUSES)
+    sales = matched.filter(reversible)
+
+    if not request.POST.get('confirm'):
+        summary = matched.aggregate(
+            matched_count=Count('pk'),
+            count=Count('pk', filter=reversible),
+            revenue=Sum('grand_total_revenue', filter=reversible),
+            cash=Sum('amount_paid_cash', filter=reversible),
+            online=Sum('amount_paid_online', filter=reversible),
+            credit=Sum('amount_on_credit', filter=reversible),
+            pending_count=Count('pk', filter=Q(status='PENDING_DELIVERY')),
+        )
+        if not summary['count']:
+            messages.warning(request, "No matching settled sales were found to reverse.")
+            return redirect('stock:all_transactions_list')
+        summary['other_count'] = summary['matched_count'] - summary['count'] - summary['pending_count']
+        return render(request, 'stock/confirm_bulk_reverse_sales.html', {
+            'summary': summary,
+            'sale_ids': ','.join(str(pk) for pk in sales.order_by('pk').values_list('pk', flat=True)),
+            'start_date': start_date,
+            'end_date': end_date,
+        })
 
-        if start_date and not end_date:
-            transactions_list = transactions_list.filter(transaction_time__date=start_date)
+    try:
+        count, restored_items = retry_on_conflict(reverse_sales)(sales)
+        if count:
+            messages.success(request, f"Reversed and deleted {count} sale(s); {restored_items} item(s) returned to stock.")
         else:
-            if start_date:
-                transactions_list = transactions_list.filter(transaction_time__date__gte=start_date)
-            if end_date:
-                transactions_list = transactions_list.filter(transaction_time__date__lte=end_date)
+            messages.warning(request, "No matching settled sales were found to reverse.")
+    except Exception as e:
+        messages.error(request, f"Error while reversing sales: {str(e)}")
+    return redirect('stock:all_transactions_list')
 
-    # Apply optimizations and ordering
-    transactions_list = transactions_list.select_related(
-        'customer_shop', 'assigned_vehicle'
-    ).prefetch_related( # Prefetch items and their nested details for performance
-        'items__product_detail_snapshot__product_base'
-    ).order_by('-transaction_time')
 
-    # Create the Excel Workbook and Worksheet in memory
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Sales Report"
+@login_required
+def export_sales_to_excel(request):
+    """
+    Handles the export of sales transactions to an Excel (.xlsx) file, or to CSV with ?format=csv.
+    Can be filtered by a date range OR a specific list of transaction IDs.
+    CSV is streamed straight back; the Excel file is built by a background job.
+    """
+    ids_to_export_str = request.GET.get('ids')
+    start_date = request.GET.get('start_date')
+    end_date = request.GET.get('end_date')
 
-    # Define the Headers
-    columns = [
-        "Tx ID", "Date", "Time", "Customer", "Payment", "Status",
-        "Total Revenue", "Total Profit", "Notes",  # Transaction-level info
-        "Product Name", "Price Per Unit", "Quantity Sold", "Returned", "Discount", "Unit", # Item-level info
-    ]
-    ws.append(columns)
-
-    # Style the header row (bold font)
-    bold_font = Font(bold=True)
-    for col_num in range(1, len(columns) + 1):
-        cell = ws.cell(row=1, column=col_num)
-        cell.font = bold_font
-
-    # Loop through the queryset and append data rows
-    for tx in transactions_list:
-        # Using .all() on a prefetched queryset is efficient (no extra DB hit here)
-        all_items = tx.items.all()
-        customer_name = tx.customer_shop.name if tx.customer_shop else tx.customer_name_manual or "N/A"
-
-        # If a transaction has no items, we might still want to log it
-        if not all_items:
-            row = [
-                tx.pk,
-                tx.transaction_time.date(),
-                tx.transaction_time.time().strftime('%H:%M:%S'),
-                customer_name,
-                tx.get_payment_type_display(),
-                tx.get_status_display(),
-                tx.grand_total_revenue, # Use number format for better sorting in Excel
-                tx.calculated_grand_profit,
-                tx.notes,
-            ]
-            ws.append(row)
-        else:
-            # If there are items, create a row for each one
-            for item in all_items:
-                row = [
-                    tx.pk,
-                    tx.transaction_time.date(),
-                    tx.transaction_time.time().strftime('%H:%M:%S'),
-                    customer_name,
-                    tx.get_payment_type_display(),
-                    tx.get_status_display(),
-                    tx.grand_total_revenue,
-                    tx.calculated_grand_profit,
-                    tx.notes,
-                    item.product_detail_snapshot.product_base.name,
-                    item.selling_price_per_item,
-                    item.quantity_sold_decimal,
-                    item.returned_quantity_decimal,
-                    f'{tx.total_discount_amount}', 
-                    f'{item.product_detail_snapshot.quantity_in_packing} {item.product_detail_snapshot.unit_of_measure}',
-                ]
-                ws.append(row)
-
-    # Auto-size columns for better readability
-    for col_num, column_title in enumerate(columns, 1):
-        column_letter = get_column_letter(col_num)
-        ws.column_dimensions[column_letter].autosize = True
-
-    # Prepare the HTTP response to serve the file
-    response = HttpResponse(
-        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-    )
     # Define a dynamic filename
-    filename = "sales_report.xlsx"
+    filename = "sales_report"
     if ids_to_export_str:
-        filename = "conflicting_sales_export.xlsx"
+        filename = "conflicting_sales_export"
     elif start_date and end_date:
-        filename = f"sales_{start_date}_to_{end_date}.xlsx"
+        filename = f"sales_{start_date}_to_{end_date}"
     elif start_date:
-        filename = f"sales_{start_date}.xlsx"
-        
-    response['Content-Disposition'] = f'attachment; filename="{filename}"'
-
-    # Save the workbook to the response
-    wb.save(response)
-
-    return response
-
-
+        filename = f"sales_{start_date}"
+
+    if request.GET.get('format') == 'csv':
+        transactions_list = filter_sales_for_export(request.user, ids_to_export_str, start_date, end_date)
+        writer = csv.writer(_Echo())
+        response = StreamingHttpResponse(
+            (writer.writerow(row) for row in sales_export_rows(transactions_list)),
+            content_type='text/csv',
+        )
+        response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+        return response
+
+    job = Job.enqueue(request.user, 'sales_export', {
+        'ids': ids_to_export_str,
+        'start_date': start_date,
+        'end_date': end_date,
+        'filename': f"{filename}.xlsx",
+    })
+    messages.info(request, f"Excel export queued as job #{job.pk}. It will be ready to download below shortly.")
+    return redirect('jobs:job_list')
 
 
 @login_required
@@ -804,7 +932,7 @@ def pending_deliveries_view(request):
     UPDATED: This view now also calculates a consolidated "Loading Sheet" for each
     vehicle with pending deliveries.
     """
-    # Get all pending transactions for the user, ordered by vehicle
+    # Get all pending transactions for the user, newest first
     pending_transactions = SalesTransaction.objects.filter(
         user=request.user,
         status='PENDING_DELIVERY',
@@ -815,66 +943,10 @@ def pending_deliveries_view(request):
         'items__product_detail_snapshot__product_base'
     ).order_by('-transaction_time')
 
-    # --- CORRECTED AGGREGATION LOGIC ---
-    # Structure: {vehicle_obj: {product_detail_obj: total_individual_item_count}}
-    vehicle_loading_sheets_agg = defaultdict(lambda: defaultdict(lambda: {'total_items': 0, 'returned_items': 0, 'increased_demand_items': 0}))
-    no_of_invoices = defaultdict(lambda: int(0))  # To count invoices per vehicle
-    for tx in pending_transactions:
-        vehicle = tx.assigned_vehicle
-        no_of_invoices[vehicle.pk] += 1
-        for item in tx.items.all():
-            product_detail = item.product_detail_snapshot
-            # Get the quantity sold as a count of individual items
-            individual_items_sold = item.dispatched_individual_items_count # Use the property
-            returned_items = product_detail._get_items_from_decimal(item.returned_quantity_decimal or Decimal('0.00'))
-            increased_demand = product_detail._get_items_from_decimal(item.increased_demand or Decimal('0.00'))
-            # Add this integer count to the running total for that product on that vehicle
-            vehicle_loading_sheets_agg[vehicle][product_detail]['total_items'] += individual_items_sold
-            vehicle_loading_sheets_agg[vehicle][product_detail]['returned_items'] += returned_items
-            vehicle_loading_sheets_agg[vehicle][product_detail]['increased_demand_items'] += increased_demand
-
-    # Convert the aggregated individual item counts back to the decimal format for display
-    # The final structure will be: {vehicle_object: [ {'product': product_detail, 'total_quantity_decimal': 2.05}, ... ]}
-    final_loading_sheets = {}
-    for vehicle, product_item_counts in vehicle_loading_sheets_agg.items():
-        
-        loading_sheet_items = []
-        for product_detail, counts in product_item_counts.items():
-            # Use the ProductDetail's own helper method to convert the total item count back
-            # into the 'MasterUnits.IndividualItems' decimal format. 
-            loading_sheet_items.append({
-                'product': product_detail,
-                'total_quantity_decimal': product_detail._get_decimal_from_items(counts['total_items']),
-                'returned_quantity_decimal': product_detail._get_decimal_from_items(counts['returned_items']),
-                'increased_demand_decimal': product_detail._get_decimal_from_items(counts['increased_demand_items']),
-            })
-
-        # Sort items by product name for a clean printout
-        final_loading_sheets[vehicle] = sorted(loading_sheet_items, key=lambda x: x['product'].product_base.name)
-
-    # --- Total revenue credit and online and receiveable per vehicle ---
-    vehicle_total_revenue = defaultdict(lambda: Decimal('0.00'))
-    vehicle_total_discount = defaultdict(lambda: Decimal('0.00'))
-    vehicle_total_credit = defaultdict(lambda: Decimal('0.00'))
-    vehicle_total_online = defaultdict(lambda: Decimal('0.00'))
-    vehicle_remaining_amount = defaultdict(lambda: Decimal('0.00'))
-
-    for vehicle, group in groupby(pending_transactions, key=attrgetter('assigned_vehicle')):
-        group = list(group)  # Convert groupby iterator to list to iterate multiple times
-        vehicle_total_revenue[vehicle.pk] += sum(tx.grand_total_revenue for tx in group)
-        vehicle_total_discount[vehicle.pk] += sum(tx.total_discount_amount or Decimal('0.00') for tx in group)
-        vehicle_total_credit[vehicle.pk] += sum(tx.amount_on_credit or Decimal('0.00') for tx in group)
-        vehicle_total_online[vehicle.pk] += sum(tx.amount_paid_online or Decimal('0.00') for tx in group)
-        vehicle_remaining_amount[vehicle.pk] = (vehicle_total_revenue[vehicle.pk]- vehicle_total_credit[vehicle.pk]- vehicle_total_online[vehicle.pk])
+    # Loading sheets are aggregated per vehicle x batch in SQL and cached per vehicle.
     context = {
         'pending_transactions': pending_transactions,
-        'loading_sheets': final_loading_sheets,
-        'vehicle_total_revenue': vehicle_total_revenue,
-        'vehicle_total_discount': vehicle_total_discount,
-        'vehicle_total_credit': vehicle_total_credit,
-        'vehicle_total_online': vehicle_total_online,
-        'vehicle_remaining_amount': vehicle_remaining_amount,
-        'no_of_invoices': no_of_invoices,
+        'loading_sheets': vehicle_loading_sheets(request.user),
     }
     return render(request, 'stock/pending_deliveries.html', context)
 
@@ -882,6 +954,158 @@ def pending_deliveries_view(request):
 
 
 
+@retry_on_conflict
+def _mark_delivery_done(sales_transaction, return_formset, delivery_form):
+    """
+    Saves the returns, increased demand and payment split of a pending delivery and
+    marks it ready for processing; stock is left alone until settlement. Runs in one
+    transaction, so a rejected payment split leaves the items and the rollup untouched.
+    """
+    with sales_rollup_tracked([sales_transaction]):
+        # Save updated return quantities and demand edits
+        final_cost_of_tx = Decimal('0.00')
+        with deferred_totals():
+            for form_item in return_formset:
+                item_instance = form_item.save(commit=False)
+                product = item_instance.product_detail_snapshot
+                returned_qty = form_item.cleaned_data.get('returned_quantity_decimal', Decimal('0.00'))
+                increased_demand = form_item.cleaned_data.get('increased_demand') or Decimal('0.00')
+
+                # Adjust quantity sold for increased demand
+                if increased_demand > 0:
+                    item_instance.returned_quantity_decimal = returned_qty
+                    item_instance.increased_demand = increased_demand
+
+                item_instance.returned_quantity_decimal = returned_qty
+                item_instance.save()
+
+                dispatched_items = product._get_items_from_decimal(item_instance.quantity_sold_decimal)
+                returned_items = product._get_items_from_decimal(returned_qty)
+                increased_items = product._get_items_from_decimal(increased_demand)
+
+                net_items = dispatched_items + increased_items - returned_items
+                final_cost_of_tx += net_items * item_instance.selling_price_per_item
+
+
+        sales_transaction.total_discount_amount = delivery_form.cleaned_data['total_discount_amount']
+        sales_transaction.payment_type = delivery_form.cleaned_data['payment_type']
+        sales_transaction.amount_paid_cash = delivery_form.cleaned_data['amount_paid_cash']
+        sales_transaction.amount_paid_online = delivery_form.cleaned_data['amount_paid_online']
+        sales_transaction.amount_on_credit = delivery_form.cleaned_data['amount_on_credit']
+        discount = sales_transaction.total_discount_amount or Decimal('0.00')
+        expected_total = final_cost_of_tx - discount
+        paid_total = (sales_transaction.amount_on_credit or Decimal('0.00')) + \
+                    (sales_transaction.amount_paid_online or Decimal('0.00')) + \
+                    (sales_transaction.amount_paid_cash or Decimal('0.00'))
+
+        if paid_total > expected_total:
+            raise forms.ValidationError("Total paid amount exceeds final total after discount.")
+        elif paid_total < expected_total:
+            raise forms.ValidationError("Total paid amount is less than final total after discount.")
+        sales_transaction.grand_total_revenue = final_cost_of_tx - discount
+        sales_transaction.is_ready_for_processing = True
+        sales_transaction.status = 'PENDING_DELIVERY'
+        sales_transaction.save()
+        # The discount and payment split were set after the item saves were flushed.
+        sales_transaction.refresh_line_totals()
+
+
+@retry_on_conflict
+def _process_delivery(user, sales_transaction, return_formset, delivery_form):
+    """
+    Settles one delivery from the return formset: books returns and increased demand
+    against stock, applies the payment split and brings the credit ledger entry in line.
+    """
+    # A retried attempt starts again from the stored sold quantities.
+    items = [form_item.instance for form_item in return_formset]
+    stored = dict(SalesTransactionItem.objects.filter(pk__in=[item.pk for item in items]).values_list('pk', 'quantity_sold_decimal'))
+    for item in items:
+        item.quantity_sold_decimal = stored[item.pk]
+    with sales_rollup_tracked([sales_transaction]):
+        # Item saves only queue the header; it is recomputed once when this block exits.
+        with deferred_totals(), batched_movements():
+            for form_item in return_formset:
+                item_instance = form_item.instance
+                product_detail = item_instance.product_detail_snapshot
+
+                # Process returned quantity change
+                new_returned =  form_item.cleaned_data.get('returned_quantity_decimal') or Decimal('0.00')
+                if new_returned:
+                    new_returned = product_detail._get_items_from_decimal(new_returned)
+                    product_detail.increase_stock(product_detail._get_decimal_from_items(new_returned), StockMovement.DELIVERY_RETURN, sales_transaction=sales_transaction)
+
+                # Process increased demand
+                increased_demand = form_item.cleaned_data.get('increased_demand') or Decimal('0.00')
+                if increased_demand > 0:
+                    original_qty = item_instance.quantity_sold_decimal or Decimal('0.00')
+                    total_items = product_detail._get_items_from_decimal(original_qty) + product_detail._get_items_from_decimal(increased_demand)
+                    updated_qty = product_detail._get_decimal_from_items(total_items)
+                    item_instance.quantity_sold_decimal = updated_qty
+                    product_detail.decrease_stock(increased_demand, StockMovement.INCREASED_DEMAND, sales_transaction=sales_transaction)
+                    item_instance.save()
+
+            return_formset.save()
+
+            # Recalculate grand total with the new discount (queued last, so this copy is used)
+            sales_transaction.total_discount_amount = delivery_form.cleaned_data.get('total_discount_amount') or Decimal('0.00')
+            defer_grand_totals(sales_transaction)
+        sales_transaction.refresh_from_db()
+        final_grand_total = sales_transaction.grand_total_revenue
+
+        # Payment processing
+        payment_type = delivery_form.cleaned_data['payment_type']
+        cash = delivery_form.cleaned_data.get('amount_paid_cash') or Decimal('0.00')
+        online = delivery_form.cleaned_data.get('amount_paid_online') or Decimal('0.00')
+        credit = delivery_form.cleaned_data.get('amount_on_credit') or Decimal('0.00')
+
+        if payment_type == 'SPLIT':
+            total_split = (cash + online + credit).quantize(Decimal('0.01'))
+            if total_split != final_grand_total.quantize(Decimal('0.01')):
+                raise forms.ValidationError(f"Split payments (Rs {total_split}) do not match Grand Total (Rs {final_grand_total}).")
+            sales_transaction.amount_paid_cash = cash
+            sales_transaction.amount_paid_online = online
+            sales_transaction.amount_on_credit = credit
+            sales_transaction.notes = (
+                f"Split Payment: Cash = Rs {cash:.2f}, "
+                f"Online = Rs {online:.2f}, "
+                f"Credit = Rs {credit:.2f}"
+            )
+        else:
+            sales_transaction.amount_paid_cash = final_grand_total if payment_type == 'CASH' else Decimal('0.00')
+            sales_transaction.amount_paid_online = final_grand_total if payment_type == 'ONLINE' else Decimal('0.00')
+            sales_transaction.amount_on_credit = final_grand_total if payment_type == 'CREDIT' else Decimal('0.00')
+
+        sales_transaction.payment_type = payment_type
+
+        # Update status
+        total_dispatched = sum(item.dispatched_individual_items_count for item in sales_transaction.items.all())
+        total_returned = sum(item.returned_individual_items_count for item in sales_transaction.items.all())
+
+        if total_returned == 0:
+            sales_transaction.status = 'COMPLETED'
+        elif total_returned >= total_dispatched:
+            sales_transaction.status = 'FULLY_RETURNED'
+        else:
+            sales_transaction.status = 'PARTIALLY_RETURNED'
+
+        sales_transaction.save()
+
+        # Financial Ledger
+        existing_credit = ShopFinancialTransaction.objects.filter(source_sale=sales_transaction).first()
+        if sales_transaction.amount_on_credit > 0 and sales_transaction.customer_shop:
+            if existing_credit:
+                existing_credit.debit_amount = sales_transaction.amount_on_credit
+                existing_credit.save()
+            else:
+                ShopFinancialTransaction.objects.create(
+                    shop=sales_transaction.customer_shop, user=user,
+                    source_sale=sales_transaction, transaction_type='CREDIT_SALE',
+                    debit_amount=sales_transaction.amount_on_credit
+                )
+        elif existing_credit:
+            existing_credit.delete()
+
+
 @login_required
 def process_delivery_return_view(request, sale_pk):
     sales_transaction = get_object_or_404(
@@ -900,139 +1124,14 @@ def process_delivery_return_view(request, sale_pk):
             mark_as_done = 'mark_as_done' in request.POST
             try:
                 if mark_as_done:
-                    # Save updated return quantities and demand edits
-                    final_cost_of_tx = Decimal('0.00')
-                    for form_item in return_formset:
-                        item_instance = form_item.save(commit=False)
-                        product = item_instance.product_detail_snapshot
-                        returned_qty = form_item.cleaned_data.get('returned_quantity_decimal', Decimal('0.00'))
-                        increased_demand = form_item.cleaned_data.get('increased_demand') or Decimal('0.00')
-
-                        # Adjust quantity sold for increased demand
-                        if increased_demand > 0:
-                            item_instance.returned_quantity_decimal = returned_qty
-                            item_instance.increased_demand = increased_demand
-
-                        item_instance.returned_quantity_decimal = returned_qty
-                        item_instance.save()
-
-                        dispatched_items = product._get_items_from_decimal(item_instance.quantity_sold_decimal)
-                        returned_items = product._get_items_from_decimal(returned_qty)
-                        increased_items = product._get_items_from_decimal(increased_demand)
-
-                        net_items = dispatched_items + increased_items - returned_items
-                        final_cost_of_tx += net_items * item_instance.selling_price_per_item
-
-
-                    sales_transaction.total_discount_amount = delivery_form.cleaned_data['total_discount_amount']
-                    sales_transaction.payment_type = delivery_form.cleaned_data['payment_type']
-                    sales_transaction.amount_paid_cash = delivery_form.cleaned_data['amount_paid_cash']
-                    sales_transaction.amount_paid_online = delivery_form.cleaned_data['amount_paid_online']
-                    sales_transaction.amount_on_credit = delivery_form.cleaned_data['amount_on_credit']
-                    discount = sales_transaction.total_discount_amount or Decimal('0.00')
-                    expected_total = final_cost_of_tx - discount
-                    paid_total = (sales_transaction.amount_on_credit or Decimal('0.00')) + \
-                                (sales_transaction.amount_paid_online or Decimal('0.00')) + \
-                                (sales_transaction.amount_paid_cash or Decimal('0.00'))
-
-                    if paid_total > expected_total:
-                        raise forms.ValidationError("Total paid amount exceeds final total after discount.")
-                    elif paid_total < expected_total:
-                        raise forms.ValidationError("Total paid amount is less than final total after discount.")
-                    sales_transaction.grand_total_revenue = final_cost_of_tx - discount
-                    sales_transaction.is_ready_for_processing = True
-                    sales_transaction.status = 'PENDING_DELIVERY'
-                    sales_transaction.save()
+                    _mark_delivery_done(sales_transaction, return_formset, delivery_form)
                     messages.success(request, "Marked as done. Will be processed with your changes.")
-                    
                     return redirect('stock:pending_deliveries')
-                    # mark as done is completed and controll is returned ......
 
                 # Full processing
-                with transaction.atomic():
-                    for form_item in return_formset:
-                        item_instance = form_item.instance
-                        product_detail = item_instance.product_detail_snapshot
-
-                        # Process returned quantity change
-                        new_returned =  form_item.cleaned_data.get('returned_quantity_decimal') or Decimal('0.00')
-                        if new_returned:
-                            new_returned = product_detail._get_items_from_decimal(new_returned)
-                            product_detail.increase_stock(product_detail._get_decimal_from_items(new_returned))
-
-                        # Process increased demand
-                        increased_demand = form_item.cleaned_data.get('increased_demand') or Decimal('0.00')
-                        if increased_demand > 0:
-                            original_qty = item_instance.quantity_sold_decimal or Decimal('0.00')
-                            total_items = product_detail._get_items_from_decimal(original_qty) + product_detail._get_items_from_decimal(increased_demand)
-                            updated_qty = product_detail._get_decimal_from_items(total_items)
-                            item_instance.quantity_sold_decimal = updated_qty
-                            product_detail.decrease_stock(increased_demand)
-                            item_instance.save()
-
-                    return_formset.save()
-
-                    # Recalculate grand total
-                    new_discount = delivery_form.cleaned_data.get('total_discount_amount') or Decimal('0.00')
-                    sales_transaction.update_grand_totals(new_discount_amount=new_discount)
-                    sales_transaction.refresh_from_db()
-                    final_grand_total = sales_transaction.grand_total_revenue
-
-                    # Payment processing
-                    payment_type = delivery_form.cleaned_data['payment_type']
-                    cash = delivery_form.cleaned_data.get('amount_paid_cash') or Decimal('0.00')
-                    online = delivery_form.cleaned_data.get('amount_paid_online') or Decimal('0.00')
-                    credit = delivery_form.cleaned_data.get('amount_on_credit') or Decimal('0.00')
-
-                    if payment_type == 'SPLIT':
-                        total_split = (cash + online + credit).quantize(Decimal('0.01'))
-                        if total_split != final_grand_total.quantize(Decimal('0.01')):
-                            raise forms.ValidationError(f"Split payments (Rs {total_split}) do not match Grand Total (Rs {final_grand_total}).")
-                        sales_transaction.amount_paid_cash = cash
-                        sales_transaction.amount_paid_online = online
-                        sales_transaction.amount_on_credit = credit
-                        sales_transaction.notes = (
-                            f"Split Payment: Cash = Rs {cash:.2f}, "
-                            f"Online = Rs {online:.2f}, "
-                            f"Credit = Rs {credit:.2f}"
-                        )
-                    else:
-                        sales_transaction.amount_paid_cash = final_grand_total if payment_type == 'CASH' else Decimal('0.00')
-                        sales_transaction.amount_paid_online = final_grand_total if payment_type == 'ONLINE' else Decimal('0.00')
-                        sales_transaction.amount_on_credit = final_grand_total if payment_type == 'CREDIT' else Decimal('0.00')
-
-                    sales_transaction.payment_type = payment_type
-
-                    # Update status
-                    total_dispatched = sum(item.dispatched_individual_items_count for item in sales_transaction.items.all())
-                    total_returned = sum(item.returned_individual_items_count for item in sales_transaction.items.all())
-
-                    if total_returned == 0:
-                        sales_transaction.status = 'COMPLETED'
-                    elif total_returned >= total_dispatched:
-                        sales_transaction.status = 'FULLY_RETURNED'
-                    else:
-                        sales_transaction.status = 'PARTIALLY_RETURNED'
-
-                    sales_transaction.save()
-
-                    # Financial Ledger
-                    existing_credit = ShopFinancialTransaction.objects.filter(source_sale=sales_transaction).first()
-                    if sales_transaction.amount_on_credit > 0 and sales_transaction.customer_shop:
-                        if existing_credit:
-                            existing_credit.debit_amount = sales_transaction.amount_on_credit
-                            existing_credit.save()
-                        else:
-                            ShopFinancialTransaction.objects.create(
-                                shop=sales_transaction.customer_shop, user=request.user,
-                                source_sale=sales_transaction, transaction_type='CREDIT_SALE',
-                                debit_amount=sales_transaction.amount_on_credit
-                            )
-                    elif existing_credit:
-                        existing_credit.delete()
-
-                    messages.success(request, f"Delivery for Transaction #{sales_transaction.pk} processed successfully.")
-                    return redirect('stock:pending_deliveries')
+                _process_delivery(request.user, sales_transaction, return_formset, delivery_form)
+                messages.success(request, f"Delivery for Transaction #{sales_transaction.pk} processed successfully.")
+                return redirect('stock:pending_deliveries')
 
             except forms.ValidationError as e:
                 delivery_form.add_error(None, e)
@@ -1062,89 +1161,47 @@ def process_all_pending_for_vehicle(request, vehicle_id):
         assigned_vehicle=vehicle,
         user=request.user,
         status='PENDING_DELIVERY'
-    ).prefetch_related('items__product_detail_snapshot', 'customer_shop')
+    )
 
     if not transactions.exists():
         messages.warning(request, f"No pending deliveries found for vehicle {vehicle.vehicle_number}.")
         return redirect('stock:pending_deliveries')
 
     try:
-        for tx in transactions:
-            final_total = Decimal('0.00')
-            for item in tx.items.all():
-                product = item.product_detail_snapshot
-                selling_price = item.selling_price_per_item or Decimal('0.00')
-
-                dispatched_items = product._get_items_from_decimal(item.quantity_sold_decimal or Decimal('0.00'))
-                returned_items = product._get_items_from_decimal(item.returned_quantity_decimal or Decimal('0.00'))
-                increased_items = product._get_items_from_decimal(item.increased_demand or Decimal('0.00'))
-
-                # Apply stock changes
-                if returned_items > 0:
-                    product.increase_stock(product._get_decimal_from_items(returned_items))
-
-                if increased_items > 0:
-                    product.decrease_stock(product._get_decimal_from_items(increased_items))
-
-                # Update sold quantity (original + increased)
-                new_total_items = dispatched_items + increased_items
-                item.quantity_sold_decimal = product._get_decimal_from_items(new_total_items)
-                item.save()
-
-                net_items = new_total_items - returned_items
-                net_items = max(net_items, 0)
-                final_total += selling_price * net_items
-
-            # Apply discount
-            discount = tx.total_discount_amount or Decimal('0.00')
-            final_total -= discount
-
-            tx.grand_total_revenue = final_total
-
-            # Process payment fields
-            if tx.payment_type == 'SPLIT':
-                cash = tx.amount_paid_cash or Decimal('0.00')
-                online = tx.amount_paid_online or Decimal('0.00')
-                credit = tx.amount_on_credit or Decimal('0.00')
-                tx.notes = f"Split Payment: Cash = Rs {cash:.2f}, Online = Rs {online:.2f}, Credit = Rs {credit:.2f}"
-            else:
-                cash = final_total if tx.payment_type == 'CASH' else Decimal('0.00')
-                online = final_total if tx.payment_type == 'ONLINE' else Decimal('0.00')
-                credit = final_total if tx.payment_type == 'CREDIT' else Decimal('0.00')
-                tx.notes = ""
-
-            tx.amount_paid_cash = cash
-            tx.amount_paid_online = online
-            tx.amount_on_credit = credit
-            tx.status = 'COMPLETED'
-            tx.is_ready_for_processing = False  # Reset manual flag
-            tx.save()
-
-            # Update financial ledger
-            existing_ledger = ShopFinancialTransaction.objects.filter(source_sale=tx).first()
-            if credit > 0 and tx.customer_shop:
-                if existing_ledger:
-                    existing_ledger.debit_amount = credit
-                    existing_ledger.save()
-                else:
-                    ShopFinancialTransaction.objects.create(
-                        shop=tx.customer_shop,
-                        user=request.user,
-                        source_sale=tx,
-                        transaction_type='CREDIT_SALE',
-                        debit_amount=credit
-                    )
-            elif existing_ledger:
-                existing_ledger.delete()
-
-        messages.success(request, f"All pending deliveries for vehicle {vehicle.vehicle_number} processed successfully.")
-
+        Job.enqueue(request.user, 'settle_vehicle_deliveries', {'vehicle_id': vehicle.pk})
+        messages.success(request, f"Processing of all pending deliveries for vehicle {vehicle.vehicle_number} has been queued. Track it under Background Jobs.")
     except Exception as e:
         messages.error(request, f"A critical error occurred: {str(e)}")
 
     return redirect('stock:pending_deliveries')
 
 
+@login_required
+@require_POST
+def submit_route_returns_api(request, vehicle_pk):
+    """
+    JSON check-in for a whole route: {"invoices": [...], "settle": false}. See
+    apply_route_returns for the invoice format. Either every invoice is applied or none
+    is, and the response carries one result per invoice.
+    """
+    vehicle = get_object_or_404(Vehicle, pk=vehicle_pk, user=request.user)
+    try:
+        payload = json.loads(request.body or b'{}')
+        invoices = payload.get('invoices')
+    except (ValueError, AttributeError):
+        return JsonResponse({'success': False, 'error': 'Request body must be a JSON object.'}, status=400)
+    if not isinstance(invoices, list) or not invoices or not all(isinstance(data, dict) for data in invoices):
+        return JsonResponse({'success': False, 'error': "'invoices' must be a non-empty list of objects."}, status=400)
+
+    try:
+        ok, results = retry_on_conflict(apply_route_returns)(request.user, vehicle, invoices, settle=bool(payload.get('settle')))
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': f'An unexpected server error occurred: {str(e)}'}, status=500)
+    if not ok:
+        return JsonResponse({'success': False, 'error': 'Some invoices were rejected; nothing was saved.', 'data': {'invoices': results}}, status=400)
+    return JsonResponse({'success': True, 'data': {'invoices': results, 'settled': bool(payload.get('settle'))}})
+
+
 @login_required
 @admin_mode_required
 def sales_report_view(request):
@@ -1168,85 +1225,81 @@ def sales_report_view(request):
     end_of_year = timezone.make_aware(timezone.datetime.combine(end_of_year.date(), timezone.datetime.max.time()))
 
 
-    def get_period_stats(start_dt, end_dt):
-        """
-        Helper function to get sales and expense stats for a given period.
-        """
-        transactions = SalesTransaction.objects.filter(
-            user=request.user, 
-            transaction_time__range=(start_dt, end_dt)
-        )
-        expenses = Expense.objects.filter(
-            user=request.user, 
-            expense_date__range=(start_dt, end_dt)
-        )
-        claims = Claim.objects.filter(
-            user=request.user,
-            status='COMPLETED',
-            claim_date__range=(start_dt, end_dt)
-        )
-        stock_claim_loss = sum(claim.value_of_items_given for claim in claims) or Decimal('0.00')
-        
-        total_revenue = sum(tx.grand_total_revenue for tx in transactions)
-        total_profit = sum(tx.calculated_grand_profit for tx in transactions)
-        total_expense = expenses.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-                
-        net_profit = total_profit - total_expense - stock_claim_loss
-        
+    periods = {
+        'today': (start_of_today, end_of_today),
+        'week': (start_of_week, end_of_week),
+        'month': (start_of_month, end_of_month),
+        'year': (start_of_year, end_of_year),
+    }
+    # One conditional-aggregation query per source table covers all four periods.
+    # Sales come from the daily rollup, whose rows are keyed by local business date.
+    net_revenue = F('revenue') - F('discount')
+    sales = sum_by_period(
+        SalesDailyRollup.objects.filter(user=request.user), 'business_date',
+        {period: (timezone.localdate(start), timezone.localdate(end)) for period, (start, end) in periods.items()},
+        {
+            'count': 'sales_count',
+            'revenue': net_revenue,
+            'profit': net_revenue - F('cost'),
+        },
+    )
+    expenses = sum_by_period(
+        Expense.objects.filter(user=request.user), 'expense_date', periods, {'amount': 'amount'}
+    )
+    claim_losses = sum_by_period(
+        ClaimItem.objects.filter(claim__user=request.user, claim__status='COMPLETED', item_type='EXCHANGED'),
+        'claim__claim_date', periods, {'cost': claim_loss_expression()},
+    )
+
+    def period_stats(period):
+        total_profit = sales[period]['profit']
+        total_expense = expenses[period]['amount']
+        stock_claim_loss = claim_losses[period]['cost']
         return {
-            'transactions_count': transactions.count(),
-            'total_grand_revenue': total_revenue,
+            'transactions_count': int(sales[period]['count']),
+            'total_grand_revenue': sales[period]['revenue'],
             'total_grand_profit': total_profit,
             'total_expense': total_expense,
             'stock_claim_loss': stock_claim_loss,
-            'net_profit': net_profit,
+            'net_profit': total_profit - total_expense - stock_claim_loss,
         }
 
-    stats_today = get_period_stats(start_of_today, end_of_today)
-    stats_this_week = get_period_stats(start_of_week, end_of_week)
-    stats_this_month = get_period_stats(start_of_month, end_of_month)
-    stats_this_year = get_period_stats(start_of_year, end_of_year)
-
-    # --- Data for Charts (using SalesTransaction) ---
+    stats_today = period_stats('today')
+    stats_this_week = period_stats('week')
+    stats_this_month = period_stats('month')
+    stats_this_year = period_stats('year')
+
+    # --- Data for Charts (using SalesDailyRollup) ---
+    # Grouped in the database by business day / month; days with no sales are filled with 0.
+    first_chart_day = today - timedelta(days=6)
+    daily_totals = dict(
+        SalesDailyRollup.objects.filter(user=request.user, business_date__range=(first_chart_day, today))
+        .values('business_date')
+        .annotate(revenue=Sum(net_revenue))
+        .values_list('business_date', 'revenue')
+    )
     daily_labels = []
     daily_revenue_data = []
     for i in range(6, -1, -1):
         day = today - timedelta(days=i)
-        start = timezone.make_aware(timezone.datetime.combine(day, timezone.datetime.min.time()))
-        end = timezone.make_aware(timezone.datetime.combine(day, timezone.datetime.max.time()))
-
-        tx_on_day = SalesTransaction.objects.filter(user=request.user, transaction_time__range=(start, end))
-        daily_revenue = sum(tx.grand_total_revenue for tx in tx_on_day) or Decimal('0.00')
-
         daily_labels.append(day.strftime("%a")) # Short day name e.g., "Mon"
-        daily_revenue_data.append(float(daily_revenue))
-
-
-
-    # ... Monthly chart data logic ...
-    monthly_labels = []
-    monthly_revenue_data = []
-    for i in range(5, -1, -1):
-        # ... (logic for first_day_of_target_month, last_day_of_target_month as before) ...
+        daily_revenue_data.append(float(daily_totals.get(day) or Decimal('0.00')))
+
+    chart_months = [today.replace(day=1)]
+    for _ in range(5):
+        chart_months.insert(0, (chart_months[0] - timedelta(days=1)).replace(day=1))
+    monthly_totals = dict(
+        SalesDailyRollup.objects.filter(
+            user=request.user, business_date__range=(chart_months[0], timezone.localdate(end_of_month)),
+        )
+        .annotate(month=TruncMonth('business_date', output_field=DateField()))
+        .values('month')
+        .annotate(revenue=Sum(net_revenue))
+        .values_list('month', 'revenue')
+    )
+    monthly_labels = [month.strftime("%b %Y") for month in chart_months]
+    monthly_revenue_data = [float(monthly_totals.get(month) or Decimal('0.00')) for month in chart_months]
 
-        target_month_date = today # Start from today for current month calculation
-        
-        for _ in range(i):
-            first_day_of_prev_month = target_month_date.replace(day=1) - timedelta(days=1)
-            target_month_date = first_day_of_prev_month
-        start_of_target_month = target_month_date.replace(day=1)
-        next_m = start_of_target_month.replace(day=28) + timedelta(days=4)
-        end_of_target_month = next_m - timedelta(days=next_m.day)
-        
-        start_dt = timezone.make_aware(timezone.datetime.combine(start_of_target_month, timezone.datetime.min.time()))
-        end_dt = timezone.make_aware(timezone.datetime.combine(end_of_target_month, timezone.datetime.max.time()))
-        
-        tx_in_month = SalesTransaction.objects.filter(user=request.user, transaction_time__range=(start_dt, end_dt))
-        monthly_revenue = sum(tx.grand_total_revenue for tx in tx_in_month) or Decimal('0.00')
-        
-        monthly_labels.append(start_of_target_month.strftime("%b %Y"))
-        monthly_revenue_data.append(float(monthly_revenue))
-        
     context = {
         'stats_today': stats_today,
         'stats_this_week': stats_this_week,
@@ -1505,55 +1558,78 @@ def ajax_get_shop_data(request, shop_pk):
 
 
 
+SHOP_LEADERBOARD_SORTS = {
+    'name': 'name',
+    'sales': 'sales_count',
+    'revenue': 'total_revenue',
+    'profit': 'total_profit',
+    'average': 'average_ticket',
+    'last': 'last_purchase',
+}
+
+
 @login_required
 def list_shops_for_sales_view(request):
-    # This view should be fine if it only lists Shop instances.
-    # The links it generates will point to shop_purchase_history_view.
-    shops = Shop.objects.filter(user=request.user, is_active=True).order_by('name')
-    
-    # Filter shops to only include those with transactions having grand_total_revenue > 0
-    shops_with_revenue = []
-    for shop in shops:
-        shop_transactions = SalesTransaction.objects.filter(
-            customer_shop=shop,
-            user=request.user 
-        ).select_related(
-            'assigned_vehicle'
-        ).prefetch_related(
-            'items__product_detail_snapshot__product_base'
-        ).order_by('-transaction_time')
-        
-        # Check if this shop has any transactions with revenue > 0
-        total_revenue = sum(tx.grand_total_revenue for tx in shop_transactions)
-        if total_revenue > 0:
-            shops_with_revenue.append(shop)
+    """
+    Shop revenue leaderboard: one annotated query per user (cached until one of the
+    user's shop sales changes), sorted and paginated in memory.
+    """
+    rows = shop_leaderboard(request.user)
+
+    sort = request.GET.get('sort', '-revenue')
+    sort_key = SHOP_LEADERBOARD_SORTS.get(sort.lstrip('-'))
+    if sort_key is None:
+        sort, sort_key = '-revenue', 'total_revenue'
+    descending = sort.startswith('-')
+    if sort_key == 'name':
+        rows = sorted(rows, key=lambda row: row['name'].lower(), reverse=descending)
+    else:
+        rows = sorted(rows, key=lambda row: (row[sort_key] is not None, row[sort_key] or 0), reverse=descending)
 
-    context = {'shops': shops_with_revenue}
+    paginator = Paginator(rows, 25)
+    page_obj = paginator.get_page(request.GET.get('page'))
+
+    context = {
+        'shops': page_obj.object_list,
+        'page_obj': page_obj,
+        'sort': sort,
+        'rank_offset': page_obj.start_index() - 1 if paginator.count else 0,
+    }
     return render(request, 'stock/list_shops_for_sales.html', context)
 
 @login_required
 def shop_purchase_history_view(request, shop_pk):
-    shop = get_object_or_404(Shop, pk=shop_pk) # Potentially add user=request.user if shops are user-scoped
+    shop = get_object_or_404(Shop, pk=shop_pk, user=request.user)
 
     # Fetch SalesTransaction records associated with this shop and processed by the current user
-    shop_transactions = SalesTransaction.objects.filter(
-        customer_shop=shop,
-        user=request.user 
-    ).select_related(
-        'assigned_vehicle' # No need to select_related product_detail here, items are separate
-    ).prefetch_related(
-        'items__product_detail_snapshot__product_base'
-    ).order_by('-transaction_time')
+    shop_sales = SalesTransaction.objects.filter(customer_shop=shop, user=request.user)
+    profit = ExpressionWrapper(F('grand_total_revenue') - F('grand_total_cost'), output_field=DecimalField(max_digits=14, decimal_places=2))
+
+    # Headline totals and the per-month strip are computed by the database.
+    totals = shop_sales.aggregate(revenue=Sum('grand_total_revenue'), profit=Sum(profit), count=Count('id'))
+    monthly_totals = (
+        shop_sales.annotate(month=TruncMonth('transaction_time', output_field=DateField()))
+        .values('month')
+        .annotate(revenue=Sum('grand_total_revenue'), profit=Sum(profit), count=Count('id'))
+        .order_by('-month')
+    )
 
-    # Recalculate totals based on the new structure
-    shop_total_revenue = sum(tx.grand_total_revenue for tx in shop_transactions)
-    shop_total_profit = sum(tx.calculated_grand_profit for tx in shop_transactions)
+    # Only one page of invoices (newest first) is loaded, via keyset pagination.
+    shop_transactions = keyset_paginate(
+        shop_sales.select_related('assigned_vehicle').prefetch_related('items__product_detail_snapshot__product_base'),
+        keys=('transaction_time', 'id'),
+        after=request.GET.get('after'),
+        before=request.GET.get('before'),
+        per_page=50,
+    )
 
     context = {
         'shop': shop,
         'shop_transactions': shop_transactions, # Changed context variable name
-        'shop_total_revenue': shop_total_revenue,
-        'shop_total_profit': shop_total_profit,
+        'shop_total_revenue': totals['revenue'] or Decimal('0.00'),
+        'shop_total_profit': totals['profit'] or Decimal('0.00'),
+        'shop_transactions_count': totals['count'],
+        'monthly_totals': monthly_totals,
     }
     return render(request, 'stock/shop_purchase_history.html', context)
 
@@ -1605,156 +1681,28 @@ def group_performance_summary_view(request, vehicle_pk=None):
     user = request.user
     
     if vehicle_pk:
-        grouping_object = get_object_or_404(Vehicle, pk=vehicle_pk)
+        grouping_object = get_object_or_404(Vehicle, pk=vehicle_pk, user=user)
         grouping_name = f"Performance Summary for: {grouping_object.vehicle_number}"
-        base_items_query = SalesTransactionItem.objects.filter(
-            transaction__user=user, transaction__assigned_vehicle=grouping_object
-        )
+        base_rollup_query = SalesDailyRollup.objects.filter(user=user, vehicle=grouping_object)
     else:
         grouping_object = None
         grouping_name = "Performance Summary for: Store"
-        base_items_query = SalesTransactionItem.objects.filter(
-            transaction__user=user, transaction__assigned_vehicle__isnull=True
-        )
+        base_rollup_query = SalesDailyRollup.objects.filter(user=user, vehicle__isnull=True)
 
-    # Pre-fetch related data for efficiency
-    base_items_query = base_items_query.select_related(
-        'transaction', 'product_detail_snapshot__product_base'
+    # Page over the days that have sales; the engine then reads the rollup rows of the
+    # months on this page once and builds both the daily and monthly buckets.
+    days_with_sales = list(
+        base_rollup_query.order_by('-business_date').values_list('business_date', flat=True).distinct()
     )
-    
-    # --- Daily Summary Calculation ---
-    days_with_sales = base_items_query.annotate(
-        day=TruncDate('transaction__transaction_time')
-    ).values_list('day', flat=True).distinct().order_by('-day')
-    
-    daily_summary = []
-    for day in days_with_sales:
-        items_on_day = base_items_query.filter(transaction__transaction_time__date=day)
-        net_revenue_on_day = Decimal('0.00')
-        seen_transactions_daily = set()
-        credit_total = Decimal('0.00')
-        online_total = Decimal('0.00')
-        for item in items_on_day:
-            transaction = item.transaction
-            total_discount = transaction.total_discount_amount or 0
-            gross_total = sum(i.gross_line_subtotal for i in transaction.items.all())
-            if gross_total != 0:
-                item_discount = ((item.gross_line_subtotal / gross_total) * total_discount).quantize(Decimal('0.00'), rounding=ROUND_HALF_UP)
-            else:
-                item_discount = Decimal('0.00')
-            if transaction.pk not in seen_transactions_daily:
-                seen_transactions_daily.add(transaction.pk)
-                credit_total  += transaction.amount_on_credit or Decimal('0.00')
-                online_total += transaction.amount_paid_online or Decimal('0.00')
-            
-            # Calculate net revenue in Python for accuracy
-            net_revenue_on_day += item.gross_line_subtotal - item_discount
-
-        
-        # --- PYTHON-BASED NET QUANTITY CALCULATION ---
-        # 1. Group items by their packaging and sum their individual item counts.
-        quantity_agg = defaultdict(int)
-        # Store a reference object for each group to access its properties later
-        ref_objects = {}
-        for item in items_on_day:
-            pd_snapshot = item.product_detail_snapshot
-            # Use the product detail's PK as a simple, hashable key
-            key = pd_snapshot.pk
-            quantity_agg[key] += item.actual_sold_individual_items_count
-            if key not in ref_objects:
-                ref_objects[key] = pd_snapshot
-
-        # 2. Convert the summed individual item counts back to the decimal format.
-        quantity_breakdown = []
-        for pk, total_items in quantity_agg.items():
-            if total_items > 0:
-                # Get the reference ProductDetail object for this group
-                ref_product_detail = ref_objects[pk]
-                
-                # Call the method from the correct model (ProductDetail)
-                net_quantity_decimal = ref_product_detail._get_decimal_from_items(total_items)
-
-                # Format the dictionary EXACTLY as the template expects
-                quantity_breakdown.append({
-                    'net_quantity': net_quantity_decimal,
-                    'product_detail_snapshot__quantity_in_packing': ref_product_detail.quantity_in_packing,
-                    'product_detail_snapshot__unit_of_measure': ref_product_detail.unit_of_measure,
-                })
-        
-        daily_summary.append({
-            'day': day,
-            'total_revenue': net_revenue_on_day,
-            'quantity_breakdown': sorted(quantity_breakdown, key=lambda x: x['net_quantity'], reverse=True),
-            'credit_total': credit_total,
-            'online_total': online_total,
-        })
-
-    # --- Monthly Summary Calculation ---
-    months_with_sales = base_items_query.annotate(
-        month=TruncMonth('transaction__transaction_time')
-    ).values_list('month', flat=True).distinct().order_by('-month')
-
-    monthly_summary = []
-    for month in months_with_sales:
-        items_in_month = base_items_query.filter(
-            transaction__transaction_time__year=month.year,
-            transaction__transaction_time__month=month.month
-        )
-        net_revenue_in_month = Decimal('0.00')
-        monthly_credit_total = Decimal('0.00')
-        monthly_online_total = Decimal('0.00')
-        seen_transactions  = set()  # To track unique transactions in the month
-        for item in items_in_month:
-            transaction = item.transaction
-            total_discount = transaction.total_discount_amount or Decimal('0.00')
-            total_gross = sum(i.gross_line_subtotal for i in transaction.items.all())
-
-            if total_gross != 0:
-                item_discount = ((item.gross_line_subtotal / total_gross) * total_discount).quantize(Decimal('0.00'), rounding=ROUND_HALF_UP)
-            else:
-                item_discount = Decimal('0.00')
-
-            net_revenue_in_month += item.gross_line_subtotal - item_discount
-            # print(item, transaction.amount_on_credit, transaction.amount_paid_online, item.pk)
-            if transaction.pk not in seen_transactions:
-                seen_transactions.add(transaction.pk)
-                monthly_credit_total += item.transaction.amount_on_credit or Decimal('0.00')
-                print("Credit Total:", monthly_credit_total, "Item:", item)
-                monthly_online_total += item.transaction.amount_paid_online or Decimal('0.00')
-             
-        # ---SAME PYTHON-BASED NET QUANTITY CALCULATION ---
-        quantity_agg = defaultdict(int)
-        ref_objects = {}
-        for item in items_in_month:
-            pd_snapshot = item.product_detail_snapshot
-            key = pd_snapshot.pk
-            quantity_agg[key] += item.actual_sold_individual_items_count
-            if key not in ref_objects:
-                ref_objects[key] = pd_snapshot
-        
-        quantity_breakdown = []
-        for pk, total_items in quantity_agg.items():
-            if total_items > 0:
-                ref_product_detail = ref_objects[pk]
-                net_quantity_decimal = ref_product_detail._get_decimal_from_items(total_items)
-                quantity_breakdown.append({
-                    'net_quantity': net_quantity_decimal,
-                    'product_detail_snapshot__quantity_in_packing': ref_product_detail.quantity_in_packing,
-                    'product_detail_snapshot__unit_of_measure': ref_product_detail.unit_of_measure,
-                })
-
-        monthly_summary.append({
-            'month': month,
-            'total_revenue': net_revenue_in_month,
-            'quantity_breakdown': sorted(quantity_breakdown, key=lambda x: x['net_quantity'], reverse=True),
-            'monthly_credit_total': monthly_credit_total,
-            'monthly_online_total': monthly_online_total,
-        })
+    paginator = Paginator(days_with_sales, 31)
+    page_obj = paginator.get_page(request.GET.get('page'))
+    daily_summary, monthly_summary = performance_summary(base_rollup_query, list(page_obj.object_list))
 
     context = {
         'grouping_name': grouping_name,
         'daily_summary': daily_summary,
         'monthly_summary': monthly_summary,
+        'page_obj': page_obj,
     }
     return render(request, 'stock/group_performance_summary.html', context)
 